@@ -9,6 +9,7 @@ setup(
     package_dir={"": "src"},
     install_requires=[
         "click==8.0.3",
+        "httpx==0.23.0",
         "pandas==1.4.2",
         "pydantic[email]==1.9.0",
         "requests==2.27.1",
@@ -17,6 +18,7 @@ setup(
         "urllib3==1.26.9",
     ],
     extras_require={
+        "parquet": ["pyarrow==8.0.0"],
         "test": ["pytest==7.1.1"],
     },
     entry_points={"console_scripts": ["data-inclusion=data_inclusion.cli.cli:cli"]},
@@ -1,16 +1,25 @@
 import logging
+from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Optional
 
 import click
+import sqlalchemy as slqa
 
 from data_inclusion import settings
 from data_inclusion.tasks import (
+    ban_index,
+    codes_postaux,
+    communes,
     constants,
     extract,
     geocoding,
     load,
     reshape,
     services,
+    sirene,
+    sirene_index,
+    sirene_stock,
     siretisation,
     validate,
 )
@@ -18,6 +27,125 @@ from data_inclusion.tasks import (
 logger = logging.getLogger(__name__)
 
 
+def get_geocoding_backend() -> geocoding.GeocodingBackend:
+    if settings.GEOCODING_BACKEND == "ban-local":
+        if settings.BAN_INDEX_PATH is None:
+            raise click.UsageError("BAN_INDEX_PATH not configured.")
+        geocoding_backend = ban_index.LocalBaseAdresseNationaleBackend(
+            index_dir=Path(settings.BAN_INDEX_PATH)
+        )
+    elif settings.GEOCODING_BACKEND == "ban-async":
+        geocoding_backend = geocoding.SyncGeocodingBackend(
+            backend=geocoding.AsyncBaseAdresseNationaleBackend(
+                base_url=settings.BAN_API_URL,
+                max_concurrency=settings.BAN_API_MAX_CONCURRENCY,
+            )
+        )
+    else:
+        geocoding_backend = geocoding.BaseAdresseNationaleBackend(
+            base_url=settings.BAN_API_URL,
+            batch_size=settings.BAN_API_BATCH_SIZE,
+            min_batch_size=settings.BAN_API_MIN_BATCH_SIZE,
+            max_batch_size=settings.BAN_API_MAX_BATCH_SIZE,
+            max_response_bytes=settings.BAN_API_MAX_RESPONSE_BYTES,
+            target_latency=settings.BAN_API_TARGET_LATENCY,
+            max_workers=settings.BAN_API_MAX_WORKERS,
+        )
+
+    if settings.GEOCODING_CACHE_PATH is not None:
+        geocoding_backend = get_geocoding_cache(backend=geocoding_backend)
+
+    return geocoding_backend
+
+
+def get_geocoding_cache(
+    backend: geocoding.GeocodingBackend,
+) -> geocoding.CachedGeocodingBackend:
+    if settings.GEOCODING_CACHE_PATH is None:
+        raise click.UsageError("GEOCODING_CACHE_PATH not configured.")
+
+    return geocoding.CachedGeocodingBackend(
+        backend=backend,
+        path=Path(settings.GEOCODING_CACHE_PATH),
+        ttl=timedelta(days=settings.GEOCODING_CACHE_TTL_DAYS),
+        max_entries=settings.GEOCODING_CACHE_MAX_ENTRIES,
+    )
+
+
+def get_commune_index() -> Optional[communes.CommunePolygonIndex]:
+    if settings.COMMUNES_GEOJSON_PATH is None:
+        return None
+
+    return communes.CommunePolygonIndex.from_geojson(
+        path=Path(settings.COMMUNES_GEOJSON_PATH),
+        arrondissements_path=Path(settings.ARRONDISSEMENTS_GEOJSON_PATH)
+        if settings.ARRONDISSEMENTS_GEOJSON_PATH is not None
+        else None,
+    )
+
+
+def get_codes_postaux_table() -> Optional[codes_postaux.CodesPostauxTable]:
+    if settings.CODES_POSTAUX_TABLE_PATH is None:
+        return None
+
+    return codes_postaux.CodesPostauxTable.from_csv(
+        path=Path(settings.CODES_POSTAUX_TABLE_PATH)
+    )
+
+
+def get_siretisation_backend(
+    batch: bool = True, exact: bool = True, workers: int = 1
+) -> siretisation.SiretisationBackend:
+    if settings.SIRETISATION_BACKEND == "replay":
+        if settings.SIRETISATION_RECORDING_PATH is None:
+            raise click.UsageError("SIRETISATION_RECORDING_PATH not configured.")
+        return siretisation.ReplayingSiretisationBackend(
+            path=Path(settings.SIRETISATION_RECORDING_PATH)
+        )
+
+    if settings.SIRETISATION_BACKEND == "local":
+        if settings.SIRENE_INDEX_PATH is None:
+            raise click.UsageError("SIRENE_INDEX_PATH not configured.")
+        siretisation_backend = sirene_index.LocalSireneBackend(
+            index_dir=Path(settings.SIRENE_INDEX_PATH)
+        )
+    elif settings.SIRENE_DATABASE_URL is None:
+        raise click.UsageError("SIRENE_DATABASE_URL not configured.")
+    elif settings.SIRETISATION_BACKEND == "prefetch":
+        siretisation_backend = sirene_index.PrefetchedSireneBackend(
+            engine=slqa.create_engine(settings.SIRENE_DATABASE_URL),
+            cache_size=max(workers, 8),
+        )
+    else:
+        siretisation_backend = siretisation.PostgresSiretisationBackend(
+            url=settings.SIRENE_DATABASE_URL,
+            batch=batch,
+            exact=exact,
+            pool_size=workers,
+        )
+
+    if settings.SIRETISATION_RECORDING_PATH is not None:
+        siretisation_backend = siretisation.RecordingSiretisationBackend(
+            backend=siretisation_backend,
+            path=Path(settings.SIRETISATION_RECORDING_PATH),
+        )
+
+    return siretisation_backend
+
+
+def get_siretisation_cache() -> Optional[siretisation.SiretisationCache]:
+    if settings.SIRETISATION_CACHE_PATH is None:
+        return None
+
+    return siretisation.SiretisationCache(
+        path=Path(settings.SIRETISATION_CACHE_PATH),
+        ttl=timedelta(days=settings.SIRETISATION_CACHE_TTL_DAYS),
+        sirene_refreshed_at=datetime.fromisoformat(settings.SIRENE_REFRESHED_AT)
+        if settings.SIRENE_REFRESHED_AT is not None
+        else None,
+    )
+
+
 @click.group()
 @click.version_option()
 @click.option("--verbose", "-v", count=True)
@@ -39,18 +167,80 @@ def cli(verbose: int):
     is_flag=True,
     default=False,
 )
+@click.option(
+    "--fill-coordinates",
+    is_flag=True,
+    default=False,
+    help="Also fill missing coordinates while geocoding.",
+)
+@click.option(
+    "--commune-level",
+    is_flag=True,
+    default=False,
+    help="Geocode from the commune first, and from the address when ambiguous.",
+)
 def process(
     src: str,
     src_type: constants.SourceType,
     dry_run: bool,
+    fill_coordinates: bool,
+    commune_level: bool,
 ):
     """ETL a given source to data-inclusion."""
     services.full_processing(
         src=src,
         src_type=src_type,
-        geocoding_backend=geocoding.BaseAdresseNationaleBackend(
-            base_url=settings.BAN_API_URL
-        ),
+        geocoding_backend=get_geocoding_backend(),
+        fill_coordinates=fill_coordinates,
+        commune_index=get_commune_index(),
+        codes_postaux_table=get_codes_postaux_table(),
+        commune_level=commune_level,
+        dry_run=dry_run,
+    )
+
+
+@cli.command(name="process-many")
+@click.option(
+    "--source",
+    "sources",
+    type=(click.Choice(list(constants.SourceType)), click.STRING),
+    multiple=True,
+    required=True,
+    help="Source type and path, repeated for each source.",
+)
+@click.option(
+    "-n",
+    "--dry-run",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--fill-coordinates",
+    is_flag=True,
+    default=False,
+    help="Also fill missing coordinates while geocoding.",
+)
+@click.option(
+    "--commune-level",
+    is_flag=True,
+    default=False,
+    help="Geocode from the commune first, and from the address when ambiguous.",
+)
+def process_many(
+    sources: list[tuple[constants.SourceType, str]],
+    dry_run: bool,
+    fill_coordinates: bool,
+    commune_level: bool,
+):
+    """ETL several sources concurrently, sharing their geocoding requests."""
+    services.full_processing_many(
+        sources=[(src, src_type) for src_type, src in sources],
+        geocoding_backend=get_geocoding_backend(),
+        coalescing_window=settings.GEOCODING_COALESCING_WINDOW,
+        fill_coordinates=fill_coordinates,
+        commune_index=get_commune_index(),
+        codes_postaux_table=get_codes_postaux_table(),
+        commune_level=commune_level,
         dry_run=dry_run,
     )
 
@@ -93,28 +283,213 @@ def _reshape(
     "filepath",
     type=click.Path(exists=True, readable=True),
 )
+@click.option(
+    "--fill-coordinates",
+    is_flag=True,
+    default=False,
+    help="Also fill missing coordinates.",
+)
+@click.option(
+    "--commune-level",
+    is_flag=True,
+    default=False,
+    help="Geocode from the commune first, and from the address when ambiguous.",
+)
 def geocode(
     filepath: str,
+    fill_coordinates: bool,
+    commune_level: bool,
 ):
     "Geocode a data file that should be structured in the data.inclusion format."
     geocoding.geocode_normalized_data(
         path=Path(filepath),
-        geocoding_backend=geocoding.BaseAdresseNationaleBackend(
-            base_url=settings.BAN_API_URL
-        ),
+        geocoding_backend=get_geocoding_backend(),
+        fill_coordinates=fill_coordinates,
+        commune_index=get_commune_index(),
+        codes_postaux_table=get_codes_postaux_table(),
+        commune_level=commune_level,
+    )
+
+
+@cli.group(name="geocoding-cache")
+def geocoding_cache():
+    "Manage the geocoding cache configured with GEOCODING_CACHE_PATH."
+
+
+@geocoding_cache.command(name="export")
+@click.argument("filepath", type=click.Path(writable=True))
+def _export_geocoding_cache(filepath: str):
+    "Export the geocoding cache to a standalone file."
+    get_geocoding_cache(backend=geocoding.GeocodingBackend()).export(Path(filepath))
+
+
+@geocoding_cache.command(name="import")
+@click.argument("filepath", type=click.Path(exists=True, readable=True))
+def _import_geocoding_cache(filepath: str):
+    "Merge a previously exported file into the geocoding cache."
+    get_geocoding_cache(backend=geocoding.GeocodingBackend()).import_(Path(filepath))
+
+
+@cli.command(name="build-ban-index")
+@click.argument(
+    "filepath",
+    type=click.Path(exists=True, readable=True),
+)
+@click.argument(
+    "output_dir",
+    type=click.Path(file_okay=False, writable=True),
+)
+def build_ban_index(
+    filepath: str,
+    output_dir: str,
+):
+    """Build the index used by the `ban-local` geocoding backend from a BAN export."""
+    ban_index.build_ban_index(src=Path(filepath), output_dir=Path(output_dir))
+
+
+@cli.command(name="build-codes-postaux-table")
+@click.argument(
+    "filepath",
+    type=click.Path(exists=True, readable=True),
+)
+@click.argument(
+    "output_path",
+    type=click.Path(dir_okay=False, writable=True),
+)
+def build_codes_postaux_table(
+    filepath: str,
+    output_path: str,
+):
+    """Build the postcode table used to geocode offline from the La Poste file."""
+    codes_postaux.build_codes_postaux_table(
+        src=Path(filepath), output_path=Path(output_path)
+    )
+
+
+@cli.command(name="migrate-sirene-database")
+def migrate_sirene_database():
+    """Create the columns and indexes used by the siretisation, then check them."""
+    if settings.SIRENE_DATABASE_URL is None:
+        raise click.UsageError("SIRENE_DATABASE_URL not configured.")
+
+    sirene.migrate(slqa.create_engine(settings.SIRENE_DATABASE_URL))
+
+    engine = siretisation.create_engine(
+        settings.SIRENE_DATABASE_URL, stats=siretisation.StatementStats()
+    )
+    if not siretisation.check_search_plan(engine):
+        raise click.ClickException("The siretisation indexes are not used.")
+
+
+@cli.command(name="load-sirene-stock")
+@click.argument(
+    "filepath",
+    type=click.Path(exists=True, readable=True),
+)
+@click.option(
+    "--database-url",
+    default=None,
+    help="Postgres or sqlite url, SIRENE_DATABASE_URL by default.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=500_000,
+    show_default=True,
+)
+@click.option(
+    "--legal-units",
+    type=click.Path(exists=True, readable=True),
+    default=None,
+    help="StockUniteLegale file, whose legal names are used as fallback names.",
+)
+def load_sirene_stock(
+    filepath: str,
+    database_url: Optional[str],
+    batch_size: int,
+    legal_units: Optional[str],
+):
+    """Load the SIRENE establishments stock in the `sirene_establishment` table."""
+    database_url = database_url or settings.SIRENE_DATABASE_URL
+    if database_url is None:
+        raise click.UsageError("SIRENE_DATABASE_URL not configured.")
+
+    sirene_stock.load_sirene_stock(
+        src=Path(filepath),
+        engine=slqa.create_engine(database_url),
+        batch_size=batch_size,
+        legal_units_src=Path(legal_units) if legal_units is not None else None,
     )
 
 
+@cli.command(name="build-sirene-index")
+@click.argument(
+    "filepath",
+    type=click.Path(exists=True, readable=True),
+)
+@click.argument(
+    "output_dir",
+    type=click.Path(file_okay=False, writable=True),
+)
+def build_sirene_index(
+    filepath: str,
+    output_dir: str,
+):
+    """Build the index of the `local` siretisation backend from a SIRENE extract."""
+    sirene_index.build_sirene_index(src=Path(filepath), output_dir=Path(output_dir))
+
+
 @cli.command(name="siretize")
 @click.argument(
     "filepath",
     type=click.Path(exists=True, readable=True),
 )
+@click.option(
+    "--batch/--no-batch",
+    default=True,
+    show_default=True,
+    help="Match all the structures in a single query, or one query per structure.",
+)
+@click.option(
+    "--exact/--no-exact",
+    default=True,
+    show_default=True,
+    help="Match exactly on the name or parent siren, before the similarity search.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of departments processed concurrently.",
+)
+@click.option(
+    "--sample",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Only siretize a random sample of this size, without checkpoint.",
+)
 def siretize(
     filepath: str,
+    batch: bool,
+    exact: bool,
+    workers: int,
+    sample: Optional[int],
 ):
-    """Siretize a data file that should be structured in the data.inclusion format."""
-    siretisation.siretize_normalized_data(path=Path(filepath))
+    """Siretize a data file that should be structured in the data.inclusion format.
+
+    Only the structures without siret nor rna are processed. An interrupted run is
+    resumed from its checkpoint file.
+    """
+    siretisation.siretize_normalized_data(
+        path=Path(filepath),
+        siretisation_backend=get_siretisation_backend(
+            batch=batch, exact=exact, workers=workers
+        ),
+        workers=workers,
+        siretisation_cache=get_siretisation_cache(),
+        sample=sample,
+    )
 
 
 @cli.command(name="validate")
@@ -5,13 +5,66 @@ DI_API_URL = os.environ.get("DI_API_URL", None)
 DI_API_TOKEN = os.environ.get("DI_API_TOKEN", None)
 
 # Config for the geocoding backend
+# either `ban` (the BAN api), `ban-async` (the BAN api, from an event loop) or
+# `ban-local` (a local index of the BAN export)
+GEOCODING_BACKEND = os.environ.get("GEOCODING_BACKEND", "ban")
+BAN_INDEX_PATH = os.environ.get("BAN_INDEX_PATH", None)
 BAN_API_URL = os.environ.get("BAN_API_URL", "https://api-adresse.data.gouv.fr/")
+# the batch size is adjusted between its min and max values, starting from
+# BAN_API_BATCH_SIZE
+BAN_API_BATCH_SIZE = int(os.environ.get("BAN_API_BATCH_SIZE", 5000))
+BAN_API_MIN_BATCH_SIZE = int(os.environ.get("BAN_API_MIN_BATCH_SIZE", 500))
+BAN_API_MAX_BATCH_SIZE = int(os.environ.get("BAN_API_MAX_BATCH_SIZE", 20000))
+# the batch size shrinks after batches slower than BAN_API_TARGET_LATENCY seconds,
+# or whose responses near BAN_API_MAX_RESPONSE_BYTES
+BAN_API_TARGET_LATENCY = float(os.environ.get("BAN_API_TARGET_LATENCY", 30))
+BAN_API_MAX_RESPONSE_BYTES = int(
+    os.environ.get("BAN_API_MAX_RESPONSE_BYTES", 32 * 1024 * 1024)
+)
+BAN_API_MAX_WORKERS = int(os.environ.get("BAN_API_MAX_WORKERS", 4))
+BAN_API_MAX_CONCURRENCY = int(os.environ.get("BAN_API_MAX_CONCURRENCY", 50))
+
+# Config for the geocoding cache, disabled if no path is provided
+GEOCODING_CACHE_PATH = os.environ.get("GEOCODING_CACHE_PATH", None)
+GEOCODING_CACHE_TTL_DAYS = int(os.environ.get("GEOCODING_CACHE_TTL_DAYS", 90))
+GEOCODING_CACHE_MAX_ENTRIES = (
+    int(os.environ.get("GEOCODING_CACHE_MAX_ENTRIES", 0)) or None
+)
+
+# Delay to accumulate the geocoding requests of concurrently processed sources, in
+# seconds
+GEOCODING_COALESCING_WINDOW = float(os.environ.get("GEOCODING_COALESCING_WINDOW", 0.5))
+
+# Path to a geojson of the boundaries of the communes, to resolve the code_insee of
+# the structures from their coordinates, without network
+COMMUNES_GEOJSON_PATH = os.environ.get("COMMUNES_GEOJSON_PATH", None)
+# Path to a geojson of the boundaries of the municipal arrondissements, that replace
+# Paris, Lyon and Marseille, as in the BAN
+ARRONDISSEMENTS_GEOJSON_PATH = os.environ.get("ARRONDISSEMENTS_GEOJSON_PATH", None)
+# Path to a table built with `build-codes-postaux-table`, to resolve the code_insee of
+# the structures from their postcode when it is served by a single commune
+CODES_POSTAUX_TABLE_PATH = os.environ.get("CODES_POSTAUX_TABLE_PATH", None)
 
 # Config for the itou source type
 ITOU_API_TOKEN = os.environ.get("ITOU_API_TOKEN", None)
 
 # Config for siretization
+# either `postgres` (the SIRENE_DATABASE_URL database), `prefetch` (the establishments
+# of the SIRENE_DATABASE_URL database, matched locally by department), `local` (a
+# local index of a SIRENE extract) or `replay` (the results recorded in
+# SIRETISATION_RECORDING_PATH)
+SIRETISATION_BACKEND = os.environ.get("SIRETISATION_BACKEND", "postgres")
 SIRENE_DATABASE_URL = os.environ.get("SIRENE_DATABASE_URL", None)
+SIRENE_INDEX_PATH = os.environ.get("SIRENE_INDEX_PATH", None)
+# results of the other backends are recorded in this file, if provided
+SIRETISATION_RECORDING_PATH = os.environ.get("SIRETISATION_RECORDING_PATH", None)
+# date of the last import of the SIRENE data (ISO 8601), older siretisation results
+# are discarded from the cache
+SIRENE_REFRESHED_AT = os.environ.get("SIRENE_REFRESHED_AT", None)
+
+# Config for the siretisation cache, disabled if no path is provided
+SIRETISATION_CACHE_PATH = os.environ.get("SIRETISATION_CACHE_PATH", None)
+SIRETISATION_CACHE_TTL_DAYS = int(os.environ.get("SIRETISATION_CACHE_TTL_DAYS", 31))
 
 # Config for the soliguide source type
 SOLIGUIDE_API_TOKEN = os.environ.get("SOLIGUIDE_API_TOKEN", None)
@@ -0,0 +1,208 @@
+"""Offline geocoding from a local copy of the Base Adresse Nationale.
+
+The BAN csv export (https://adresse.data.gouv.fr/data/ban/adresses/latest/csv/) is
+aggregated once into an on-disk index of streets, sorted by postcode and then by
+commune. The index is stored as plain numpy arrays, that are memory-mapped when the
+backend is instantiated.
+"""
+
+import functools
+import logging
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from data_inclusion.tasks import geocoding, utils
+
+logger = logging.getLogger(__name__)
+
+BAN_EXPORT_KEY_COLUMNS = ["code_postal", "code_insee", "nom_commune", "nom_voie"]
+
+INDEX_ARRAYS = ["code_postal", "code_insee", "commune", "voie", "longitude", "latitude"]
+
+STOPWORDS = {"a", "au", "aux", "d", "de", "des", "du", "en", "l", "la", "le", "les"}
+
+
+def tokenize(s: str) -> frozenset[str]:
+    return frozenset(s.split()) - STOPWORDS
+
+
+def similarity(a: frozenset[str], b: frozenset[str]) -> float:
+    """Dice coefficient between 2 sets of tokens."""
+
+    if len(a) == 0 and len(b) == 0:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def build_ban_index(src: Path, output_dir: Path, chunksize: int = 1_000_000) -> Path:
+    """Aggregate a BAN csv export into a street level index."""
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # sum of the coordinates of the addresses, by street
+    streets_df = (
+        pd.concat(
+            chunk_df.assign(n=1).groupby(BAN_EXPORT_KEY_COLUMNS, as_index=False).sum()
+            for chunk_df in pd.read_csv(
+                src,
+                sep=";",
+                usecols=BAN_EXPORT_KEY_COLUMNS + ["lon", "lat"],
+                dtype={column: str for column in BAN_EXPORT_KEY_COLUMNS},
+                keep_default_na=False,
+                chunksize=chunksize,
+            )
+        )
+        .groupby(BAN_EXPORT_KEY_COLUMNS, as_index=False)
+        .sum()
+    )
+
+    # a commune level entry for each (code_postal, code_insee, nom_commune), used as
+    # fallback when no street matches
+    streets_df = pd.concat(
+        [
+            streets_df,
+            streets_df.assign(nom_voie="")
+            .groupby(BAN_EXPORT_KEY_COLUMNS, as_index=False)
+            .sum(),
+        ]
+    )
+
+    index_df = (
+        pd.DataFrame()
+        .assign(
+            code_postal=streets_df.code_postal,
+            code_insee=streets_df.code_insee,
+            commune=streets_df.nom_commune.map(utils.normalize_address),
+            voie=streets_df.nom_voie.map(utils.normalize_address),
+            longitude=streets_df.lon / streets_df.n,
+            latitude=streets_df.lat / streets_df.n,
+        )
+        .drop_duplicates(subset=["code_postal", "code_insee", "commune", "voie"])
+        .sort_values(by=["code_postal", "code_insee", "commune", "voie"])
+    )
+
+    for name in ["code_postal", "code_insee", "commune", "voie"]:
+        np.save(output_dir / f"{name}.npy", index_df[name].to_numpy(dtype=str))
+    for name in ["longitude", "latitude"]:
+        np.save(output_dir / f"{name}.npy", index_df[name].to_numpy(dtype=np.float32))
+
+    # secondary ordering, to search by commune when the postcode is missing
+    commune_order = np.argsort(index_df.commune.to_numpy(dtype=str), kind="stable")
+    np.save(output_dir / "commune_order.npy", commune_order)
+    np.save(
+        output_dir / "commune_sorted.npy",
+        index_df.commune.to_numpy(dtype=str)[commune_order],
+    )
+
+    logger.info("%d entries indexed in %s", len(index_df), output_dir)
+
+    return output_dir
+
+
+class LocalBaseAdresseNationaleBackend(geocoding.GeocodingBackend):
+    """Geocode against an index built by `build_ban_index`, without network.
+
+    The score mimics the BAN `result_score` : it combines the similarity of the
+    street and of the commune, and is capped for commune level results.
+    """
+
+    def __init__(self, index_dir: Path, cache_size: int = 1024):
+        self.arrays = {
+            name: np.load(index_dir / f"{name}.npy", mmap_mode="r")
+            for name in INDEX_ARRAYS + ["commune_order", "commune_sorted"]
+        }
+        self.candidates_by_postcode = functools.lru_cache(maxsize=cache_size)(
+            self._candidates_by_postcode
+        )
+        self.candidates_by_commune = functools.lru_cache(maxsize=cache_size)(
+            self._candidates_by_commune
+        )
+
+    def _candidates(self, positions: np.ndarray) -> list[tuple]:
+        return [
+            (
+                i,
+                str(self.arrays["code_insee"][i]),
+                tokenize(str(self.arrays["commune"][i])),
+                tokenize(str(self.arrays["voie"][i])),
+            )
+            for i in positions
+        ]
+
+    def _candidates_by_postcode(self, code_postal: str) -> list[tuple]:
+        lo = np.searchsorted(self.arrays["code_postal"], code_postal, side="left")
+        hi = np.searchsorted(self.arrays["code_postal"], code_postal, side="right")
+        return self._candidates(np.arange(lo, hi))
+
+    def _candidates_by_commune(self, commune: str) -> list[tuple]:
+        lo = np.searchsorted(self.arrays["commune_sorted"], commune, side="left")
+        hi = np.searchsorted(self.arrays["commune_sorted"], commune, side="right")
+        return self._candidates(np.sort(self.arrays["commune_order"][lo:hi]))
+
+    def geocode(
+        self, geocoding_input: geocoding.GeocodingInput
+    ) -> Optional[geocoding.GeocodingOutput]:
+        code_postal = utils.normalize_str(geocoding_input.code_postal)
+        commune = utils.normalize_address(geocoding_input.commune)
+
+        if code_postal != "":
+            candidates = self.candidates_by_postcode(code_postal)
+        elif commune != "":
+            candidates = self.candidates_by_commune(commune)
+        else:
+            return None
+
+        # house numbers and their suffixes are not indexed
+        voie_tokens = frozenset(
+            token
+            for token in tokenize(utils.normalize_address(geocoding_input.adresse))
+            if not token.isdigit() and token not in {"bis", "ter", "b", "t"}
+        )
+        commune_tokens = tokenize(commune)
+
+        best_score, best_position, best_code_insee = 0.0, None, None
+        for (
+            position,
+            code_insee,
+            candidate_commune_tokens,
+            candidate_voie_tokens,
+        ) in candidates:
+            commune_score = (
+                similarity(commune_tokens, candidate_commune_tokens)
+                if len(commune_tokens) > 0
+                else 0.5
+            )
+            if len(candidate_voie_tokens) == 0:
+                # commune level queries are fully answered by the commune entries
+                score = commune_score if len(voie_tokens) == 0 else 0.5 * commune_score
+            else:
+                score = (
+                    0.7 * similarity(voie_tokens, candidate_voie_tokens)
+                    + 0.3 * commune_score
+                )
+
+            if score > best_score:
+                best_score, best_position, best_code_insee = score, position, code_insee
+
+        if best_code_insee is None:
+            return None
+
+        return geocoding.GeocodingOutput(
+            id=geocoding_input.id,
+            code_insee=best_code_insee,
+            score=round(best_score, 4),
+            latitude=round(float(self.arrays["latitude"][best_position]), 5),
+            longitude=round(float(self.arrays["longitude"][best_position]), 5),
+        )
+
+    def geocode_batch(
+        self, geocoding_input_list: list[geocoding.GeocodingInput]
+    ) -> list[geocoding.GeocodingOutput]:
+        return [
+            geocoding_output
+            for geocoding_output in map(self.geocode, geocoding_input_list)
+            if geocoding_output is not None
+        ]
@@ -0,0 +1,79 @@
+"""Offline resolution of the code insee of the communes, from their postcode.
+
+The table is built from the official correspondence between postcodes and insee
+codes published by La Poste
+(https://datanova.laposte.fr/datasets/laposte-hexasmal), and stored as a compact
+csv of (code_postal, code_insee, commune) rows.
+"""
+
+import logging
+from pathlib import Path
+
+import pandas as pd
+
+from data_inclusion.tasks import utils
+
+logger = logging.getLogger(__name__)
+
+TABLE_COLUMNS = ["code_postal", "code_insee", "commune"]
+
+
+def build_codes_postaux_table(src: Path, output_path: Path) -> Path:
+    """Extract the postcode/insee pairs from the La Poste correspondence file."""
+
+    # the header of the file changes between releases, e.g. `Code_commune_INSEE`,
+    # `#Code_commune_INSEE`, `Nom_commune` or `Nom_de_la_commune`
+    df = pd.read_csv(src, sep=";", dtype=str, keep_default_na=False, encoding="utf-8")
+    columns = {column.lower().lstrip("#"): column for column in df.columns}
+    code_insee_column = next(c for k, c in columns.items() if "insee" in k)
+    code_postal_column = next(c for k, c in columns.items() if "postal" in k)
+    commune_column = next(c for k, c in columns.items() if k.startswith("nom_"))
+
+    table_df = (
+        pd.DataFrame()
+        .assign(
+            code_postal=df[code_postal_column].str.strip().str.zfill(5),
+            code_insee=df[code_insee_column].str.strip().str.zfill(5),
+            commune=df[commune_column].map(utils.normalize_address),
+        )
+        .drop_duplicates()
+        .sort_values(by=TABLE_COLUMNS)
+    )
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    table_df.to_csv(output_path, index=False)
+
+    logger.info(
+        "%d postcodes, %d unambiguous, saved in %s",
+        table_df.code_postal.nunique(),
+        (table_df.groupby("code_postal").code_insee.nunique() == 1).sum(),
+        output_path,
+    )
+
+    return output_path
+
+
+class CodesPostauxTable:
+    """Map the postcodes served by a single commune to its code insee."""
+
+    def __init__(self, table_df: pd.DataFrame):
+        self.table_df = table_df
+
+        code_insee_by_code_postal = table_df.drop_duplicates(
+            subset=["code_postal", "code_insee"]
+        ).set_index("code_postal")["code_insee"]
+        self.unambiguous = code_insee_by_code_postal[
+            ~code_insee_by_code_postal.index.duplicated(keep=False)
+        ]
+
+    @classmethod
+    def from_csv(cls, path: Path) -> "CodesPostauxTable":
+        table_df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        logger.info("%d postcodes loaded from %s", table_df.code_postal.nunique(), path)
+        return cls(table_df=table_df[TABLE_COLUMNS])
+
+    def lookup(self, code_postal: pd.Series) -> pd.Series:
+        """Code insee for each unambiguous postcode, or None."""
+
+        code_insee = code_postal.map(utils.normalize_str).map(self.unambiguous)
+        return code_insee.astype(object).where(code_insee.notna(), None)
@@ -0,0 +1,197 @@
+"""Offline reverse geocoding of communes, from their boundaries.
+
+The boundaries are loaded from a geojson file of the communes, such as the ones
+published by etalab (https://etalab-datasets.geo.data.gouv.fr/contours-administratifs/)
+where each feature has the code insee of the commune in its `code` property.
+
+Paris, Lyon and Marseille are resolved to their municipal arrondissements, like the
+BAN and the postcode table do. Their boundaries are read from a geojson of the
+arrondissements (the `arrondissements-municipaux` layer of etalab), that replace the
+single polygon of these three communes. Without it, these communes are not resolved.
+"""
+
+import collections
+import json
+import logging
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# communes divided in municipal arrondissements, by code insee
+COMMUNES_WITH_ARRONDISSEMENTS = {
+    "75056": "Paris",
+    "69123": "Lyon",
+    "13055": "Marseille",
+}
+
+
+class CommunePolygonIndex:
+    """Find the commune containing given coordinates.
+
+    The polygons are indexed on a regular grid of `cell_size` degrees : each cell
+    references the communes whose bounding box overlaps it. Points are then tested
+    against the edges of the candidate polygons, with a vectorized even-odd rule.
+    """
+
+    def __init__(
+        self,
+        codes: list[str],
+        rings_list: list[list[np.ndarray]],
+        cell_size: float = 0.1,
+    ):
+        self.codes = np.array(codes, dtype=object)
+        self.cell_size = cell_size
+
+        # edges of all the rings of each commune, as (x1, y1, x2, y2) rows
+        self.edges = [
+            np.concatenate([np.hstack([ring[:-1], ring[1:]]) for ring in rings])
+            for rings in rings_list
+        ]
+        self.bboxes = np.array(
+            [
+                [
+                    edges[:, [0, 2]].min(),
+                    edges[:, [1, 3]].min(),
+                    edges[:, [0, 2]].max(),
+                    edges[:, [1, 3]].max(),
+                ]
+                for edges in self.edges
+            ]
+        ).reshape(-1, 4)
+
+        self.candidates_by_cell = collections.defaultdict(list)
+        cell_bboxes = np.floor(self.bboxes / cell_size).astype(int)
+        for i, (min_x, min_y, max_x, max_y) in enumerate(cell_bboxes):
+            for cell_x in range(min_x, max_x + 1):
+                for cell_y in range(min_y, max_y + 1):
+                    self.candidates_by_cell[(cell_x, cell_y)].append(i)
+
+    @classmethod
+    def from_geojson(
+        cls,
+        path: Path,
+        code_property: str = "code",
+        arrondissements_path: Optional[Path] = None,
+        **kwargs,
+    ) -> "CommunePolygonIndex":
+        codes, rings_list = [], []
+        for code, rings in read_geojson(path, code_property=code_property):
+            # superseded by their arrondissements
+            if code in COMMUNES_WITH_ARRONDISSEMENTS:
+                continue
+            codes.append(code)
+            rings_list.append(rings)
+
+        logger.info("%d communes loaded from %s", len(codes), path)
+
+        if arrondissements_path is not None:
+            communes_count = len(codes)
+            for code, rings in read_geojson(
+                arrondissements_path, code_property=code_property
+            ):
+                codes.append(code)
+                rings_list.append(rings)
+            logger.info(
+                "%d arrondissements loaded from %s",
+                len(codes) - communes_count,
+                arrondissements_path,
+            )
+        else:
+            logger.warning(
+                "No arrondissements : %s are not resolved",
+                ", ".join(COMMUNES_WITH_ARRONDISSEMENTS.values()),
+            )
+
+        return cls(codes=codes, rings_list=rings_list, **kwargs)
+
+    def lookup(self, longitude: np.ndarray, latitude: np.ndarray) -> np.ndarray:
+        """Code insee of the commune containing each point, or None."""
+
+        x = np.asarray(longitude, dtype=float)
+        y = np.asarray(latitude, dtype=float)
+        result = np.full(len(x), None, dtype=object)
+        resolved = np.zeros(len(x), dtype=bool)
+
+        valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        points_cells = np.floor(np.stack([x[valid], y[valid]], axis=1) / self.cell_size)
+        cells, inverse = np.unique(
+            points_cells.astype(int), axis=0, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+
+        # group the points by cell
+        order = np.argsort(inverse, kind="stable")
+        splits = np.cumsum(np.bincount(inverse, minlength=len(cells)))[:-1]
+
+        for (cell_x, cell_y), positions in zip(cells, np.split(valid[order], splits)):
+            for i in self.candidates_by_cell.get((cell_x, cell_y), []):
+                positions = positions[~resolved[positions]]
+                if len(positions) == 0:
+                    break
+
+                min_x, min_y, max_x, max_y = self.bboxes[i]
+                px, py = x[positions], y[positions]
+                in_bbox = (px >= min_x) & (px <= max_x) & (py >= min_y) & (py <= max_y)
+                if not in_bbox.any():
+                    continue
+
+                inside = positions[in_bbox][
+                    contains(self.edges[i], px[in_bbox], py[in_bbox])
+                ]
+                result[inside] = self.codes[i]
+                resolved[inside] = True
+
+        return result
+
+
+def read_geojson(path: Path, code_property: str) -> Iterator[tuple[str, list]]:
+    """Code and rings of the (multi)polygon features of a geojson file."""
+
+    with path.open() as f:
+        feature_collection = json.load(f)
+
+    for feature in feature_collection["features"]:
+        geometry = feature["geometry"]
+        if geometry is None:
+            continue
+
+        if geometry["type"] == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+
+        yield feature["properties"][code_property], [
+            np.array(ring, dtype=float)[:, :2]
+            for polygon in polygons
+            for ring in polygon
+        ]
+
+
+def contains(
+    edges: np.ndarray,
+    x: np.ndarray,
+    y: np.ndarray,
+    max_chunk_size: int = 1_000_000,
+) -> np.ndarray:
+    """Even-odd rule test of points against the edges of a (multi)polygon."""
+
+    x1, y1, x2, y2 = (edges[:, i] for i in range(4))
+    result = np.zeros(len(x), dtype=bool)
+
+    # bound the size of the intermediate (points x edges) arrays
+    chunk_size = max(1, max_chunk_size // len(edges))
+    for start in range(0, len(x), chunk_size):
+        px = x[start : start + chunk_size, np.newaxis]
+        py = y[start : start + chunk_size, np.newaxis]
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = straddles & (px < crossing_x)
+        result[start : start + chunk_size] = crossings.sum(axis=1) % 2 == 1
+
+    return result
@@ -1,14 +1,25 @@
+import asyncio
+import concurrent.futures
 import csv
 import dataclasses
+import functools
 import io
+import itertools
 import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
 from pathlib import Path
+from typing import Iterable, Iterator, Optional
 
+import httpx
 import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 
-from data_inclusion.tasks import utils
+from data_inclusion.tasks import codes_postaux, communes, utils
 
 logger = logging.getLogger(__name__)
 
@@ -21,123 +32,1106 @@ class GeocodingInput:
     commune: str
 
 
+GEOCODING_INPUT_FIELDNAMES = [f.name for f in dataclasses.fields(GeocodingInput)]
+
+# minimum score to fill the code_insee
+MIN_SCORE = 0.4
+# minimum score to trust a commune level result, without the street
+MIN_COMMUNE_SCORE = 0.7
+# minimum score to fill the coordinates
+MIN_COORDINATES_SCORE = 0.6
+
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+BAN_SEARCH_CSV_PARAMS = {
+    "columns": ["adresse", "code_postal", "commune"],
+    "postcode": "code_postal",
+    "result_columns": ["result_citycode", "result_score", "latitude", "longitude"],
+}
+
+REVERSE_GEOCODING_INPUT_FIELDNAMES = ["id", "latitude", "longitude"]
+
+BAN_REVERSE_CSV_PARAMS = {
+    "result_columns": ["result_citycode", "result_score"],
+}
+
+
 @dataclasses.dataclass(frozen=True)
 class GeocodingOutput:
     id: str
     code_insee: str
     score: float
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+
+GEOCODING_OUTPUT_FIELDNAMES = [f.name for f in dataclasses.fields(GeocodingOutput)]
+
+
+@dataclasses.dataclass
+class GeocodingStats:
+    rows: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    response_bytes: int = 0
+    elapsed_seconds: float = 0.0
+    batch_sizes: list[int] = dataclasses.field(default_factory=list)
+    lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    @property
+    def rows_per_second(self) -> float:
+        if self.elapsed_seconds == 0:
+            return 0.0
+        return self.rows / self.elapsed_seconds
+
+    def record(self, batch_size: int, response_bytes: int, failed: bool):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes.append(batch_size)
+            self.response_bytes += response_bytes
+            if failed:
+                self.failed_batches += 1
+            else:
+                self.rows += batch_size
+
+    def log(self, logger: logging.Logger = logger):
+        logger.info("Statistiques du géocodage:")
+        logger.info(f"\t{self.rows} lignes géocodées en {self.elapsed_seconds:.1f}s")
+        logger.info(f"\t{self.rows_per_second:.1f} lignes/s")
+        logger.info(f"\t{self.batches} lots, dont {self.failed_batches} en échec")
+        if len(self.batch_sizes) > 0:
+            logger.info(
+                f"\ttaille des lots: min={min(self.batch_sizes)} "
+                f"médiane={int(np.median(self.batch_sizes))} "
+                f"max={max(self.batch_sizes)}"
+            )
+
+
+class AdaptiveBatchSize:
+    """Batch size tuned with an additive increase/multiplicative decrease rule.
+
+    The size grows by `increment` after each batch that succeeds within
+    `target_latency` seconds, and is halved after a failure or a slow batch. It stays
+    within `[min_size, max_size]`.
+
+    With `max_response_bytes`, the size is also halved after a response larger than
+    this budget, and otherwise capped to the number of rows whose responses would fit
+    in it, at the size of the rows of the last response.
+
+    Iterating over it yields the current size, forever.
+    """
+
+    def __init__(
+        self,
+        initial_size: int,
+        min_size: int,
+        max_size: int,
+        target_latency: float = 30.0,
+        max_response_bytes: Optional[int] = None,
+        increment: Optional[int] = None,
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min(max(initial_size, min_size), max_size)
+        self.target_latency = target_latency
+        self.max_response_bytes = max_response_bytes
+        self.increment = increment or max(1, max_size // 20)
+        self.lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[int]:
+        while True:
+            yield self.size
+
+    def record(
+        self,
+        latency: float,
+        failed: bool,
+        batch_size: int = 0,
+        response_bytes: int = 0,
+    ):
+        with self.lock:
+            if (
+                failed
+                or latency > self.target_latency
+                or (
+                    self.max_response_bytes is not None
+                    and response_bytes > self.max_response_bytes
+                )
+            ):
+                self.size = max(self.min_size, self.size // 2)
+                return
+
+            size = self.size + self.increment
+            if (
+                self.max_response_bytes is not None
+                and batch_size > 0
+                and response_bytes > 0
+            ):
+                size = min(size, self.max_response_bytes * batch_size // response_bytes)
+            self.size = min(self.max_size, max(self.min_size, size))
 
 
 class GeocodingBackend:
+    @property
+    def stats(self) -> Optional[GeocodingStats]:
+        return None
+
     def geocode_batch(
         self, geocoding_input_list: list[GeocodingInput]
     ) -> list[GeocodingOutput]:
         raise NotImplementedError
 
+    def geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Columnar counterpart of `geocode_batch`.
+
+        `df` has the fields of `GeocodingInput` as columns, and the returned dataframe
+        has the fields of `GeocodingOutput`. Backends should override it to avoid the
+        conversion to and from dataclasses.
+        """
+
+        return to_geocoding_output_dataframe(
+            self.geocode_batch(to_geocoding_input_list(df))
+        )
+
+    def reverse_geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Find the commune of the inputs, from their coordinates.
+
+        `df` has the `id`, `latitude` and `longitude` columns, and the returned
+        dataframe has the fields of `GeocodingOutput`.
+        """
+
+        raise NotImplementedError
+
 
 class BaseAdresseNationaleBackend(GeocodingBackend):
-    def __init__(self, base_url: str):
+    """Geocode through the csv endpoint of the BAN api.
+
+    The input is split in batches bounded both in rows and in bytes, that are sent
+    concurrently from a pooled session. A failing batch only loses its own rows.
+
+    The number of rows per batch is adjusted between `min_batch_size` and
+    `max_batch_size`, according to the latency, failures and response sizes of
+    previous batches.
+
+    Each batch is streamed to the api as it is encoded, and its results are parsed
+    line by line as they are received : no full copy of the payloads is kept.
+
+    Inputs with coordinates can be reverse geocoded in the same way, through the
+    reverse csv endpoint.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        batch_size: int = 5000,
+        min_batch_size: Optional[int] = None,
+        max_batch_size: Optional[int] = None,
+        max_batch_bytes: int = 8 * 1024 * 1024,
+        max_response_bytes: int = 32 * 1024 * 1024,
+        target_latency: float = 30.0,
+        max_workers: int = 4,
+        max_attempts: int = 3,
+    ):
         self.base_url = base_url.strip("/")
+        self.adaptive_batch_size = AdaptiveBatchSize(
+            initial_size=batch_size,
+            min_size=min_batch_size or batch_size,
+            max_size=max_batch_size or batch_size,
+            target_latency=target_latency,
+            max_response_bytes=max_response_bytes,
+        )
+        self.max_batch_bytes = max_batch_bytes
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self._stats = GeocodingStats()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def geocode_batch(
         self, geocoding_input_list: list[GeocodingInput]
     ) -> list[GeocodingOutput]:
-        with io.BytesIO() as buf:
-            wrapper = io.TextIOWrapper(buf, newline="", write_through=True)
+        return to_geocoding_output_list(
+            self.geocode_dataframe(to_geocoding_input_dataframe(geocoding_input_list))
+        )
 
-            writer = csv.DictWriter(
-                wrapper, fieldnames=["id", "adresse", "code_postal", "commune"]
-            )
-            writer.writeheader()
-            writer.writerows(
-                (
-                    dataclasses.asdict(geocoding_input)
-                    for geocoding_input in geocoding_input_list
-                )
+    @property
+    def stats(self) -> GeocodingStats:
+        return self._stats
+
+    def geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        started_at = time.perf_counter()
+        try:
+            return concat_geocoding_outputs(self.iter_geocode_dataframe(df))
+        finally:
+            self._stats.elapsed_seconds += time.perf_counter() - started_at
+
+    def reverse_geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        started_at = time.perf_counter()
+        try:
+            return concat_geocoding_outputs(
+                self.iter_geocode_dataframe(df, reverse=True)
             )
+        finally:
+            self._stats.elapsed_seconds += time.perf_counter() - started_at
+
+    def iter_geocode_dataframe(
+        self, df: pd.DataFrame, reverse: bool = False
+    ) -> Iterator[pd.DataFrame]:
+        """Geocode the inputs, yielding the results batch by batch, in input order."""
+
+        # batches are cut lazily, so that their size follows the latest measures
+        return utils.ordered_map(
+            functools.partial(self._geocode_csv, reverse=reverse),
+            iter_csv_batches(
+                df,
+                batch_sizes=self.adaptive_batch_size,
+                max_batch_bytes=self.max_batch_bytes,
+                fieldnames=(
+                    REVERSE_GEOCODING_INPUT_FIELDNAMES
+                    if reverse
+                    else GEOCODING_INPUT_FIELDNAMES
+                ),
+            ),
+            max_workers=self.max_workers,
+        )
 
+    def _geocode_csv(self, df: pd.DataFrame, reverse: bool = False) -> pd.DataFrame:
+        if reverse:
+            url = self.base_url + "/reverse/csv/"
+            params = BAN_REVERSE_CSV_PARAMS
+        else:
+            url = self.base_url + "/search/csv/"
+            params = BAN_SEARCH_CSV_PARAMS
+        boundary = uuid.uuid4().hex
+
+        for attempt in range(1, self.max_attempts + 1):
+            started_at = time.perf_counter()
             try:
-                response = requests.post(
-                    self.base_url + "/search/csv/",
-                    files={"data": ("data.csv", buf.getvalue(), "text/csv")},
-                    data={
-                        "columns": ["adresse", "code_postal", "commune"],
-                        "postcode": "code_postal",
-                        "result_columns": ["result_citycode", "result_score"],
+                # the body is a generator : it is sent with chunked transfer encoding
+                with self.session.post(
+                    url,
+                    data=iter_multipart(
+                        boundary, params, iter_csv_lines(df, fieldnames=list(df))
+                    ),
+                    headers={
+                        "Content-Type": f"multipart/form-data; boundary={boundary}"
                     },
+                    stream=True,
+                ) as response:
+                    response.raise_for_status()
+                    response.encoding = "utf-8"
+                    results_df = parse_csv_results(
+                        response.iter_lines(decode_unicode=True)
+                    )
+                    response_bytes = response.raw.tell()
+            except (requests.RequestException, csv.Error, ValueError) as e:
+                # a malformed response is a failed batch, like a failed request
+                self.adaptive_batch_size.record(
+                    latency=time.perf_counter() - started_at, failed=True
+                )
+                self._stats.record(batch_size=len(df), response_bytes=0, failed=True)
+
+                response = getattr(e, "response", None)
+                status_code = response.status_code if response is not None else None
+                if attempt == self.max_attempts or (
+                    status_code is not None and status_code not in RETRY_STATUS_CODES
+                ):
+                    logger.info("Error while fetching `%s`: %s", url, e)
+                    return to_geocoding_output_dataframe([])
+                time.sleep(2 ** (attempt - 1))
+            else:
+                self.adaptive_batch_size.record(
+                    latency=time.perf_counter() - started_at,
+                    failed=False,
+                    batch_size=len(df),
+                    response_bytes=response_bytes,
+                )
+                self._stats.record(
+                    batch_size=len(df), response_bytes=response_bytes, failed=False
+                )
+                return results_df
+
+
+class AsyncGeocodingBackend:
+    @property
+    def stats(self) -> Optional[GeocodingStats]:
+        return None
+
+    async def geocode_batch(
+        self, geocoding_input_list: list[GeocodingInput]
+    ) -> list[GeocodingOutput]:
+        raise NotImplementedError
+
+    async def geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        return to_geocoding_output_dataframe(
+            await self.geocode_batch(to_geocoding_input_list(df))
+        )
+
+
+class AsyncBaseAdresseNationaleBackend(AsyncGeocodingBackend):
+    """Geocode through the csv endpoint of the BAN api, from a single event loop.
+
+    Like `BaseAdresseNationaleBackend`, the input is split in bounded batches. At most
+    `max_concurrency` batches are in flight at a time, without a thread per request.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        batch_size: int = 1000,
+        max_batch_bytes: int = 8 * 1024 * 1024,
+        max_concurrency: int = 50,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_url = base_url.strip("/")
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_concurrency = max_concurrency
+        self.transport = transport or httpx.AsyncHTTPTransport(retries=3)
+
+    async def geocode_batch(
+        self, geocoding_input_list: list[GeocodingInput]
+    ) -> list[GeocodingOutput]:
+        return to_geocoding_output_list(
+            await self.geocode_dataframe(
+                to_geocoding_input_dataframe(geocoding_input_list)
+            )
+        )
+
+    async def geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with httpx.AsyncClient(
+            transport=self.transport,
+            limits=httpx.Limits(max_connections=self.max_concurrency),
+            timeout=httpx.Timeout(10, read=None),
+        ) as client:
+
+            async def geocode_csv(batch_df: pd.DataFrame) -> pd.DataFrame:
+                async with semaphore:
+                    return await self._geocode_csv(client, batch_df)
+
+            geocoding_output_df_list = await asyncio.gather(
+                *(
+                    geocode_csv(batch_df)
+                    for batch_df in iter_csv_batches(
+                        df,
+                        batch_sizes=itertools.repeat(self.batch_size),
+                        max_batch_bytes=self.max_batch_bytes,
+                    )
                 )
-            except requests.RequestException as e:
-                logger.info("Error while fetching `%s`: %s", e.request.url, e)
-                return []
-
-        with io.StringIO() as f:
-            f.write(response.text)
-            f.seek(0)
-
-            reader = csv.DictReader(f)
-            geocoding_results = [
-                GeocodingOutput(
-                    id=row["id"],
-                    code_insee=row["result_citycode"],
-                    score=float(row["result_score"]),
+            )
+
+        return concat_geocoding_outputs(geocoding_output_df_list)
+
+    async def _geocode_csv(
+        self, client: httpx.AsyncClient, df: pd.DataFrame
+    ) -> pd.DataFrame:
+        url = self.base_url + "/search/csv/"
+        boundary = uuid.uuid4().hex
+
+        async def content():
+            for chunk in iter_multipart(
+                boundary, BAN_SEARCH_CSV_PARAMS, iter_csv_lines(df)
+            ):
+                yield chunk
+
+        try:
+            async with client.stream(
+                "POST",
+                url,
+                content=content(),
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            ) as response:
+                response.raise_for_status()
+                # results are parsed as they are received
+                parser = CsvResultsParser()
+                async for line in response.aiter_lines():
+                    parser.feed(line)
+                return parser.to_dataframe()
+        except (httpx.HTTPError, csv.Error, ValueError) as e:
+            # a malformed response only fails its own batch
+            logger.info("Error while fetching `%s`: %s", url, e)
+            return to_geocoding_output_dataframe([])
+
+
+class SyncGeocodingBackend(GeocodingBackend):
+    """Expose an `AsyncGeocodingBackend` as a regular `GeocodingBackend`."""
+
+    def __init__(self, backend: AsyncGeocodingBackend):
+        self.backend = backend
+
+    @property
+    def stats(self) -> Optional[GeocodingStats]:
+        return self.backend.stats
+
+    def geocode_batch(
+        self, geocoding_input_list: list[GeocodingInput]
+    ) -> list[GeocodingOutput]:
+        return asyncio.run(self.backend.geocode_batch(geocoding_input_list))
+
+    def geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        return asyncio.run(self.backend.geocode_dataframe(df))
+
+
+class CachedGeocodingBackend(GeocodingBackend):
+    """Persistent cache in front of another geocoding backend.
+
+    Results are stored in a sqlite database, keyed on the `address_keys` of the
+    inputs, so that only cache misses are sent to the wrapped backend. Inputs without
+    any result are not cached : the wrapped backend does not distinguish them from
+    failed requests.
+
+    Entries older than `ttl` are discarded. When `max_entries` is set, the least
+    recently used entries are evicted beyond that size.
+    """
+
+    SCHEMA_VERSION = 2
+
+    # values cached for each key
+    COLUMNS = {
+        "code_insee": "TEXT NOT NULL",
+        "score": "REAL NOT NULL",
+        "latitude": "REAL",
+        "longitude": "REAL",
+    }
+
+    def __init__(
+        self,
+        backend: GeocodingBackend,
+        path: Path,
+        ttl: Optional[timedelta] = None,
+        max_entries: Optional[int] = None,
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.cache = utils.SqliteCache(
+            path,
+            table="geocoding_cache",
+            columns=self.COLUMNS,
+            schema_version=self.SCHEMA_VERSION,
+            max_entries=max_entries,
+        )
+
+    @property
+    def stats(self) -> Optional[GeocodingStats]:
+        return self.backend.stats
+
+    def geocode_batch(
+        self, geocoding_input_list: list[GeocodingInput]
+    ) -> list[GeocodingOutput]:
+        return to_geocoding_output_list(
+            self.geocode_dataframe(to_geocoding_input_dataframe(geocoding_input_list))
+        )
+
+    def geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        if len(df) == 0:
+            return to_geocoding_output_dataframe([])
+
+        keys = address_keys(df)
+
+        self.evict()
+        cached_df = self.cache.get_many(keys.unique())
+
+        # send a single input per missing key
+        is_missing = ~keys.isin(cached_df.index) & ~keys.duplicated()
+        missing_keys = keys[is_missing].to_numpy()
+
+        logger.info(
+            "Geocoding cache: %d hits, %d misses",
+            len(cached_df),
+            len(missing_keys),
+        )
+
+        if len(missing_keys) > 0:
+            # ids are not guaranteed to be unique : index the inputs by position
+            fetched_df = self.backend.geocode_dataframe(
+                df[is_missing.to_numpy()].assign(
+                    id=np.arange(len(missing_keys)).astype(str)
                 )
-                for row in reader
-                if row.get("result_citycode", "") != ""
-            ]
+            )
+            fetched_df = fetched_df.set_index(
+                pd.Index(missing_keys[fetched_df.id.astype(int).to_numpy()])
+            )[list(self.COLUMNS)]
+            self.cache.set_many(fetched_df)
+            cached_df = pd.concat([cached_df, fetched_df])
+
+        return (
+            cached_df.reindex(keys)
+            .assign(id=df.id.to_numpy())
+            .dropna(subset=["code_insee"])
+            .reset_index(drop=True)[GEOCODING_OUTPUT_FIELDNAMES]
+        )
+
+    def reverse_geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        # the cache is keyed on addresses : coordinates are not cached
+        return self.backend.reverse_geocode_dataframe(df)
+
+    def evict(self):
+        if self.ttl is None:
+            return
+
+        self.cache.evict(created_before=time.time() - self.ttl.total_seconds())
+
+    def export(self, path: Path):
+        """Copy the cache content to a standalone sqlite file."""
+
+        self.cache.export(path)
 
-        return geocoding_results
+    def import_(self, path: Path):
+        """Merge the content of an exported cache file, keeping the newest entries."""
+
+        self.cache.import_(path)
+        self.evict()
+
+
+class CoalescingGeocodingBackend(GeocodingBackend):
+    """Share the geocoding requests of concurrent callers, e.g. one per source.
+
+    The inputs submitted from several threads within `window` seconds are merged in
+    a single request to the wrapped backend, where each distinct normalized address
+    is geocoded once. Addresses already being geocoded for another caller are not
+    sent again : the caller waits for the pending request instead.
+    """
+
+    def __init__(self, backend: GeocodingBackend, window: float = 0.5):
+        self.backend = backend
+        self.window = window
+        self.lock = threading.Lock()
+        # inputs waiting for the next request, by key
+        self.pending_inputs: dict[str, dict] = {}
+        self.pending_future: Optional[concurrent.futures.Future] = None
+        # requests in progress, by key
+        self.futures_by_key: dict[str, concurrent.futures.Future] = {}
+
+    @property
+    def stats(self) -> Optional[GeocodingStats]:
+        return self.backend.stats
+
+    def geocode_batch(
+        self, geocoding_input_list: list[GeocodingInput]
+    ) -> list[GeocodingOutput]:
+        return to_geocoding_output_list(
+            self.geocode_dataframe(to_geocoding_input_dataframe(geocoding_input_list))
+        )
+
+    def geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        if len(df) == 0:
+            return to_geocoding_output_dataframe([])
+
+        keys = address_keys(df)
+        geocoding_inputs = df[GEOCODING_INPUT_FIELDNAMES].to_dict(orient="records")
+
+        is_leader = False
+        try:
+            with self.lock:
+                is_leader = self.pending_future is None
+                if is_leader:
+                    self.pending_future = concurrent.futures.Future()
+
+                futures = set()
+                for key, geocoding_input in zip(keys, geocoding_inputs):
+                    if key not in self.futures_by_key:
+                        self.futures_by_key[key] = self.pending_future
+                        self.pending_inputs[key] = geocoding_input
+                    futures.add(self.futures_by_key[key])
+
+            if is_leader:
+                time.sleep(self.window)
+        finally:
+            # the first caller of the window sends the request for everyone, even
+            # when interrupted, so that the others are not left waiting
+            if is_leader:
+                self.flush()
+
+        results_df = pd.concat([future.result() for future in futures])
+        results_df = results_df[~results_df.index.duplicated()]
+
+        return (
+            results_df.reindex(keys)
+            .assign(id=df.id.to_numpy())
+            .dropna(subset=["code_insee"])
+            .reset_index(drop=True)[GEOCODING_OUTPUT_FIELDNAMES]
+        )
+
+    def reverse_geocode_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        return self.backend.reverse_geocode_dataframe(df)
+
+    def flush(self):
+        with self.lock:
+            future, self.pending_future = self.pending_future, None
+            inputs_by_key, self.pending_inputs = self.pending_inputs, {}
+
+        logger.info("%d distinct addresses to geocode", len(inputs_by_key))
+
+        try:
+            # ids are not guaranteed to be unique : index the inputs by position
+            keys = list(inputs_by_key.keys())
+            if len(keys) == 0:
+                output_df = to_geocoding_output_dataframe([])
+            else:
+                output_df = self.backend.geocode_dataframe(
+                    pd.DataFrame(
+                        list(inputs_by_key.values()),
+                        columns=GEOCODING_INPUT_FIELDNAMES,
+                    ).assign(id=np.arange(len(keys)).astype(str))
+                )
+            future.set_result(
+                output_df.set_index(
+                    pd.Index(keys, dtype=object)[output_df.id.astype(int).to_numpy()]
+                )
+            )
+        except BaseException as e:
+            future.set_exception(e)
+            # e.g. an interruption, that the waiting callers also get
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            with self.lock:
+                for key in inputs_by_key:
+                    del self.futures_by_key[key]
+
+
+def address_keys(df: pd.DataFrame) -> pd.Series:
+    """Normalized (adresse, code_postal, commune) of each input, as a string."""
+
+    return (
+        df.adresse.map(utils.normalize_address)
+        + "|"
+        + df.code_postal.map(utils.normalize_str)
+        + "|"
+        + df.commune.map(utils.normalize_address)
+    )
+
+
+def to_geocoding_input_list(df: pd.DataFrame) -> list[GeocodingInput]:
+    return [
+        GeocodingInput(*row)
+        for row in df[GEOCODING_INPUT_FIELDNAMES].itertuples(index=False)
+    ]
+
+
+def to_geocoding_input_dataframe(
+    geocoding_input_list: list[GeocodingInput],
+) -> pd.DataFrame:
+    return pd.DataFrame(
+        [dataclasses.astuple(i) for i in geocoding_input_list],
+        columns=GEOCODING_INPUT_FIELDNAMES,
+    )
+
+
+def to_geocoding_output_list(df: pd.DataFrame) -> list[GeocodingOutput]:
+    return [
+        GeocodingOutput(*row)
+        for row in df[GEOCODING_OUTPUT_FIELDNAMES]
+        .astype(object)
+        .replace({np.nan: None})
+        .itertuples(index=False)
+    ]
+
+
+def to_geocoding_output_dataframe(
+    geocoding_output_list: list[GeocodingOutput],
+) -> pd.DataFrame:
+    return pd.DataFrame(
+        [dataclasses.astuple(o) for o in geocoding_output_list],
+        columns=GEOCODING_OUTPUT_FIELDNAMES,
+    ).astype({"score": float, "latitude": float, "longitude": float})
+
+
+def concat_geocoding_outputs(df_list: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    return pd.concat([to_geocoding_output_dataframe([]), *df_list], ignore_index=True)
+
+
+def iter_csv_batches(
+    df: pd.DataFrame,
+    batch_sizes: Iterable[int],
+    max_batch_bytes: int,
+    fieldnames: list[str] = GEOCODING_INPUT_FIELDNAMES,
+) -> Iterator[pd.DataFrame]:
+    """Split the inputs in batches, bounded both in rows and in encoded bytes.
+
+    The maximum number of rows of each batch is taken from `batch_sizes`, when the
+    batch is cut.
+    """
+
+    batch_sizes = iter(batch_sizes)
+
+    df = df[fieldnames]
+    header_size = len(",".join(fieldnames)) + 1
+
+    # upper bound of the encoded size of each row, including quotes and separators
+    row_sizes = sum(
+        df[column].fillna("").astype(str).str.encode("utf-8").str.len().to_numpy() + 3
+        for column in fieldnames
+    )
+    cumulative_sizes = np.concatenate([[0], np.cumsum(row_sizes)])
+
+    start = 0
+    while start < len(df):
+        stop = np.searchsorted(
+            cumulative_sizes,
+            cumulative_sizes[start] + max_batch_bytes - header_size,
+            side="right",
+        )
+        # at least one row per batch
+        stop = max(start + 1, min(start + next(batch_sizes), stop - 1))
+        yield df.iloc[start:stop]
+        start = stop
+
+
+def iter_csv_lines(
+    df: pd.DataFrame,
+    block_size: int = 1000,
+    fieldnames: list[str] = GEOCODING_INPUT_FIELDNAMES,
+) -> Iterator[bytes]:
+    """Encode the inputs in csv, block of rows by block of rows."""
+
+    yield (",".join(fieldnames) + "\n").encode()
+    for start in range(0, len(df), block_size):
+        yield (
+            df[fieldnames]
+            .iloc[start : start + block_size]
+            .to_csv(index=False, header=False)
+            .encode()
+        )
+
+
+def iter_multipart(
+    boundary: str, params: dict, data: Iterable[bytes]
+) -> Iterator[bytes]:
+    """Encode a multipart/form-data body, with `data` as the csv file part."""
+
+    for name, values in params.items():
+        for value in values if isinstance(values, list) else [values]:
+            yield (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode()
+
+    yield (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="data"; filename="data.csv"\r\n'
+        "Content-Type: text/csv\r\n\r\n"
+    ).encode()
+    yield from data
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+class CsvResultsParser:
+    """Parser of the csv returned by the BAN api, fed line by line.
+
+    Only the results are kept. Lines can be fed as they are received, from a
+    synchronous or an asynchronous response. A malformed csv raises `ValueError`, so
+    that the batch fails like a failed request.
+    """
+
+    # fields of the output, by column of the csv
+    COLUMNS = {
+        "id": "id",
+        "code_insee": "result_citycode",
+        "score": "result_score",
+        "latitude": "latitude",
+        "longitude": "longitude",
+    }
+    REQUIRED_COLUMNS = ["id", "result_citycode", "result_score"]
+
+    def __init__(self):
+        self.header: Optional[list[str]] = None
+        self.indexes: dict[str, int] = {}
+        self.values: dict[str, list] = {}
+        # lines of a record with a quoted line break
+        self.pending_lines: list[str] = []
+
+    def feed(self, line: str):
+        self.pending_lines.append(line.rstrip("\r\n"))
+        text = "\n".join(self.pending_lines)
+        # an odd number of quotes : the record continues on the next line
+        if text.count('"') % 2 == 1:
+            return
+        self.pending_lines = []
+
+        # an empty line is yielded when a chunk ends between `\r` and `\n`
+        row = next(csv.reader(io.StringIO(text)), None)
+        if row is None:
+            return
+
+        if self.header is None:
+            self.set_header(row)
+            return
+
+        if len(row) != len(self.header):
+            raise ValueError(f"Malformed csv row: {row}")
+        if row[self.indexes["code_insee"]] != "":
+            for fieldname, index in self.indexes.items():
+                self.values[fieldname].append(row[index])
+
+    def set_header(self, header: list[str]):
+        missing_columns = [c for c in self.REQUIRED_COLUMNS if c not in header]
+        if len(missing_columns) > 0:
+            raise ValueError(f"Missing csv columns: {missing_columns}")
+
+        self.header = header
+        self.indexes = {
+            fieldname: header.index(column)
+            for fieldname, column in self.COLUMNS.items()
+            if column in header
+        }
+        self.values = {fieldname: [] for fieldname in self.indexes}
+
+    def to_dataframe(self) -> pd.DataFrame:
+        if len(self.pending_lines) > 0:
+            raise ValueError("Truncated csv")
+
+        return (
+            pd.DataFrame(self.values, columns=GEOCODING_OUTPUT_FIELDNAMES, dtype=object)
+            .replace({"": None})
+            .astype({"score": float, "latitude": float, "longitude": float})
+        )
+
+
+def parse_csv_results(lines: Iterable[str]) -> pd.DataFrame:
+    """Parse the csv returned by the BAN api line by line, keeping only results."""
+
+    parser = CsvResultsParser()
+    for line in lines:
+        parser.feed(line)
+    return parser.to_dataframe()
 
 
 def geocode_normalized_data(
     path: Path,
     geocoding_backend: GeocodingBackend,
+    fill_coordinates: bool = False,
+    commune_index: Optional[communes.CommunePolygonIndex] = None,
+    codes_postaux_table: Optional[codes_postaux.CodesPostauxTable] = None,
+    commune_level: bool = False,
 ) -> Path:
     logger.info("[GÉOCODING]")
     output_path = Path(f"./{path.stem}.geocoded.json")
     input_df = pd.read_json(path, dtype=False).replace(np.nan, None)
     output_df = geocode_normalized_dataframe(
-        input_df, geocoding_backend=geocoding_backend
+        input_df,
+        geocoding_backend=geocoding_backend,
+        fill_coordinates=fill_coordinates,
+        commune_index=commune_index,
+        codes_postaux_table=codes_postaux_table,
+        commune_level=commune_level,
     )
     output_df.to_json(output_path, orient="records", force_ascii=False)
+    if geocoding_backend.stats is not None:
+        geocoding_backend.stats.log(logger)
     return output_path
 
 
+def geocode_distinct(
+    df: pd.DataFrame,
+    keys: pd.Series,
+    geocoding_backend: GeocodingBackend,
+) -> pd.DataFrame:
+    """Geocode the first row of each distinct key, and broadcast its result."""
+
+    codes, uniques = pd.factorize(keys)
+    _, first_positions = np.unique(codes, return_index=True)
+
+    logger.info("%d rows to geocode, %d distinct keys", len(df), len(uniques))
+
+    geocoding_input_df = df.iloc[first_positions].assign(
+        id=np.arange(len(uniques)).astype(str)
+    )
+    geocoding_output_df = geocoding_backend.geocode_dataframe(geocoding_input_df)
+
+    return (
+        geocoding_output_df.set_index(geocoding_output_df.id.astype(int))
+        .reindex(np.arange(len(uniques)))
+        .iloc[codes]
+        .set_index(df.index)
+    )
+
+
 def geocode_normalized_dataframe(
     df: pd.DataFrame,
     geocoding_backend: GeocodingBackend,
+    fill_coordinates: bool = False,
+    commune_index: Optional[communes.CommunePolygonIndex] = None,
+    codes_postaux_table: Optional[codes_postaux.CodesPostauxTable] = None,
+    commune_level: bool = False,
 ) -> pd.DataFrame:
+    """Fill the missing `code_insee` of the structures, from their address.
+
+    With `fill_coordinates`, the missing `latitude` and `longitude` are also filled,
+    from the same geocoding results.
+
+    With a `commune_index`, the `code_insee` of the structures that already have
+    coordinates is first resolved offline, from the boundaries of the communes.
+
+    With a `codes_postaux_table`, the `code_insee` of the structures whose postcode
+    is served by a single commune is also resolved offline.
+
+    The structures with coordinates but without an address are reverse geocoded,
+    when the backend supports it.
+
+    With `commune_level`, the remaining structures are geocoded from their distinct
+    (code_postal, commune) pairs, and only the structures whose commune is ambiguous
+    are geocoded from their full address.
+    """
+
     utils.log_df_info(df, logger)
 
-    geocoding_outputs = geocoding_backend.geocode_batch(
-        [
-            GeocodingInput(
-                id=id, adresse=adresse, code_postal=code_postal, commune=commune
+    # keep the values provided by the source : only geocode missing ones
+    missing_code_insee = df.code_insee.isna()
+
+    if commune_index is not None:
+        has_coordinates = (
+            missing_code_insee & df.latitude.notna() & df.longitude.notna()
+        )
+        located_code_insee = pd.Series(
+            commune_index.lookup(
+                df.longitude[has_coordinates].to_numpy(dtype=float),
+                df.latitude[has_coordinates].to_numpy(dtype=float),
+            ),
+            index=df.index[has_coordinates],
+            dtype=object,
+        ).reindex(df.index)
+        df["code_insee"] = df.code_insee.where(~missing_code_insee, located_code_insee)
+        df["code_insee"] = df.code_insee.astype(object).where(
+            df.code_insee.notna(), None
+        )
+
+        logger.info(
+            "%d code_insee resolved from the coordinates",
+            located_code_insee.notna().sum(),
+        )
+
+        missing_code_insee = df.code_insee.isna()
+
+    if codes_postaux_table is not None:
+        looked_up_code_insee = codes_postaux_table.lookup(
+            df.code_postal[missing_code_insee]
+        ).reindex(df.index)
+        df["code_insee"] = df.code_insee.where(
+            ~missing_code_insee, looked_up_code_insee
+        )
+        df["code_insee"] = df.code_insee.astype(object).where(
+            df.code_insee.notna(), None
+        )
+
+        logger.info(
+            "%d code_insee resolved from an unambiguous postcode",
+            looked_up_code_insee.notna().sum(),
+        )
+
+        missing_code_insee = df.code_insee.isna()
+
+    # structures without a usable address are located from their coordinates
+    to_reverse = (
+        missing_code_insee
+        & df.latitude.notna()
+        & df.longitude.notna()
+        & (df.adresse.map(utils.normalize_address) == "")
+    )
+    if to_reverse.any():
+        reverse_input_df = df.loc[to_reverse, ["latitude", "longitude"]].assign(
+            id=np.arange(to_reverse.sum()).astype(str)
+        )
+        try:
+            reverse_output_df = geocoding_backend.reverse_geocode_dataframe(
+                reverse_input_df
             )
-            for id, adresse, code_postal, commune in zip(
-                df.id, df.adresse, df.code_postal, df.commune
+        except NotImplementedError:
+            logger.warning("Reverse geocoding not supported by the geocoding backend")
+        else:
+            reverse_output_df = (
+                reverse_output_df.set_index(reverse_output_df.id.astype(int))
+                .reindex(np.arange(len(reverse_input_df)))
+                .set_index(reverse_input_df.index)
+                .reindex(df.index)
+            )
+            reversed_code_insee = reverse_output_df.code_insee.where(
+                reverse_output_df.score >= MIN_SCORE
+            )
+            df["code_insee"] = df.code_insee.where(
+                ~missing_code_insee, reversed_code_insee
+            )
+            df["code_insee"] = df.code_insee.astype(object).where(
+                df.code_insee.notna(), None
             )
-        ]
-    )
 
-    geocoding_output_by_id = {o.id: o for o in geocoding_outputs}
+            logger.info(
+                "%d code_insee reverse geocoded, out of %d",
+                reversed_code_insee.notna().sum(),
+                to_reverse.sum(),
+            )
+
+            missing_code_insee = df.code_insee.isna()
+
+    if commune_level:
+        # geocode each distinct commune once, without the street
+        commune_df = df.loc[
+            missing_code_insee, ["adresse", "code_postal", "commune"]
+        ].assign(adresse="")
+        commune_output_df = geocode_distinct(
+            commune_df,
+            keys=commune_df.code_postal.map(utils.normalize_str)
+            + "|"
+            + commune_df.commune.map(utils.normalize_address),
+            geocoding_backend=geocoding_backend,
+        ).reindex(df.index)
 
-    def fill_code_insee(row):
-        # keep the code_insee provided by the source
-        if row["code_insee"] is not None:
-            return row["code_insee"]
+        # ambiguous communes are left to the street level
+        confident = commune_output_df.score >= MIN_COMMUNE_SCORE
+        df["code_insee"] = df.code_insee.where(
+            ~(missing_code_insee & confident), commune_output_df.code_insee
+        )
+        df["code_insee"] = df.code_insee.astype(object).where(
+            df.code_insee.notna(), None
+        )
 
-        if row.id not in geocoding_output_by_id:
-            return None
+        logger.info(
+            "%d code_insee resolved at the commune level, %d ambiguous",
+            (missing_code_insee & confident).sum(),
+            (missing_code_insee & ~confident).sum(),
+        )
 
-        geocoding_output = geocoding_output_by_id[row.id]
+        missing_code_insee = df.code_insee.isna()
 
-        # skip geocoding if the score is low
-        if geocoding_output.score < 0.4:
-            return None
+    to_geocode = missing_code_insee
+    if fill_coordinates:
+        missing_coordinates = df.latitude.isna() | df.longitude.isna()
+        to_geocode = to_geocode | missing_coordinates
+    to_geocode_df = df.loc[to_geocode, ["adresse", "code_postal", "commune"]]
 
-        return geocoding_output.code_insee
+    # geocode each distinct address once
+    geocoding_output_df = geocode_distinct(
+        to_geocode_df,
+        keys=address_keys(to_geocode_df),
+        geocoding_backend=geocoding_backend,
+    ).reindex(df.index)
+
+    # skip geocoding if the score is low
+    geocoded_code_insee = geocoding_output_df.code_insee.where(
+        geocoding_output_df.score >= MIN_SCORE
+    )
+    df["code_insee"] = (
+        df.code_insee.where(~missing_code_insee, geocoded_code_insee)
+        .replace({np.nan: None})
+        .astype(object)
+    )
 
-    df["code_insee"] = df.apply(fill_code_insee, axis="columns")
+    if fill_coordinates:
+        # coordinates are only relevant for precise results
+        to_fill = missing_coordinates & (
+            geocoding_output_df.score >= MIN_COORDINATES_SCORE
+        )
+        for column in ["latitude", "longitude"]:
+            df[column] = df[column].where(~to_fill, geocoding_output_df[column])
+            df[column] = df[column].astype(object).where(df[column].notna(), None)
 
     utils.log_df_info(df, logger)
 
@@ -1,6 +1,17 @@
+import concurrent.futures
 import logging
+from typing import Optional
 
-from data_inclusion.tasks import constants, extract, geocoding, load, reshape, validate
+from data_inclusion.tasks import (
+    codes_postaux,
+    communes,
+    constants,
+    extract,
+    geocoding,
+    load,
+    reshape,
+    validate,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -9,12 +20,50 @@ def full_processing(
     src: str,
     src_type: constants.SourceType,
     geocoding_backend: geocoding.GeocodingBackend,
+    fill_coordinates: bool = False,
+    commune_index: Optional[communes.CommunePolygonIndex] = None,
+    codes_postaux_table: Optional[codes_postaux.CodesPostauxTable] = None,
+    commune_level: bool = False,
     dry_run: bool = False,
 ):
     path = extract.extract(src=src, src_type=src_type)
     path = reshape.reshape(path=path, src_type=src_type)
-    path = geocoding.geocode_normalized_data(path, geocoding_backend=geocoding_backend)
+    path = geocoding.geocode_normalized_data(
+        path,
+        geocoding_backend=geocoding_backend,
+        fill_coordinates=fill_coordinates,
+        commune_index=commune_index,
+        codes_postaux_table=codes_postaux_table,
+        commune_level=commune_level,
+    )
     path = validate.validate_normalized_data(path)
 
     if not dry_run:
         load.load_data(path=path)
+
+
+def full_processing_many(
+    sources: list[tuple[str, constants.SourceType]],
+    geocoding_backend: geocoding.GeocodingBackend,
+    coalescing_window: float = 0.5,
+    **kwargs,
+):
+    """Process several sources concurrently, sharing their geocoding requests."""
+
+    geocoding_backend = geocoding.CoalescingGeocodingBackend(
+        backend=geocoding_backend, window=coalescing_window
+    )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = [
+            executor.submit(
+                full_processing,
+                src=src,
+                src_type=src_type,
+                geocoding_backend=geocoding_backend,
+                **kwargs,
+            )
+            for src, src_type in sources
+        ]
+        for future in futures:
+            future.result()
@@ -0,0 +1,117 @@
+"""Supporting objects of the `sirene_establishment` table, used for siretisation.
+
+The siretisation searches establishments close to a structure, in its department,
+with a similar name. Each of these criteria is backed by an index :
+
+* `location`, a geography column computed from the coordinates, with a GiST index
+  for `ST_DWithin`,
+* `department`, computed from the `city_code`, with a btree index,
+* GIN trigram indexes on `name` and `address1`, for the `%` similarity operator.
+
+Before that fuzzy search, structures are matched exactly on their normalized name
+(`name_key`, see `name_key()`) and commune, or on the siren of their parent
+structure and their commune, backed by btree indexes.
+"""
+
+import json
+import logging
+import re
+from typing import Iterator, Optional
+
+import sqlalchemy as slqa
+from sqlalchemy.engine import Connection, Engine
+
+from data_inclusion.tasks import utils
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = ["postgis", "pg_trgm"]
+
+# accented letters removed by `name_key`, in a form usable in an immutable expression
+ACCENTED_LETTERS = "àâäáãåçéèêëíìîïñóòôöõúùûüýÿ"
+UNACCENTED_LETTERS = "aaaaaaceeeeiiiinooooouuuuyy"
+
+COLUMNS = {
+    "location": (
+        "geography(Point, 4326) GENERATED ALWAYS AS "
+        "(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) :: geography) STORED"
+    ),
+    "department": "text GENERATED ALWAYS AS (left(city_code, 2)) STORED",
+    "name_key": (
+        "text GENERATED ALWAYS AS (trim(regexp_replace(translate(lower(name), "
+        f"'{ACCENTED_LETTERS}', '{UNACCENTED_LETTERS}'), '[^a-z0-9]+', ' ', 'g'))) "
+        "STORED"
+    ),
+    "siren": "text GENERATED ALWAYS AS (left(siret, 9)) STORED",
+}
+
+INDEXES = {
+    "sirene_establishment_location_idx": "USING gist (location)",
+    "sirene_establishment_department_idx": "(department)",
+    "sirene_establishment_name_trgm_idx": "USING gin (name gin_trgm_ops)",
+    "sirene_establishment_address1_trgm_idx": "USING gin (address1 gin_trgm_ops)",
+    "sirene_establishment_city_code_name_key_idx": "(city_code, name_key)",
+    "sirene_establishment_siren_city_code_idx": "(siren, city_code)",
+}
+
+
+def name_key(s: Optional[str]) -> str:
+    """Python counterpart of the `name_key` column, for exact matching."""
+
+    return re.sub(r"[^a-z0-9]+", " ", utils.normalize_str(s)).strip()
+
+
+def create_extensions(connection: Connection):
+    for name in EXTENSIONS:
+        connection.execute(slqa.text(f"CREATE EXTENSION IF NOT EXISTS {name}"))
+
+
+def create_columns(connection: Connection):
+    create_extensions(connection)
+    for name, definition in COLUMNS.items():
+        logger.info("Adding column %s", name)
+        connection.execute(
+            slqa.text(
+                "ALTER TABLE sirene_establishment "
+                f"ADD COLUMN IF NOT EXISTS {name} {definition}"
+            )
+        )
+
+
+def create_indexes(connection: Connection):
+    for name, definition in INDEXES.items():
+        logger.info("Creating index %s", name)
+        connection.execute(
+            slqa.text(
+                f"CREATE INDEX IF NOT EXISTS {name} "
+                f"ON sirene_establishment {definition}"
+            )
+        )
+    connection.execute(slqa.text("ANALYZE sirene_establishment"))
+
+
+def migrate(engine: Engine):
+    """Create the columns and indexes used by the siretisation, if missing."""
+
+    with engine.begin() as connection:
+        create_columns(connection)
+        create_indexes(connection)
+
+
+def iter_index_names(plan: dict) -> Iterator[str]:
+    if "Index Name" in plan:
+        yield plan["Index Name"]
+    for subplan in plan.get("Plans", []):
+        yield from iter_index_names(subplan)
+
+
+def explain(connection: Connection, statement: str, params: dict) -> set[str]:
+    """Names of the indexes used by the plan of the given statement."""
+
+    plans = connection.execute(
+        slqa.text(f"EXPLAIN (FORMAT JSON) {statement}"), params
+    ).scalar()
+    if isinstance(plans, str):
+        plans = json.loads(plans)
+
+    return set(iter_index_names(plans[0]["Plan"]))
@@ -0,0 +1,440 @@
+"""Offline siretisation from a local extract of the SIRENE establishments.
+
+The extract (a csv, possibly compressed, or a parquet file with the columns of the
+`sirene_establishment` table, or a sqlite database with this table) is indexed once
+on disk as plain numpy arrays, that are memory-mapped when the backend is
+instantiated :
+
+* the establishments are sorted by department, then by cell of a regular grid of
+  `CELL_SIZE` degrees, so that the neighbourhood of a structure is a few
+  contiguous slices of the arrays,
+* the trigrams of their names are stored as integer ids, in a compressed sparse
+  row layout, to compute the similarities with a structure name in bulk.
+
+The similarity follows the semantics of the postgres `similarity()` function of the
+pg_trgm extension.
+
+The same index can also be built in memory, department by department, from the
+SIRENE database itself (see `PrefetchedSireneBackend`).
+"""
+
+import array
+import collections
+import logging
+import re
+import sqlite3
+import textwrap
+import threading
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as slqa
+from sqlalchemy.engine import Engine
+
+from data_inclusion.tasks import siretisation
+
+logger = logging.getLogger(__name__)
+
+SIRENE_COLUMNS = ["siret", "name", "city_code", "longitude", "latitude"]
+
+INDEX_ARRAYS = [
+    "siret",
+    "cell_key",
+    "longitude",
+    "latitude",
+    "trigram_indptr",
+    "trigram_ids",
+    "trigram_vocabulary",
+    "department",
+    "department_indptr",
+]
+
+# size of the cells of the grid, in degrees (about 1 km in latitude)
+CELL_SIZE = 0.01
+
+EARTH_RADIUS_METERS = 6_371_008.8
+METERS_PER_DEGREE = 2 * np.pi * EARTH_RADIUS_METERS / 360
+
+
+def trigrams(s: Optional[str]) -> list[str]:
+    """Distinct trigrams of a string, as extracted by pg_trgm.
+
+    The string is lowercased and split in words of alphanumeric characters. Each
+    word is padded with 2 spaces before and 1 space after.
+    """
+
+    if s is None:
+        return []
+
+    return sorted(
+        {
+            padded[i : i + 3]
+            for word in re.findall(r"[^\W_]+", s.lower())
+            for padded in [f"  {word} "]
+            for i in range(len(padded) - 2)
+        }
+    )
+
+
+def similarity(a: list[str], b: list[str]) -> float:
+    """Ratio of shared trigrams, as computed by pg_trgm `similarity()`."""
+
+    union = len(set(a) | set(b))
+    if union == 0:
+        return 0.0
+    return len(set(a) & set(b)) / union
+
+
+def cell_keys(longitude: np.ndarray, latitude: np.ndarray) -> np.ndarray:
+    """Key of the grid cell of each point, ordered by column then by row."""
+
+    cell_x = np.floor(np.asarray(longitude) / CELL_SIZE).astype(np.int64)
+    cell_y = np.floor(np.asarray(latitude) / CELL_SIZE).astype(np.int64)
+    return cell_x * 2**32 + cell_y
+
+
+def distances(
+    longitude: float, latitude: float, longitudes: np.ndarray, latitudes: np.ndarray
+) -> np.ndarray:
+    """Haversine distances in meters, between a point and an array of points."""
+
+    lon1, lat1, lon2, lat2 = map(
+        np.radians, (longitude, latitude, longitudes, latitudes)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+
+def read_sirene_extract(src: Path, chunksize: int) -> pd.DataFrame:
+    if src.suffix == ".parquet":
+        return pd.read_parquet(src, columns=SIRENE_COLUMNS)
+
+    # as loaded by `sirene_stock.load_sirene_stock`
+    if src.suffix in [".db", ".sqlite"]:
+        with sqlite3.connect(src) as connection:
+            return pd.concat(
+                pd.read_sql(
+                    f"SELECT {', '.join(SIRENE_COLUMNS)} FROM sirene_establishment",
+                    connection,
+                    chunksize=chunksize,
+                )
+            )
+
+    # compression is inferred from the extension
+    return pd.concat(
+        pd.read_csv(
+            src,
+            usecols=SIRENE_COLUMNS,
+            dtype={"siret": str, "name": str, "city_code": str},
+            chunksize=chunksize,
+        )
+    )
+
+
+def index_arrays(establishments_df: pd.DataFrame) -> dict[str, np.ndarray]:
+    """Arrays of the index of the given establishments, with the `SIRENE_COLUMNS`.
+
+    When the establishments have an `address1` column, it is kept as well.
+    """
+
+    establishments_df = (
+        establishments_df.dropna(subset=SIRENE_COLUMNS)
+        .assign(
+            department=lambda df: df.city_code.str[:2],
+            cell_key=lambda df: cell_keys(df.longitude, df.latitude),
+        )
+        .sort_values(by=["department", "cell_key"], kind="stable")
+    )
+
+    # trigrams are numbered in order of appearance
+    vocabulary = {}
+    trigram_ids, trigram_counts = array.array("i"), array.array("q")
+    for name in establishments_df.name:
+        name_trigrams = trigrams(name)
+        trigram_ids.extend(
+            vocabulary.setdefault(t, len(vocabulary)) for t in name_trigrams
+        )
+        trigram_counts.append(len(name_trigrams))
+
+    departments, department_starts = np.unique(
+        establishments_df.department.to_numpy(dtype=str), return_index=True
+    )
+
+    arrays = {
+        "siret": establishments_df.siret.to_numpy(dtype=str),
+        "cell_key": establishments_df.cell_key.to_numpy(dtype=np.int64),
+        "longitude": establishments_df.longitude.to_numpy(dtype=np.float64),
+        "latitude": establishments_df.latitude.to_numpy(dtype=np.float64),
+        "trigram_indptr": np.concatenate(
+            [[0], np.cumsum(np.frombuffer(trigram_counts, dtype=np.int64))]
+        ).astype(np.int64),
+        "trigram_ids": np.frombuffer(trigram_ids, dtype=np.int32),
+        "trigram_vocabulary": np.array(list(vocabulary), dtype=str),
+        "department": departments,
+        "department_indptr": np.append(department_starts, len(establishments_df)),
+    }
+    if "address1" in establishments_df.columns:
+        arrays["address1"] = establishments_df.address1.to_numpy(dtype=object)
+
+    return arrays
+
+
+def build_sirene_index(src: Path, output_dir: Path, chunksize: int = 1_000_000) -> Path:
+    """Index a SIRENE establishments extract for the `LocalSireneBackend`."""
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    arrays = index_arrays(read_sirene_extract(src, chunksize=chunksize))
+    for name in INDEX_ARRAYS:
+        np.save(output_dir / f"{name}.npy", arrays[name])
+
+    logger.info(
+        "%d establishments and %d trigrams indexed in %s",
+        len(arrays["siret"]),
+        len(arrays["trigram_vocabulary"]),
+        output_dir,
+    )
+
+    return output_dir
+
+
+class LocalSireneBackend(siretisation.SiretisationBackend):
+    """Match the structures against an index built by `build_sirene_index`.
+
+    An establishment matches a structure when it is in the same department, within
+    `LOCATION_WITHIN_METERS` of the structure, and with a name similarity of at
+    least `NAME_SIMILARITY_THRESHOLD`. The most similar one is kept.
+
+    The index is either read from the `index_dir` built by `build_sirene_index`, or
+    given as in-memory `arrays`, as returned by `index_arrays`.
+    """
+
+    def __init__(
+        self,
+        index_dir: Optional[Path] = None,
+        arrays: Optional[dict[str, np.ndarray]] = None,
+    ):
+        if arrays is None:
+            arrays = {
+                name: np.load(index_dir / f"{name}.npy", mmap_mode="r")
+                for name in INDEX_ARRAYS
+            }
+        self.arrays = arrays
+        self.vocabulary = {
+            trigram: i for i, trigram in enumerate(self.arrays["trigram_vocabulary"])
+        }
+
+    def department_slice(self, department: str) -> slice:
+        i = np.searchsorted(self.arrays["department"], department)
+        if i == len(self.arrays["department"]) or (
+            self.arrays["department"][i] != department
+        ):
+            return slice(0, 0)
+        indptr = self.arrays["department_indptr"]
+        return slice(int(indptr[i]), int(indptr[i + 1]))
+
+    def candidates(self, department: str, longitude: float, latitude: float):
+        """Positions of the establishments of the cells around the given point."""
+
+        department_slice = self.department_slice(department)
+        keys = self.arrays["cell_key"][department_slice]
+
+        delta_y = siretisation.LOCATION_WITHIN_METERS / METERS_PER_DEGREE
+        delta_x = delta_y / max(np.cos(np.radians(latitude)), 1e-6)
+        min_cell_y, max_cell_y = np.floor(
+            np.array([latitude - delta_y, latitude + delta_y]) / CELL_SIZE
+        ).astype(np.int64)
+        min_cell_x, max_cell_x = np.floor(
+            np.array([longitude - delta_x, longitude + delta_x]) / CELL_SIZE
+        ).astype(np.int64)
+
+        # the cells of a column are contiguous
+        cell_xs = np.arange(min_cell_x, max_cell_x + 1)
+        starts = np.searchsorted(keys, cell_xs * 2**32 + min_cell_y, side="left")
+        stops = np.searchsorted(keys, cell_xs * 2**32 + max_cell_y, side="right")
+
+        return department_slice.start + np.concatenate(
+            [np.arange(start, stop) for start, stop in zip(starts, stops)]
+        ).astype(np.int64)
+
+    def similarities(self, name: str, positions: np.ndarray) -> np.ndarray:
+        """Trigram similarities between a name and the given establishments."""
+
+        name_trigrams = trigrams(name)
+        name_trigram_ids = np.array(
+            [self.vocabulary[t] for t in name_trigrams if t in self.vocabulary],
+            dtype=np.int32,
+        )
+
+        indptr = self.arrays["trigram_indptr"]
+        starts, counts = indptr[positions], indptr[positions + 1] - indptr[positions]
+
+        # flattened trigrams of all the establishments
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        flat_ids = self.arrays["trigram_ids"][offsets + np.arange(counts.sum())]
+        shared = np.bincount(
+            np.repeat(np.arange(len(positions)), counts),
+            weights=np.isin(flat_ids, name_trigram_ids),
+            minlength=len(positions),
+        )
+
+        union = counts + len(name_trigrams) - shared
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(union > 0, shared / union, 0.0)
+
+    def best_match(
+        self, nom: str, code_insee: str, longitude: float, latitude: float
+    ) -> Optional[tuple[int, float, float]]:
+        """Position, name similarity and distance of the matching establishment."""
+
+        positions = self.candidates(code_insee[:2], longitude, latitude)
+        if len(positions) == 0:
+            return None
+
+        candidate_distances = distances(
+            longitude,
+            latitude,
+            self.arrays["longitude"][positions],
+            self.arrays["latitude"][positions],
+        )
+        is_close = candidate_distances < siretisation.LOCATION_WITHIN_METERS
+        positions, candidate_distances = (
+            positions[is_close],
+            candidate_distances[is_close],
+        )
+        if len(positions) == 0:
+            return None
+
+        scores = self.similarities(nom, positions)
+        best = np.argmax(scores)
+        if scores[best] < siretisation.NAME_SIMILARITY_THRESHOLD:
+            return None
+        return (
+            int(positions[best]),
+            float(scores[best]),
+            float(candidate_distances[best]),
+        )
+
+    def match(
+        self, nom: str, code_insee: str, longitude: float, latitude: float
+    ) -> Optional[str]:
+        best_match = self.best_match(nom, code_insee, longitude, latitude)
+        if best_match is None:
+            return None
+        return str(self.arrays["siret"][best_match[0]])
+
+    def match_record(self, row) -> dict:
+        best_match = self.best_match(
+            row.nom, row.code_insee, row.longitude, row.latitude
+        )
+        if best_match is None:
+            return {"siret": None}
+
+        position, name_similarity, distance = best_match
+        return {
+            "siret": str(self.arrays["siret"][position]),
+            "name_similarity": name_similarity,
+            # addresses are only available for prefetched establishments
+            "address_similarity": similarity(
+                trigrams(row.adresse), trigrams(self.arrays["address1"][position])
+            )
+            if "address1" in self.arrays
+            else None,
+            "distance": distance,
+        }
+
+    def match_batch(self, structures_df: pd.DataFrame) -> pd.DataFrame:
+        searchable = siretisation.is_searchable(structures_df)
+        records = [
+            self.match_record(row) if is_searchable else {"siret": None}
+            for row, is_searchable in zip(structures_df.itertuples(), searchable)
+        ]
+        results_df = pd.DataFrame.from_records(
+            records,
+            columns=["siret", *siretisation.SCORE_COLUMNS],
+            index=structures_df.index,
+        ).astype(object)
+        return results_df.where(results_df.notna(), None)
+
+
+PREFETCH_QUERY = textwrap.dedent(
+    """
+    SELECT siret, name, address1, city_code, longitude, latitude
+    FROM sirene_establishment
+    WHERE
+        department = :department
+        AND name IS NOT NULL
+        AND longitude IS NOT NULL
+        AND latitude IS NOT NULL
+    """
+)
+
+
+class PrefetchedSireneBackend(siretisation.SiretisationBackend):
+    """Match the structures locally, against the establishments of their department.
+
+    The establishments of a department are read from the SIRENE database in a
+    single query, then indexed in memory with `index_arrays`. The indexes of the
+    last `cache_size` departments are kept for the next structures. The matching is
+    that of the `LocalSireneBackend`, with the address similarity on top.
+    """
+
+    def __init__(self, engine: Engine, cache_size: int = 8):
+        self.engine = engine
+        self.cache_size = cache_size
+        self._stats = siretisation.StatementStats()
+
+        self.lock = threading.Lock()
+        self.backends_by_department = collections.OrderedDict()
+
+    @property
+    def stats(self) -> Optional[siretisation.StatementStats]:
+        return self._stats
+
+    def department_backend(self, department: str) -> LocalSireneBackend:
+        with self.lock:
+            if department in self.backends_by_department:
+                self.backends_by_department.move_to_end(department)
+                return self.backends_by_department[department]
+
+        with self._stats.timed("prefetch_department"), self.engine.connect() as conn:
+            establishments_df = pd.read_sql(
+                slqa.text(PREFETCH_QUERY), conn, params={"department": department}
+            )
+        backend = LocalSireneBackend(arrays=index_arrays(establishments_df))
+        logger.info(
+            "%d establishments prefetched for department %s",
+            len(establishments_df),
+            department,
+        )
+
+        with self.lock:
+            self.backends_by_department[department] = backend
+            while len(self.backends_by_department) > self.cache_size:
+                self.backends_by_department.popitem(last=False)
+
+        return backend
+
+    def match_batch(self, structures_df: pd.DataFrame) -> pd.DataFrame:
+        # the index is not guaranteed to be unique : work on positions
+        positions_df = structures_df.reset_index(drop=True)
+        positions_df = positions_df[siretisation.is_searchable(positions_df)]
+
+        results_list = [
+            self.department_backend(department).match_batch(partition_df)
+            for department, partition_df in positions_df.groupby(
+                positions_df.code_insee.str[:2], sort=False
+            )
+        ]
+
+        results_df = pd.concat(
+            [pd.DataFrame(columns=["siret", *siretisation.SCORE_COLUMNS])]
+            + results_list
+        ).reindex(range(len(structures_df)))
+        results_df = results_df.set_axis(structures_df.index).astype(object)
+        return results_df.where(results_df.notna(), None)
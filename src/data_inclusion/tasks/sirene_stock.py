@@ -0,0 +1,246 @@
+"""Bulk loading of the SIRENE establishments stock in the `sirene_establishment` table.
+
+The stock is the `StockEtablissement` file of the SIRENE database, in its geolocated
+version (with `longitude` and `latitude` columns), as a compressed csv or a parquet
+file. It is read by batches, of which only the active establishments and the
+columns used by the siretisation are kept.
+
+Most establishments have neither a usual name nor a sign : their name then falls
+back to the legal name of their legal unit, read from the `StockUniteLegale` file.
+
+The table is recreated and loaded with `COPY` on postgres, or plain inserts on
+sqlite for local use. Its generated columns are declared with the table, so that
+they are computed as the rows are loaded, without rewriting the table afterwards.
+Its indexes are only created once the table is loaded.
+"""
+
+import io
+import logging
+from pathlib import Path
+from typing import Iterator, Optional
+
+import pandas as pd
+import sqlalchemy as slqa
+from sqlalchemy.engine import Connection, Engine
+
+from data_inclusion.tasks import sirene
+
+logger = logging.getLogger(__name__)
+
+STOCK_COLUMNS = [
+    "siret",
+    "etatAdministratifEtablissement",
+    "denominationUsuelleEtablissement",
+    "enseigne1Etablissement",
+    "numeroVoieEtablissement",
+    "indiceRepetitionEtablissement",
+    "typeVoieEtablissement",
+    "libelleVoieEtablissement",
+    "codeCommuneEtablissement",
+    "longitude",
+    "latitude",
+]
+
+LEGAL_UNIT_COLUMNS = [
+    "siren",
+    "denominationUniteLegale",
+]
+
+TABLE_COLUMNS = {
+    "siret": "text",
+    "name": "text",
+    "address1": "text",
+    "city_code": "text",
+    "longitude": "float8",
+    "latitude": "float8",
+}
+
+# sqlite has neither geography nor trigram indexes
+SQLITE_COLUMNS = {
+    "department": "text GENERATED ALWAYS AS (substr(city_code, 1, 2)) VIRTUAL",
+}
+SQLITE_INDEXES = {
+    "sirene_establishment_siret_idx": "(siret)",
+    "sirene_establishment_city_code_idx": "(city_code)",
+    "sirene_establishment_department_idx": "(department)",
+}
+
+
+def read_batches(
+    src: Path, columns: list[str], batch_size: int
+) -> Iterator[pd.DataFrame]:
+    if src.suffix == ".parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # as strings, like the csv columns
+        schema = pa.schema([pa.field(name, pa.string()) for name in columns])
+        for batch in pq.ParquetFile(src).iter_batches(
+            batch_size=batch_size, columns=columns
+        ):
+            yield pa.Table.from_batches([batch]).select(columns).cast(
+                schema
+            ).to_pandas()
+        return
+
+    # compression is inferred from the extension
+    yield from pd.read_csv(
+        src,
+        usecols=columns,
+        dtype=str,
+        chunksize=batch_size,
+    )
+
+
+def read_stock(src: Path, batch_size: int) -> Iterator[pd.DataFrame]:
+    yield from read_batches(src, columns=STOCK_COLUMNS, batch_size=batch_size)
+
+
+def read_legal_names(src: Path, batch_size: int) -> pd.Series:
+    """Legal names of the legal units, indexed by siren."""
+
+    legal_names_list = []
+    for legal_units_df in read_batches(
+        src, columns=LEGAL_UNIT_COLUMNS, batch_size=batch_size
+    ):
+        legal_units_df = legal_units_df.dropna(subset=["denominationUniteLegale"])
+        legal_names_list.append(
+            legal_units_df.set_index("siren").denominationUniteLegale
+        )
+
+    if len(legal_names_list) == 0:
+        return pd.Series(dtype=object)
+    return pd.concat(legal_names_list)
+
+
+def project(
+    stock_df: pd.DataFrame, legal_names: Optional[pd.Series] = None
+) -> pd.DataFrame:
+    """Rows of the `sirene_establishment` table, for the active establishments."""
+
+    stock_df = stock_df[stock_df.etatAdministratifEtablissement == "A"]
+
+    name = stock_df.denominationUsuelleEtablissement.fillna(
+        stock_df.enseigne1Etablissement
+    )
+    if legal_names is not None:
+        name = name.fillna(stock_df.siret.str[:9].map(legal_names))
+
+    address1 = (
+        stock_df.numeroVoieEtablissement.fillna("")
+        .str.cat(
+            [
+                stock_df.indiceRepetitionEtablissement.fillna(""),
+                stock_df.typeVoieEtablissement.fillna(""),
+                stock_df.libelleVoieEtablissement.fillna(""),
+            ],
+            sep=" ",
+        )
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+
+    return pd.DataFrame(
+        {
+            "siret": stock_df.siret,
+            "name": name,
+            "address1": address1.where(address1 != "", None),
+            "city_code": stock_df.codeCommuneEtablissement,
+            "longitude": pd.to_numeric(stock_df.longitude, errors="coerce"),
+            "latitude": pd.to_numeric(stock_df.latitude, errors="coerce"),
+        },
+        columns=list(TABLE_COLUMNS),
+    )
+
+
+def create_table(
+    connection: Connection, generated_columns: Optional[dict[str, str]] = None
+):
+    connection.execute(slqa.text("DROP TABLE IF EXISTS sirene_establishment"))
+    connection.execute(
+        slqa.text(
+            "CREATE TABLE sirene_establishment ("
+            + ", ".join(
+                f"{name} {definition}"
+                for name, definition in {
+                    **TABLE_COLUMNS,
+                    **(generated_columns or {}),
+                }.items()
+            )
+            + ")"
+        )
+    )
+
+
+def copy_batch(connection: Connection, establishments_df: pd.DataFrame):
+    buf = io.StringIO()
+    establishments_df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY sirene_establishment ({', '.join(TABLE_COLUMNS)}) "
+        "FROM STDIN WITH (FORMAT csv)",
+        buf,
+    )
+    cursor.close()
+
+
+def create_sqlite_indexes(connection: Connection):
+    for name, definition in SQLITE_INDEXES.items():
+        logger.info("Creating index %s", name)
+        connection.execute(
+            slqa.text(f"CREATE INDEX {name} ON sirene_establishment {definition}")
+        )
+    connection.execute(slqa.text("ANALYZE sirene_establishment"))
+
+
+def load_sirene_stock(
+    src: Path,
+    engine: Engine,
+    batch_size: int = 500_000,
+    legal_units_src: Optional[Path] = None,
+) -> int:
+    """Replace the content of the `sirene_establishment` table with the stock.
+
+    The whole load runs in a single transaction : an interrupted load leaves the
+    previous content untouched. Without `legal_units_src`, the establishments
+    without usual name nor sign have no name.
+    """
+
+    is_postgres = engine.dialect.name == "postgresql"
+
+    legal_names = None
+    if legal_units_src is not None:
+        legal_names = read_legal_names(legal_units_src, batch_size=batch_size)
+        logger.info("%d legal names loaded", len(legal_names))
+
+    count = 0
+    with engine.begin() as connection:
+        if is_postgres:
+            # the generated columns use the types and functions of the extensions
+            sirene.create_extensions(connection)
+            create_table(connection, generated_columns=sirene.COLUMNS)
+        else:
+            create_table(connection, generated_columns=SQLITE_COLUMNS)
+
+        for stock_df in read_stock(src, batch_size=batch_size):
+            establishments_df = project(stock_df, legal_names=legal_names)
+            if is_postgres:
+                copy_batch(connection, establishments_df)
+            else:
+                establishments_df.to_sql(
+                    "sirene_establishment",
+                    connection,
+                    if_exists="append",
+                    index=False,
+                )
+            count += len(establishments_df)
+            logger.info("%d establishments loaded", count)
+
+        if is_postgres:
+            sirene.create_indexes(connection)
+        else:
+            create_sqlite_indexes(connection)
+
+    return count
@@ -1,20 +1,187 @@
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
+import hashlib
+import json
 import logging
+import re
 import textwrap
+import threading
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterator, Optional
 
 import numpy as np
 import pandas as pd
 import sqlalchemy as slqa
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Connection, Engine
 from tqdm import tqdm
 
-from data_inclusion import settings
-from data_inclusion.tasks import utils
+from data_inclusion.tasks import sirene, utils
 
 logger = logging.getLogger(__name__)
 
-tqdm.pandas()
+# maximum distance between a structure and its establishment
+LOCATION_WITHIN_METERS = 1000
+# minimum similarity between the names of a structure and its establishment
+NAME_SIMILARITY_THRESHOLD = 0.6
+# scores of the matching establishment, when computed by the backend
+SCORE_COLUMNS = ["name_similarity", "address_similarity", "distance"]
+
+
+class SiretisationBackend:
+    @property
+    def stats(self) -> Optional["StatementStats"]:
+        return None
+
+    def match_batch(self, structures_df: pd.DataFrame) -> pd.DataFrame:
+        """Find the establishment matching each structure.
+
+        `structures_df` has the `nom`, `adresse`, `code_insee`, `latitude` and
+        `longitude` columns. The returned dataframe has the same index, and a
+        `siret` column, that is None for the structures without match. It may also
+        have the `SCORE_COLUMNS` of the matches.
+        """
+
+        raise NotImplementedError
+
+
+def is_searchable(structures_df: pd.DataFrame) -> pd.Series:
+    """Whether the structures have the data required to search an establishment."""
+
+    return (
+        structures_df[["nom", "adresse", "code_insee", "latitude", "longitude"]]
+        .notna()
+        .all(axis="columns")
+        & (structures_df.nom != "")
+        & (structures_df.adresse != "")
+        & (structures_df.code_insee != "")
+    )
+
+
+# prepared once per connection, see `create_engine`
+SEARCH_STATEMENT_NAME = "search_establishment"
+SEARCH_STATEMENT = textwrap.dedent(
+    """
+    PREPARE search_establishment(text, text, text, float8, float8) AS
+    SELECT
+        siret,
+        ST_Distance(location, ST_MakePoint($4, $5) :: geography) AS distance,
+        similarity(address1, $2) AS address_similarity,
+        similarity(name, $1) AS name_similarity
+    FROM
+        sirene_establishment
+    WHERE
+        department = $3
+        AND ST_DWithin(location, ST_MakePoint($4, $5) :: geography, {location_within_meters})
+        AND name % $1
+    ORDER BY name_similarity DESC
+    LIMIT 1
+    """  # noqa: E501
+).format(location_within_meters=LOCATION_WITHIN_METERS)
+
+
+@dataclasses.dataclass
+class StatementStats:
+    """Number of executions and cumulated duration of the statements, by name."""
+
+    counts: collections.Counter = dataclasses.field(default_factory=collections.Counter)
+    elapsed_seconds: collections.Counter = dataclasses.field(
+        default_factory=collections.Counter
+    )
+    lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    @contextlib.contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.counts[name] += 1
+                self.elapsed_seconds[name] += time.perf_counter() - started_at
+
+    def log(self, logger: logging.Logger = logger):
+        logger.info("Statistiques des requêtes:")
+        for name, count in self.counts.most_common():
+            elapsed_seconds = self.elapsed_seconds[name]
+            logger.info(
+                f"\t{name}: {count} exécutions en {elapsed_seconds:.1f}s "
+                f"({1000 * elapsed_seconds / count:.1f}ms/exécution)"
+            )
+
+
+def create_engine(url: str, stats: StatementStats, pool_size: int = 5) -> Engine:
+    """Engine whose connections have the search statement prepared.
+
+    The statement relies on the columns and indexes created by `sirene.migrate`.
+    """
+
+    engine = slqa.create_engine(url, pool_size=pool_size, max_overflow=0)
+
+    @slqa.event.listens_for(engine, "connect")
+    def prepare(dbapi_connection, connection_record):
+        with stats.timed("prepare"):
+            # outside of any transaction, whose rollback would revert the `SET`
+            autocommit = dbapi_connection.autocommit
+            dbapi_connection.autocommit = True
+            try:
+                cursor = dbapi_connection.cursor()
+                # the threshold of the indexed `%` operator
+                cursor.execute(
+                    f"SET pg_trgm.similarity_threshold = {NAME_SIMILARITY_THRESHOLD}"
+                )
+                cursor.execute(SEARCH_STATEMENT)
+                cursor.close()
+            finally:
+                dbapi_connection.autocommit = autocommit
+
+    return engine
+
+
+def check_search_plan(engine: Engine) -> bool:
+    """Check that the search queries are planned with the siretisation indexes.
+
+    Both the prepared statement and the batch query are explained.
+    """
+
+    structure = {
+        "nom": "mairie",
+        "adresse": "place de la mairie",
+        "code_insee": "75056",
+        "latitude": 48.85,
+        "longitude": 2.35,
+    }
+
+    index_names_by_query = {}
+    with engine.begin() as connection:
+        index_names_by_query[SEARCH_STATEMENT_NAME] = sirene.explain(
+            connection,
+            f"EXECUTE {SEARCH_STATEMENT_NAME}"
+            "(:nom, :adresse, :department, :longitude, :latitude)",
+            {**structure, "department": structure["code_insee"][:2]},
+        )
+
+        create_structures_table(connection, pd.DataFrame([structure]))
+        index_names_by_query["search_establishments"] = sirene.explain(
+            connection, BATCH_SEARCH_QUERY, BATCH_SEARCH_PARAMS
+        )
+
+    used = True
+    for query_name, index_names in index_names_by_query.items():
+        logger.info(
+            "Indexes used by %s: %s", query_name, ", ".join(sorted(index_names))
+        )
+        if index_names.isdisjoint(sirene.INDEXES):
+            logger.warning(
+                "%s does not use any of the siretisation indexes", query_name
+            )
+            used = False
+    return used
 
 
 def search_establishment(
@@ -23,7 +190,8 @@ def search_establishment(
     code_insee: str,
     latitude: float,
     longitude: float,
-    engine: Engine,
+    connection: Connection,
+    stats: StatementStats,
 ) -> Optional[dict]:
     if not all([nom, adresse, code_insee]):
         logger.debug("Missing data")
@@ -32,83 +200,688 @@ def search_establishment(
         logger.debug("Missing coordinates")
         return None
 
-    cog_department_str = code_insee[:2]
-    normalized_name_str = nom.replace("'", " ")
-    normalized_address_str = adresse.replace("'", " ")
-    location_within_meters_int = 1000
-    name_similarity_threshold_float = 0.6
-
-    nearest_establishments_query_str = textwrap.dedent(
-        f"""
-        SELECT
-            *,
-            ST_Distance(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) :: geography,ST_SetSRID(ST_MakePoint({longitude}, {latitude}), 4326) :: geography) AS distance,
-            similarity(address1, '{normalized_address_str}') as address_similarity,
-            similarity(name, '{normalized_name_str}') as name_similarity
-        FROM
-            sirene_establishment
-        WHERE
-            city_code ~ '^{cog_department_str}'
-            AND ST_Distance(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) :: geography,ST_SetSRID(ST_MakePoint({longitude}, {latitude}), 4326) :: geography) < {location_within_meters_int}
-        ORDER BY name_similarity DESC;
-        """  # noqa: E501
-    )
-
-    logger.debug(nearest_establishments_query_str)
-
-    establishments_df = pd.read_sql(
-        nearest_establishments_query_str,
-        engine,
-    )
+    with stats.timed(SEARCH_STATEMENT_NAME):
+        establishment = (
+            connection.execute(
+                slqa.text(
+                    f"EXECUTE {SEARCH_STATEMENT_NAME}"
+                    "(:nom, :adresse, :department, :longitude, :latitude)"
+                ),
+                {
+                    "nom": nom,
+                    "adresse": adresse,
+                    "department": code_insee[:2],
+                    "longitude": float(longitude),
+                    "latitude": float(latitude),
+                },
+            )
+            .mappings()
+            .first()
+        )
 
-    if len(establishments_df) == 0:
+    if establishment is None:
         logger.debug("No establishment with similar address within 1km")
         return None
 
     # considering only establishments that would match the position,
     # is there any close match on the name ?
-    if establishments_df.iloc[0].name_similarity < name_similarity_threshold_float:
+    if establishment["name_similarity"] < NAME_SIMILARITY_THRESHOLD:
         logger.debug("No establishment with similar address and name within 1km")
         return None
 
-    return establishments_df.iloc[0].to_dict()
+    return dict(establishment)
+
+
+BATCH_SEARCH_QUERY = textwrap.dedent(
+    """
+    SELECT
+        structures.position,
+        establishments.siret,
+        establishments.name_similarity,
+        establishments.address_similarity,
+        establishments.distance
+    FROM
+        structures_to_siretize AS structures
+        CROSS JOIN LATERAL (
+            SELECT
+                siret,
+                similarity(name, structures.nom) AS name_similarity,
+                similarity(address1, structures.adresse) AS address_similarity,
+                ST_Distance(location, ST_MakePoint(structures.longitude, structures.latitude) :: geography) AS distance
+            FROM
+                sirene_establishment
+            WHERE
+                department = structures.department
+                AND ST_DWithin(location, ST_MakePoint(structures.longitude, structures.latitude) :: geography, :location_within_meters)
+                AND name % structures.nom
+            ORDER BY name_similarity DESC
+            LIMIT 1
+        ) AS establishments
+    WHERE
+        establishments.name_similarity >= :name_similarity_threshold
+    """  # noqa: E501
+)
+BATCH_SEARCH_PARAMS = {
+    "location_within_meters": LOCATION_WITHIN_METERS,
+    # in case `pg_trgm.similarity_threshold` is not set on the connection
+    "name_similarity_threshold": NAME_SIMILARITY_THRESHOLD,
+}
+
+
+def create_structures_table(connection: Connection, structures_df: pd.DataFrame):
+    """Insert the searchable structures in the temporary table of the batch query.
+
+    The table is dropped at the end of the transaction.
+    """
+
+    structures_df = structures_df[is_searchable(structures_df)]
+
+    structures_table = slqa.Table(
+        "structures_to_siretize",
+        slqa.MetaData(),
+        slqa.Column("position", slqa.Integer, primary_key=True),
+        slqa.Column("nom", slqa.Text),
+        slqa.Column("adresse", slqa.Text),
+        slqa.Column("department", slqa.Text),
+        slqa.Column("latitude", slqa.Float),
+        slqa.Column("longitude", slqa.Float),
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+
+    structures_table.create(connection)
+    if len(structures_df) > 0:
+        connection.execute(
+            structures_table.insert(),
+            [
+                {
+                    "position": int(row.Index),
+                    "nom": row.nom,
+                    "adresse": row.adresse,
+                    "department": row.code_insee[:2],
+                    "latitude": float(row.latitude),
+                    "longitude": float(row.longitude),
+                }
+                for row in structures_df.itertuples()
+            ],
+        )
+    connection.execute(slqa.text(f"ANALYZE {structures_table.name}"))
+
+
+def search_establishments(
+    structures_df: pd.DataFrame,
+    engine: Engine,
+    stats: StatementStats,
+    progress_bar: Optional[tqdm] = None,
+    chunk_size: int = 1000,
+) -> pd.DataFrame:
+    """Find the best matching establishment of each structure, in a single query.
+
+    The structures are inserted in a temporary table, that is joined laterally to
+    the establishments. Structures without match are absent from the result, that
+    is a dataframe of the sirets and `SCORE_COLUMNS`, with the (integer) index of the
+    structures.
+    """
+
+    records = []
+    with engine.begin() as connection:
+        create_structures_table(connection, structures_df)
+
+        with stats.timed("search_establishments"):
+            result = connection.execution_options(stream_results=True).execute(
+                slqa.text(BATCH_SEARCH_QUERY), BATCH_SEARCH_PARAMS
+            )
+            for rows in result.partitions(chunk_size):
+                records.extend(rows)
+
+    if progress_bar is not None:
+        progress_bar.update(len(structures_df))
+
+    return pd.DataFrame.from_records(
+        records, columns=["position", "siret", *SCORE_COLUMNS], index="position"
+    )
+
+
+def search_establishments_row_by_row(
+    structures_df: pd.DataFrame,
+    engine: Engine,
+    stats: StatementStats,
+    progress_bar: Optional[tqdm] = None,
+) -> pd.DataFrame:
+    """Find the best matching establishment of each structure, one by one."""
+
+    establishments = {}
+    with engine.connect() as connection:
+        for row in structures_df.itertuples():
+            establishment = search_establishment(
+                nom=row.nom,
+                adresse=row.adresse,
+                code_insee=row.code_insee,
+                latitude=row.latitude,
+                longitude=row.longitude,
+                connection=connection,
+                stats=stats,
+            )
+            if establishment is not None:
+                establishments[row.Index] = establishment
+            if progress_bar is not None:
+                progress_bar.update(1)
+
+    return pd.DataFrame.from_dict(
+        establishments, orient="index", columns=["siret", *SCORE_COLUMNS]
+    )
+
+
+EXACT_MATCH_QUERY = textwrap.dedent(
+    """
+    WITH candidates AS (
+        SELECT structures.position, 0 AS priority, establishments.siret
+        FROM
+            structures_to_match AS structures
+            JOIN sirene_establishment AS establishments
+                ON establishments.city_code = structures.city_code
+                AND establishments.name_key = structures.name_key
+        UNION ALL
+        SELECT structures.position, 1 AS priority, establishments.siret
+        FROM
+            structures_to_match AS structures
+            JOIN sirene_establishment AS establishments
+                ON establishments.siren = structures.parent_siren
+                AND establishments.city_code = structures.city_code
+    ),
+    unambiguous_candidates AS (
+        SELECT position, priority, min(siret) AS siret
+        FROM candidates
+        GROUP BY position, priority
+        HAVING count(DISTINCT siret) = 1
+    )
+    SELECT DISTINCT ON (position) position, siret
+    FROM unambiguous_candidates
+    ORDER BY position, priority
+    """
+)
+
+
+def parent_sirens(structures_df: pd.DataFrame) -> pd.Series:
+    """Siren of the parent structure of each structure, when it has a siret."""
+
+    siret_by_id = (
+        structures_df[structures_df.id.notna() & structures_df.siret.notna()]
+        .drop_duplicates(subset="id")
+        .set_index("id")
+        .siret
+    )
+    sirens = structures_df.structure_parente.map(siret_by_id).str[:9]
+    return sirens.where(sirens.notna(), None)
+
+
+def match_exactly(
+    structures_df: pd.DataFrame, engine: Engine, stats: StatementStats
+) -> pd.DataFrame:
+    """Find the establishment matching exactly each structure, in a single query.
+
+    An establishment matches a structure when it is in the same commune, and it is
+    the only one either with the same `sirene.name_key` or, failing that, with the
+    siren of its parent structure (in the optional `parent_siren` column).
+    Structures without match are absent from the result, that is a dataframe of the
+    sirets, with the (integer) index of the structures.
+    """
+
+    structures_df = structures_df.assign(
+        name_key=structures_df.nom.map(sirene.name_key),
+        parent_siren=structures_df.get("parent_siren"),
+    )
+    structures_df = structures_df[
+        structures_df.code_insee.notna()
+        & ((structures_df.name_key != "") | structures_df.parent_siren.notna())
+    ]
+
+    structures_table = slqa.Table(
+        "structures_to_match",
+        slqa.MetaData(),
+        slqa.Column("position", slqa.Integer, primary_key=True),
+        slqa.Column("name_key", slqa.Text),
+        slqa.Column("city_code", slqa.Text),
+        slqa.Column("parent_siren", slqa.Text),
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+
+    with engine.begin() as connection:
+        structures_table.create(connection)
+        if len(structures_df) > 0:
+            connection.execute(
+                structures_table.insert(),
+                [
+                    {
+                        "position": int(row.Index),
+                        "name_key": row.name_key,
+                        "city_code": row.code_insee,
+                        "parent_siren": row.parent_siren,
+                    }
+                    for row in structures_df.itertuples()
+                ],
+            )
+        connection.execute(slqa.text(f"ANALYZE {structures_table.name}"))
+
+        with stats.timed("match_exactly"):
+            records = connection.execute(slqa.text(EXACT_MATCH_QUERY)).fetchall()
+
+    return pd.DataFrame.from_records(
+        records, columns=["position", "siret"], index="position"
+    )
+
+
+class PostgresSiretisationBackend(SiretisationBackend):
+    """Match the structures against the `sirene_establishment` table.
+
+    With `exact`, the structures are first matched exactly, with `match_exactly`.
+    The remaining ones are then searched : in `batch` mode, in a single query, or
+    else each structure with its own query. The engine pool has `pool_size`
+    connections, one per concurrent call.
+    """
+
+    def __init__(
+        self, url: str, batch: bool = True, exact: bool = True, pool_size: int = 5
+    ):
+        self.batch = batch
+        self.exact = exact
+        self._stats = StatementStats()
+        self.engine = create_engine(url, stats=self._stats, pool_size=pool_size)
+
+    @property
+    def stats(self) -> Optional[StatementStats]:
+        return self._stats
+
+    def match_batch(self, structures_df: pd.DataFrame) -> pd.DataFrame:
+        exact_df = pd.DataFrame(columns=["siret"], dtype=object)
+        if self.exact:
+            exact_df = match_exactly(
+                structures_df, engine=self.engine, stats=self._stats
+            )
+
+        searched_df = (
+            search_establishments if self.batch else search_establishments_row_by_row
+        )(
+            structures_df.drop(index=exact_df.index),
+            engine=self.engine,
+            stats=self._stats,
+        )
+        results_df = (
+            pd.concat([exact_df, searched_df])
+            .reindex(structures_df.index)
+            .astype(object)
+        )
+        return results_df.where(results_df.notna(), None)
+
+
+# about 10 meters
+COORDINATES_DECIMALS = 4
+
+
+def structure_keys(structures_df: pd.DataFrame) -> pd.Series:
+    """Normalized (nom, adresse, code_insee, latitude, longitude, parent_siren) of
+    the structures.
+
+    The coordinates are rounded to `COORDINATES_DECIMALS` decimals. Missing values
+    are None.
+    """
+
+    def round_coordinate(value) -> Optional[float]:
+        return round(float(value), COORDINATES_DECIMALS) if pd.notna(value) else None
+
+    parent_sirens = structures_df.get(
+        "parent_siren", pd.Series(None, index=structures_df.index, dtype=object)
+    )
+
+    return pd.Series(
+        [
+            (
+                utils.normalize_str(row.nom),
+                utils.normalize_address(row.adresse),
+                utils.normalize_str(row.code_insee),
+                round_coordinate(row.latitude),
+                round_coordinate(row.longitude),
+                parent_siren if pd.notna(parent_siren) else None,
+            )
+            for row, parent_siren in zip(structures_df.itertuples(), parent_sirens)
+        ],
+        index=structures_df.index,
+        dtype=object,
+    )
+
+
+class SiretisationCache:
+    """Persistent cache of the siretisation results.
+
+    Results are stored in a sqlite database, keyed on the `structure_keys`.
+    Structures without match are cached too, so that only the new or changed
+    structures are searched. Structures that are not searchable, that can still be
+    matched exactly, are not cached.
+
+    Entries older than `ttl`, or than the last refresh of the SIRENE database, are
+    discarded.
+    """
+
+    SCHEMA_VERSION = 3
+
+    # values cached for each key
+    COLUMNS = {
+        "siret": "TEXT",
+        "name_similarity": "REAL",
+        "address_similarity": "REAL",
+        "distance": "REAL",
+    }
+
+    def __init__(
+        self,
+        path: Path,
+        ttl: Optional[timedelta] = None,
+        sirene_refreshed_at: Optional[datetime] = None,
+    ):
+        self.ttl = ttl
+        self.sirene_refreshed_at = sirene_refreshed_at
+        self.cache = utils.SqliteCache(
+            path,
+            table="siretisation_cache",
+            columns=self.COLUMNS,
+            schema_version=self.SCHEMA_VERSION,
+        )
+
+    def evict(self):
+        expired_before = [
+            (datetime.now() - self.ttl).timestamp() if self.ttl is not None else None,
+            self.sirene_refreshed_at.timestamp()
+            if self.sirene_refreshed_at is not None
+            else None,
+        ]
+        expired_before = [t for t in expired_before if t is not None]
+        if len(expired_before) == 0:
+            return
+
+        self.cache.evict(created_before=max(expired_before))
+
+    def match_batch(
+        self,
+        structures_df: pd.DataFrame,
+        search_fn: Callable[[pd.DataFrame], pd.DataFrame],
+    ) -> pd.DataFrame:
+        """Results of the structures, only searching the cache misses.
+
+        `search_fn` has the same contract as `SiretisationBackend.match_batch`, except
+        that structures without match may be absent from its result.
+        """
+
+        searchable = is_searchable(structures_df)
+        keys = structure_keys(structures_df[searchable]).map(json.dumps)
+
+        self.evict()
+        cached_df = self.cache.get_many(keys.unique())
+
+        # search a single structure per missing key
+        missing_keys = keys[~keys.isin(cached_df.index) & ~keys.duplicated()]
+
+        logger.info(
+            "Siretisation cache: %d hits, %d misses",
+            len(cached_df),
+            len(missing_keys),
+        )
+
+        uncached_index = structures_df.index[~searchable]
+        fetched_df = search_fn(
+            structures_df.loc[missing_keys.index.append(uncached_index)]
+        ).reindex(columns=list(self.COLUMNS))
+        fetched_df = fetched_df.astype(object).where(fetched_df.notna(), None)
+
+        missing_df = fetched_df.reindex(missing_keys.index).set_index(
+            pd.Index(missing_keys.to_numpy())
+        )
+        self.cache.set_many(missing_df)
+        cached_df = pd.concat([cached_df, missing_df])
+
+        results_df = pd.concat(
+            [
+                cached_df.reindex(keys).set_index(keys.index),
+                fetched_df.reindex(uncached_index),
+            ]
+        ).astype(object)
+        return results_df.where(results_df.notna(), None)
+
+
+class RecordingSiretisationBackend(SiretisationBackend):
+    """Record the results of another backend, to be replayed later.
+
+    The results are appended to a json lines file, one record per structure, with
+    its `structure_keys`.
+    """
+
+    def __init__(self, backend: SiretisationBackend, path: Path):
+        self.backend = backend
+        self.path = path
+        self.lock = threading.Lock()
+
+    @property
+    def stats(self) -> Optional[StatementStats]:
+        return self.backend.stats
+
+    def match_batch(self, structures_df: pd.DataFrame) -> pd.DataFrame:
+        results_df = self.backend.match_batch(structures_df)
+
+        records_df = results_df.reindex(
+            index=structures_df.index, columns=["siret", *SCORE_COLUMNS]
+        )
+        records_df = records_df.astype(object).where(records_df.notna(), None)
+        records_df.insert(0, "key", structure_keys(structures_df))
+
+        if len(records_df) > 0:
+            lines = records_df.to_json(orient="records", lines=True, force_ascii=False)
+            with self.lock, self.path.open("a") as f:
+                f.write(lines.rstrip("\n") + "\n")
+
+        return results_df
+
+
+class ReplayingSiretisationBackend(SiretisationBackend):
+    """Replay the results recorded by a `RecordingSiretisationBackend`.
+
+    Structures missing from the recording have no match. They are counted in
+    `misses`.
+    """
+
+    def __init__(self, path: Path):
+        records_df = pd.read_json(
+            path, orient="records", lines=True, dtype=False, precise_float=True
+        )
+        records_df = records_df.reindex(columns=["key", "siret", *SCORE_COLUMNS])
+        records_df = records_df.astype(object).where(records_df.notna(), None)
+        self.records_by_key = {
+            tuple(record[0]): record[1:]
+            for record in records_df.itertuples(index=False, name=None)
+        }
+        self.misses = 0
+
+    def match_batch(self, structures_df: pd.DataFrame) -> pd.DataFrame:
+        keys = structure_keys(structures_df)
+        self.misses += sum(key not in self.records_by_key for key in keys)
+
+        records = {
+            index: self.records_by_key[key]
+            for index, key in keys.items()
+            if key in self.records_by_key
+        }
+        return (
+            pd.DataFrame.from_dict(
+                records, orient="index", columns=["siret", *SCORE_COLUMNS]
+            )
+            .reindex(structures_df.index)
+            .astype(object)
+        )
 
 
 def siretize_normalized_data(
     path: Path,
+    siretisation_backend: SiretisationBackend,
+    workers: int = 1,
+    siretisation_cache: Optional[SiretisationCache] = None,
+    sample: Optional[int] = None,
+    chunk_size: int = 10_000,
 ) -> Path:
+    """Siretize the structures of a file that have neither siret nor rna.
+
+    The structures are processed by chunks, whose results are appended to a
+    checkpoint file. An interrupted run resumes from the structures missing from the
+    checkpoint, which is removed once the output is written. The checkpoint is
+    named after a hash of the input content : the checkpoints of other contents for
+    the same file name are discarded.
+
+    With `sample`, only a random sample of the structures is processed, without
+    checkpoint.
+    """
+
     logger.info("[SIRETISATION]")
     output_path = Path(f"./{path.stem}.siret.json")
+    checkpoint_path = Path(f"./{path.stem}.{file_digest(path)}.siret.checkpoint.csv")
+    # only the checkpoints of this very file name, not those of e.g.
+    # `{path.stem}.geocoded.json`
+    checkpoint_name_pattern = re.compile(
+        re.escape(path.stem) + r"\.[0-9a-f]{16}\.siret\.checkpoint\.csv"
+    )
+    for stale_checkpoint_path in Path(".").glob(f"{path.stem}.*.siret.checkpoint.csv"):
+        if (
+            checkpoint_name_pattern.fullmatch(stale_checkpoint_path.name)
+            and stale_checkpoint_path.name != checkpoint_path.name
+        ):
+            logger.info("Discarding the stale checkpoint %s", stale_checkpoint_path)
+            stale_checkpoint_path.unlink()
     input_df = pd.read_json(path, dtype=False).replace(np.nan, None)
-    output_df = siretize_normalized_dataframe(input_df.sample(50))
-    output_df.to_json(output_path, orient="records", force_ascii=False)
+    input_df = input_df.reset_index(drop=True)
+    # from the whole file, as the parents are not necessarily siretized here
+    structures_df = input_df.assign(parent_siren=parent_sirens(input_df))
+
+    if sample is not None:
+        output_df = siretize_normalized_dataframe(
+            structures_df.sample(min(sample, len(structures_df))),
+            siretisation_backend=siretisation_backend,
+            workers=workers,
+            siretisation_cache=siretisation_cache,
+        ).drop(columns="parent_siren")
+        output_df.to_json(output_path, orient="records", force_ascii=False)
+        return output_path
+    to_siretize = input_df.siret.isna() & input_df.rna.isna()
+
+    sirets = read_checkpoint(checkpoint_path)
+    positions = np.flatnonzero(to_siretize & ~input_df.index.isin(sirets.index))
+    logger.info(
+        "%d structures to siretize, %d already in %s",
+        to_siretize.sum(),
+        to_siretize.sum() - len(positions),
+        checkpoint_path,
+    )
+
+    for start in range(0, len(positions), chunk_size):
+        chunk_df = siretize_normalized_dataframe(
+            structures_df.iloc[positions[start : start + chunk_size]],
+            siretisation_backend=siretisation_backend,
+            workers=workers,
+            siretisation_cache=siretisation_cache,
+        )
+        write_checkpoint(checkpoint_path, chunk_df.siret)
+
+    sirets = read_checkpoint(checkpoint_path).reindex(input_df.index)
+    input_df["siret"] = input_df.siret.where(~to_siretize, sirets)
+    input_df["siret"] = input_df.siret.where(input_df.siret.notna(), None)
+    input_df.to_json(output_path, orient="records", force_ascii=False)
+    checkpoint_path.unlink(missing_ok=True)
+
     return output_path
 
 
+def file_digest(path: Path, chunk_size: int = 2**20) -> str:
+    """Short hash of the content of a file."""
+
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def read_checkpoint(path: Path) -> pd.Series:
+    """Sirets of the structures already processed, by position, None if unmatched."""
+
+    if not path.exists():
+        return pd.Series(dtype=object)
+
+    checkpoint_df = pd.read_csv(
+        path, dtype={"siret": str}, keep_default_na=False
+    ).drop_duplicates(subset="position", keep="last")
+    return checkpoint_df.set_index("position").siret.replace({"": None}).astype(object)
+
+
+def write_checkpoint(path: Path, sirets: pd.Series):
+    """Append the sirets of the given structures, indexed by position."""
+
+    sirets.rename("siret").rename_axis("position").to_csv(
+        path, mode="a", header=not path.exists()
+    )
+
+
 def siretize_normalized_dataframe(
     structures_df: pd.DataFrame,
+    siretisation_backend: SiretisationBackend,
+    workers: int = 1,
+    siretisation_cache: Optional[SiretisationCache] = None,
 ) -> pd.DataFrame:
+    """Add the siret of the matching establishment to the structures.
+
+    The structures are partitioned by department, and the partitions are matched
+    concurrently by `workers` threads, with the given `siretisation_backend`.
+
+    With a `siretisation_cache`, only the structures missing from the cache are
+    matched.
+    """
+
     utils.log_df_info(structures_df, logger)
 
-    if settings.SIRENE_DATABASE_URL is None:
-        raise Exception("SIRENE_DATABASE_URL not configured.")
+    def search_partition(partition_df, progress_bar):
+        results_df = siretisation_backend.match_batch(partition_df)
+        progress_bar.update(len(partition_df))
+        return results_df
 
-    engine = slqa.create_engine(settings.SIRENE_DATABASE_URL)
+    def search(positions_df: pd.DataFrame) -> pd.DataFrame:
+        partitions = [
+            partition_df
+            for _, partition_df in positions_df.groupby(
+                positions_df.code_insee.str[:2], dropna=False, sort=False
+            )
+        ]
 
-    establishments_df = structures_df.progress_apply(
-        lambda row: search_establishment(
-            nom=row.nom,
-            adresse=row.adresse,
-            code_insee=row.code_insee,
-            latitude=row.latitude,
-            longitude=row.longitude,
-            engine=engine,
-        )
-        or {"siret": None},
-        axis="columns",
-        result_type="expand",
+        with tqdm(total=len(positions_df)) as progress_bar:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                results_list = list(
+                    executor.map(
+                        lambda partition_df: search_partition(
+                            partition_df, progress_bar
+                        ),
+                        partitions,
+                    )
+                )
+
+        return pd.concat([pd.DataFrame(columns=["siret"], dtype=object)] + results_list)
+
+    positions_df = structures_df.reset_index(drop=True)
+    if siretisation_cache is not None:
+        results_df = siretisation_cache.match_batch(positions_df, search_fn=search)
+    else:
+        results_df = search(positions_df)
+
+    sirets = results_df.siret.reindex(positions_df.index)
+    structures_df = structures_df.assign(
+        siret=sirets.where(sirets.notna(), None).to_numpy()
     )
 
+    if siretisation_backend.stats is not None:
+        siretisation_backend.stats.log(logger)
     utils.log_df_info(structures_df, logger)
 
-    return structures_df.assign(siret=lambda _: establishments_df.siret)
+    return structures_df
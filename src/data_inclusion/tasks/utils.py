@@ -1,13 +1,247 @@
+import collections
+import concurrent.futures
 import io
 import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
 
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+U = TypeVar("U")
+
 
 def log_df_info(df: pd.DataFrame, logger: logging.Logger = logger):
     buf = io.StringIO()
     df.info(buf=buf)
     for line in buf.getvalue().splitlines():
         logger.info(line)
+
+
+def normalize_str(s: Optional[str]) -> str:
+    """Normalize a free text value, for comparison purposes.
+
+    Lowercase, strip accents, and collapse punctuation and whitespaces.
+    """
+
+    if s is None:
+        return ""
+
+    s = unicodedata.normalize("NFKD", str(s))
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    s = re.sub(r"[\W_]+", " ", s.lower())
+    return s.strip()
+
+
+# common abbreviations found in addresses, mostly street types
+ADDRESS_ABBREVIATIONS = {
+    "all": "allee",
+    "av": "avenue",
+    "ave": "avenue",
+    "bd": "boulevard",
+    "bld": "boulevard",
+    "bvd": "boulevard",
+    "ch": "chemin",
+    "che": "chemin",
+    "chem": "chemin",
+    "crs": "cours",
+    "fbg": "faubourg",
+    "imp": "impasse",
+    "lot": "lotissement",
+    "pl": "place",
+    "pte": "porte",
+    "qu": "quai",
+    "res": "residence",
+    "rte": "route",
+    "sq": "square",
+    "st": "saint",
+    "ste": "sainte",
+}
+
+
+def normalize_address(s: Optional[str]) -> str:
+    """Normalize an address, commune name, etc. for comparison purposes.
+
+    On top of `normalize_str`, expand the common abbreviations.
+    """
+
+    return " ".join(
+        ADDRESS_ABBREVIATIONS.get(token, token) for token in normalize_str(s).split()
+    )
+
+
+def ordered_map(
+    fn: Callable[[T], U], iterable: Iterable[T], max_workers: int
+) -> Iterator[U]:
+    """Concurrent equivalent of `map`, preserving the input order.
+
+    Unlike `Executor.map`, items are consumed lazily : at most `max_workers` items
+    are pending at a time.
+    """
+
+    iterator = iter(iterable)
+    exhausted = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        while True:
+            # only pull the next items once a slot is available
+            while not exhausted and len(pending) < max_workers:
+                try:
+                    pending.append(executor.submit(fn, next(iterator)))
+                except StopIteration:
+                    exhausted = True
+
+            if len(pending) == 0:
+                return
+
+            yield pending.popleft().result()
+
+
+class SqliteCache:
+    """Key/value cache in a table of a sqlite database.
+
+    Keys are strings, and values are rows of the `columns` (a mapping of the column
+    names to their sqlite definitions). The creation and last access of each entry
+    are timestamped, for the callers to evict expired entries. When `max_entries` is
+    set, the least recently used entries are evicted beyond that size.
+
+    Entries cached with a previous `schema_version` are discarded. The cache can be
+    shared between threads.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        table: str,
+        columns: dict[str, str],
+        schema_version: int,
+        max_entries: Optional[int] = None,
+    ):
+        self.path = path
+        self.table = table
+        self.columns = columns
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        if version < schema_version:
+            self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self.connection.execute(f"PRAGMA user_version = {schema_version}")
+
+        column_definitions = "".join(
+            f"{name} {definition}, " for name, definition in columns.items()
+        )
+        self.connection.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                {column_definitions}
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at);
+            CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at);
+            """
+        )
+
+    def get_many(self, keys: Iterable[str]) -> pd.DataFrame:
+        """Cached values of the given keys, indexed by key."""
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS {self.table}_keys (key TEXT)"
+            )
+            self.connection.execute(f"DELETE FROM {self.table}_keys")
+            self.connection.executemany(
+                f"INSERT INTO {self.table}_keys VALUES (?)", ((key,) for key in keys)
+            )
+            self.connection.execute(
+                f"""
+                UPDATE {self.table} SET accessed_at = ?
+                WHERE key IN (SELECT key FROM {self.table}_keys)
+                """,
+                (time.time(),),
+            )
+            rows = self.connection.execute(
+                f"""
+                SELECT key, {", ".join(self.columns)}
+                FROM {self.table}
+                JOIN {self.table}_keys USING (key)
+                """
+            ).fetchall()
+        return pd.DataFrame.from_records(
+            rows, columns=["key", *self.columns], index="key"
+        )
+
+    def set_many(self, values_df: pd.DataFrame):
+        """Cache the values of `values_df`, indexed by key, with the `columns`."""
+
+        now = time.time()
+        values_df = values_df[list(self.columns)].astype(object)
+        values_df = values_df.where(values_df.notna(), None)
+        placeholders = ", ".join(["?"] * (len(self.columns) + 3))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})",
+                (
+                    (key, *values, now, now)
+                    for key, *values in values_df.itertuples(name=None)
+                ),
+            )
+            if self.max_entries is not None:
+                self.connection.execute(
+                    f"""
+                    DELETE FROM {self.table} WHERE rowid IN (
+                        SELECT rowid FROM {self.table}
+                        ORDER BY accessed_at DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,),
+                )
+
+    def evict(self, created_before: float):
+        """Delete the entries created before the given timestamp."""
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"DELETE FROM {self.table} WHERE created_at < ?", (created_before,)
+            )
+
+    def export(self, path: Path):
+        """Copy the cache content to a standalone sqlite file."""
+
+        with self.lock, sqlite3.connect(path) as target:
+            self.connection.backup(target)
+
+    def import_(self, path: Path):
+        """Merge the content of an exported cache file, keeping the newest entries."""
+
+        updates = ", ".join(
+            f"{name} = excluded.{name}"
+            for name in [*self.columns, "created_at", "accessed_at"]
+        )
+        with self.lock:
+            self.connection.execute("ATTACH DATABASE ? AS imported", (str(path),))
+            try:
+                with self.connection:
+                    self.connection.execute(
+                        f"""
+                        INSERT INTO {self.table}
+                        SELECT * FROM imported.{self.table} WHERE true
+                        ON CONFLICT (key) DO UPDATE SET {updates}
+                        WHERE excluded.created_at > {self.table}.created_at
+                        """
+                    )
+            finally:
+                self.connection.execute("DETACH DATABASE imported")
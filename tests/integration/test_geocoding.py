@@ -31,6 +31,8 @@ def ban_backend():
                     id="1",
                     code_insee="59350",
                     score=mock.ANY,
+                    latitude=mock.ANY,
+                    longitude=mock.ANY,
                 )
             ],
         ),
@@ -0,0 +1,96 @@
+import os
+
+import pandas as pd
+import pytest
+import sqlalchemy as slqa
+
+from data_inclusion.tasks import sirene, sirene_stock, siretisation
+
+pytestmark = pytest.mark.sirene_db
+
+
+@pytest.fixture
+def engine():
+    """Engine of a disposable postgis database, with the pg_trgm extension."""
+
+    url = os.environ.get("SIRENE_TEST_DATABASE_URL")
+    if url is None:
+        pytest.skip("SIRENE_TEST_DATABASE_URL not configured.")
+
+    with slqa.create_engine(url).begin() as connection:
+        # as loaded by `sirene_stock.load_sirene_stock`
+        sirene.create_extensions(connection)
+        sirene_stock.create_table(connection, generated_columns=sirene.COLUMNS)
+        connection.execute(
+            slqa.text(
+                "INSERT INTO sirene_establishment "
+                "(siret, name, address1, city_code, longitude, latitude) VALUES "
+                "(:siret, :name, :address1, :city_code, :longitude, :latitude)"
+            ),
+            [
+                {
+                    "siret": "11111111100011",
+                    "name": "MAIRIE DE RENNES",
+                    "address1": "PL DE LA MAIRIE",
+                    "city_code": "35238",
+                    "longitude": -1.6794,
+                    "latitude": 48.1113,
+                },
+                {
+                    "siret": "22222222200022",
+                    "name": "MAIRIE DE RENNES ANNEXE",
+                    "address1": "RUE DE PARIS",
+                    "city_code": "35238",
+                    "longitude": -1.65,
+                    "latitude": 48.11,
+                },
+                {
+                    "siret": "33333333300033",
+                    "name": "CENTRE SOCIAL DU BLOSNE",
+                    "address1": "BD DE YOUGOSLAVIE",
+                    "city_code": "35051",
+                    "longitude": -1.6601,
+                    "latitude": 48.0856,
+                },
+            ],
+        )
+        sirene.create_indexes(connection)
+
+    return siretisation.create_engine(url, stats=siretisation.StatementStats())
+
+
+def test_search_establishments(engine):
+    structures_df = pd.DataFrame(
+        [
+            ("Mairie de Rennes", "Place de la Mairie", "35238", 48.1110, -1.6790),
+            # the establishment in another department is ignored
+            ("Centre social du Blosne", "Bd de Yougoslavie", "35238", 48.086, -1.660),
+            # not similar enough
+            ("Epicerie solidaire", "Place de la Mairie", "35238", 48.1110, -1.6790),
+            # missing data
+            ("Mairie de Rennes", None, "35238", 48.1110, -1.6790),
+        ],
+        columns=["nom", "adresse", "code_insee", "latitude", "longitude"],
+        index=[3, 1, 4, 5],
+    )
+    stats = siretisation.StatementStats()
+
+    output_df = siretisation.search_establishments(
+        structures_df, engine=engine, stats=stats
+    )
+
+    assert output_df.index.to_list() == [3]
+    assert output_df.siret.to_list() == ["11111111100011"]
+    # pg_trgm ignores the case
+    assert output_df.name_similarity[3] == pytest.approx(1.0)
+    assert output_df.distance[3] < 100
+
+    # the same matches as the prepared statement
+    row_by_row_df = siretisation.search_establishments_row_by_row(
+        structures_df, engine=engine, stats=stats
+    )
+    assert row_by_row_df.siret.to_dict() == output_df.siret.to_dict()
+
+
+def test_check_search_plan(engine):
+    assert siretisation.check_search_plan(engine)
@@ -0,0 +1,88 @@
+import textwrap
+
+import pytest
+
+from data_inclusion.tasks import ban_index, geocoding
+
+
+@pytest.fixture
+def ban_index_dir(tmp_path):
+    (tmp_path / "adresses.csv").write_text(
+        textwrap.dedent(
+            """\
+            id;numero;rep;nom_voie;code_postal;code_insee;nom_commune;lon;lat
+            35238_0001_00001;1;;Rue de la Paix;35000;35238;Rennes;-1.67;48.11
+            35238_0001_00003;3;;Rue de la Paix;35000;35238;Rennes;-1.67;48.11
+            35238_0002_00002;2;;Boulevard de la Liberté;35000;35238;Rennes;-1.68;48.10
+            35051_0001_00001;1;;Rue de la Paix;35510;35051;Cesson-Sévigné;-1.60;48.12
+            59350_0001_00027;27;;Impasse Lefebvre;59260;59350;Lille;3.10;50.62
+            59350_0002_00001;1;;Rue Roger Salengro;59260;59350;Lille;3.11;50.62
+            """
+        )
+    )
+    return ban_index.build_ban_index(
+        src=tmp_path / "adresses.csv", output_dir=tmp_path / "index"
+    )
+
+
+@pytest.mark.parametrize(
+    "geocoding_input,expected_code_insee",
+    [
+        (("27 Impasse Lefebvre", "59260", "Hellemmes"), "59350"),
+        (("12 boulevard de la liberte", "35000", "RENNES"), "35238"),
+        (("1 rue de la paix", None, "Cesson Sévigné"), "35051"),
+        (("", "35510", "Cesson-Sévigné"), "35051"),
+        (("1 rue de la paix", "99999", "Nulle Part"), None),
+    ],
+)
+def test_local_ban_geocode(ban_index_dir, geocoding_input, expected_code_insee):
+    backend = ban_index.LocalBaseAdresseNationaleBackend(index_dir=ban_index_dir)
+
+    adresse, code_postal, commune = geocoding_input
+    outputs = backend.geocode_batch(
+        [
+            geocoding.GeocodingInput(
+                id="1", adresse=adresse, code_postal=code_postal, commune=commune
+            )
+        ]
+    )
+
+    assert [o.code_insee for o in outputs] == (
+        [expected_code_insee] if expected_code_insee is not None else []
+    )
+
+
+def test_local_ban_score(ban_index_dir):
+    backend = ban_index.LocalBaseAdresseNationaleBackend(index_dir=ban_index_dir)
+
+    exact_output, vague_output, commune_output = backend.geocode_batch(
+        [
+            geocoding.GeocodingInput(
+                id="1",
+                adresse="3 rue de la Paix",
+                code_postal="35000",
+                commune="Rennes",
+            ),
+            geocoding.GeocodingInput(
+                id="2",
+                adresse="lieu dit inconnu",
+                code_postal="35000",
+                commune="Rennes",
+            ),
+            geocoding.GeocodingInput(
+                id="3",
+                adresse="",
+                code_postal="35000",
+                commune="Rennes",
+            ),
+        ]
+    )
+
+    assert exact_output.score == 1.0
+    assert (exact_output.latitude, exact_output.longitude) == (48.11, -1.67)
+    # commune level result
+    assert vague_output.code_insee == "35238"
+    assert vague_output.score == 0.5
+    # commune level query
+    assert commune_output.code_insee == "35238"
+    assert commune_output.score == 1.0
@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from data_inclusion.tasks import codes_postaux
+
+
+@pytest.fixture
+def codes_postaux_table(tmp_path):
+    src = tmp_path / "laposte_hexasmal.csv"
+    src.write_text(
+        "#Code_commune_INSEE;Nom_de_la_commune;Code_postal;"
+        "Libellé_d_acheminement;Ligne_5\n"
+        "35238;RENNES;35000;RENNES;\n"
+        "35238;RENNES;35200;RENNES;\n"
+        "59350;LILLE;59260;LILLE;HELLEMMES LILLE\n"
+        "59350;LILLE;59260;LILLE;LOMME\n"
+        "35051;CESSON SEVIGNE;35510;CESSON SEVIGNE;\n"
+        "35055;CHATEAUGIRON;35410;CHATEAUGIRON;\n"
+        "35069;DOMLOUP;35410;DOMLOUP;\n"
+    )
+    path = codes_postaux.build_codes_postaux_table(
+        src=src, output_path=tmp_path / "codes_postaux.csv.gz"
+    )
+    return codes_postaux.CodesPostauxTable.from_csv(path)
+
+
+def test_codes_postaux_table_lookup(codes_postaux_table):
+    code_postal = pd.Series(["35000", "59260", "35410", " 35510", "99999", None])
+
+    assert codes_postaux_table.lookup(code_postal).to_list() == [
+        "35238",
+        "59350",
+        None,
+        "35051",
+        None,
+        None,
+    ]
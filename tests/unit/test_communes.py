@@ -0,0 +1,120 @@
+import json
+
+import numpy as np
+import pytest
+
+from data_inclusion.tasks import communes
+
+
+@pytest.fixture
+def commune_index(tmp_path):
+    def square(x, y, size):
+        return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+    features = [
+        # a square, with a hole for an enclave
+        {
+            "properties": {"code": "35238"},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [square(-1.8, 48.0, 0.3), square(-1.7, 48.1, 0.1)],
+            },
+        },
+        # the enclave
+        {
+            "properties": {"code": "35051"},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [square(-1.7, 48.1, 0.1)],
+            },
+        },
+        # an island and its mainland
+        {
+            "properties": {"code": "29155"},
+            "geometry": {
+                "type": "MultiPolygon",
+                "coordinates": [[square(-4.5, 48.0, 0.2)], [square(-5.1, 48.4, 0.1)]],
+            },
+        },
+    ]
+    path = tmp_path / "communes.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+    return communes.CommunePolygonIndex.from_geojson(path)
+
+
+def test_commune_polygon_index_lookup(commune_index):
+    longitude, latitude = np.array(
+        [
+            (-1.75, 48.05),
+            (-1.65, 48.15),
+            (-4.4, 48.1),
+            (-5.05, 48.45),
+            (2.35, 48.85),
+            (np.nan, 48.1),
+        ]
+    ).T
+
+    assert commune_index.lookup(longitude, latitude).tolist() == [
+        "35238",
+        "35051",
+        "29155",
+        "29155",
+        None,
+        None,
+    ]
+
+
+def test_commune_polygon_index_lookup_empty(commune_index):
+    assert commune_index.lookup(np.array([]), np.array([])).tolist() == []
+
+
+def test_commune_polygon_index_arrondissements(tmp_path):
+    def feature(code, x, y, size):
+        return {
+            "properties": {"code": code},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [
+                    [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+                ],
+            },
+        }
+
+    communes_path = tmp_path / "communes.geojson"
+    communes_path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    feature("75056", 2.2, 48.8, 0.2),
+                    feature("92012", 2.2, 48.7, 0.1),
+                ],
+            }
+        )
+    )
+    arrondissements_path = tmp_path / "arrondissements.geojson"
+    arrondissements_path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    feature("75118", 2.3, 48.88, 0.1),
+                    feature("75107", 2.2, 48.8, 0.1),
+                ],
+            }
+        )
+    )
+    longitude, latitude = np.array([(2.35, 48.89), (2.25, 48.85), (2.25, 48.75)]).T
+
+    commune_index = communes.CommunePolygonIndex.from_geojson(
+        communes_path, arrondissements_path=arrondissements_path
+    )
+    assert commune_index.lookup(longitude, latitude).tolist() == [
+        "75118",
+        "75107",
+        "92012",
+    ]
+
+    # without the arrondissements, Paris is left to the geocoder
+    commune_index = communes.CommunePolygonIndex.from_geojson(communes_path)
+    assert commune_index.lookup(longitude, latitude).tolist() == [None, None, "92012"]
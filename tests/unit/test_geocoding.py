@@ -0,0 +1,817 @@
+import concurrent.futures
+import csv
+import io
+import threading
+from datetime import timedelta
+from typing import Optional
+
+import httpx
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from data_inclusion.tasks import codes_postaux, communes, geocoding
+
+
+class FakeBANAdapter(BaseAdapter):
+    """Answer the BAN csv endpoints without network, recording received batches."""
+
+    def __init__(
+        self,
+        citycode_by_postcode: dict,
+        failing_batches: tuple = (),
+        failing_status_code: int = 500,
+        citycode_by_latitude: Optional[dict] = None,
+    ):
+        super().__init__()
+        self.citycode_by_postcode = citycode_by_postcode
+        self.citycode_by_latitude = citycode_by_latitude or {}
+        self.failing_batches = failing_batches
+        self.failing_status_code = failing_status_code
+        self.batches = []
+
+    def send(self, request, **kwargs):
+        body = request.body
+        if not isinstance(body, bytes):
+            body = b"".join(body)
+
+        boundary = request.headers["Content-Type"].split("boundary=")[1].encode()
+        data = next(
+            part.split(b"\r\n\r\n", 1)[1].rstrip(b"\r\n")
+            for part in body.split(b"--" + boundary)
+            if b'name="data"' in part
+        )
+        rows = list(csv.DictReader(io.StringIO(data.decode())))
+        self.batches.append(rows)
+
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+
+        if len(self.batches) in self.failing_batches:
+            response.status_code = self.failing_status_code
+            response.raw = io.BytesIO(b"")
+            return response
+
+        with io.StringIO() as buf:
+            if request.url.endswith("/reverse/csv/"):
+                # reverse geocode from the latitude only
+                writer = csv.DictWriter(
+                    buf, fieldnames=list(rows[0]) + ["result_citycode", "result_score"]
+                )
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(
+                        {
+                            **row,
+                            "result_citycode": self.citycode_by_latitude.get(
+                                row["latitude"], ""
+                            ),
+                            "result_score": "0.9",
+                        }
+                    )
+            else:
+                writer = csv.DictWriter(
+                    buf,
+                    fieldnames=list(rows[0])
+                    + ["result_citycode", "result_score", "latitude", "longitude"],
+                )
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(
+                        {
+                            **row,
+                            "result_citycode": self.citycode_by_postcode.get(
+                                row["code_postal"], ""
+                            ),
+                            "result_score": "0.9",
+                            "latitude": "48.1",
+                            "longitude": "-1.6",
+                        }
+                    )
+            response.raw = io.BytesIO(buf.getvalue().encode())
+        response.status_code = 200
+        return response
+
+    def close(self):
+        pass
+
+
+def make_ban_backend(adapter: BaseAdapter, **kwargs):
+    backend = geocoding.BaseAdresseNationaleBackend(
+        base_url="https://api-adresse.data.gouv.fr", **kwargs
+    )
+    backend.session.mount("https://", adapter)
+    return backend
+
+
+@pytest.fixture
+def geocoding_inputs():
+    return [
+        geocoding.GeocodingInput(
+            id=str(i),
+            adresse=f"{i} rue de la Paix",
+            code_postal=code_postal,
+            commune=commune,
+        )
+        for i, (code_postal, commune) in enumerate(
+            [
+                ("59260", "Hellemmes"),
+                ("35000", "Rennes"),
+                ("99999", "Nulle Part"),
+                ("75018", "Paris"),
+                ("35000", "Rennes"),
+            ]
+        )
+    ]
+
+
+CITYCODE_BY_POSTCODE = {"59260": "59350", "35000": "35238", "75018": "75118"}
+
+
+def test_ban_reverse_geocode_in_batches():
+    adapter = FakeBANAdapter(
+        CITYCODE_BY_POSTCODE, citycode_by_latitude={"48.11": "35238", "50.62": "59350"}
+    )
+    backend = make_ban_backend(adapter, batch_size=2, max_workers=1)
+
+    output_df = backend.reverse_geocode_dataframe(
+        pd.DataFrame(
+            {
+                "id": ["0", "1", "2"],
+                "latitude": [48.11, 50.62, 0.0],
+                "longitude": [-1.67, 3.1, 0.0],
+            }
+        )
+    )
+
+    assert output_df.id.to_list() == ["0", "1"]
+    assert output_df.code_insee.to_list() == ["35238", "59350"]
+    assert [len(batch) for batch in adapter.batches] == [2, 1]
+    assert list(adapter.batches[0][0]) == ["id", "latitude", "longitude"]
+
+
+def test_ban_geocode_in_batches(geocoding_inputs):
+    adapter = FakeBANAdapter(CITYCODE_BY_POSTCODE)
+    backend = make_ban_backend(adapter, batch_size=2, max_workers=3)
+
+    assert backend.geocode_batch(geocoding_inputs) == [
+        geocoding.GeocodingOutput(
+            id=id, code_insee=code_insee, score=0.9, latitude=48.1, longitude=-1.6
+        )
+        for id, code_insee in [
+            ("0", "59350"),
+            ("1", "35238"),
+            ("3", "75118"),
+            ("4", "35238"),
+        ]
+    ]
+    assert sorted(len(batch) for batch in adapter.batches) == [1, 2, 2]
+
+
+def test_ban_geocode_batches_bounded_in_bytes(geocoding_inputs):
+    adapter = FakeBANAdapter(CITYCODE_BY_POSTCODE)
+    backend = make_ban_backend(adapter, max_batch_bytes=64, max_workers=1)
+
+    backend.geocode_batch(geocoding_inputs)
+
+    assert len(adapter.batches) == len(geocoding_inputs)
+
+
+def test_ban_geocode_multi_chunk_crlf_response():
+    # the csv is written with \r\n line endings : with rows of varying lengths,
+    # some of them are split between the chunks of the response
+    geocoding_inputs = [
+        geocoding.GeocodingInput(
+            id=str(i),
+            adresse=f"{i} rue de la Paix",
+            code_postal="35000",
+            commune="x" * (i % 7 + 1),
+        )
+        for i in range(2000)
+    ]
+    adapter = FakeBANAdapter(CITYCODE_BY_POSTCODE)
+    backend = make_ban_backend(adapter, batch_size=2000, max_workers=1)
+
+    outputs = backend.geocode_batch(geocoding_inputs)
+
+    assert len(adapter.batches) == 1
+    assert [o.id for o in outputs] == [str(i) for i in range(2000)]
+
+
+def test_parse_csv_results_malformed_row():
+    with pytest.raises(ValueError):
+        geocoding.parse_csv_results(
+            ["id,result_citycode,result_score", "0,35238,0.9", "1,35238"]
+        )
+
+
+def test_parse_csv_results_missing_column():
+    with pytest.raises(ValueError):
+        geocoding.parse_csv_results(["id,result_score", "0,0.9"])
+
+
+def test_parse_csv_results_quoted_line_break():
+    output_df = geocoding.parse_csv_results(
+        [
+            "id,adresse,result_citycode,result_score\r\n",
+            '0,"1 rue\r\n',
+            'haute",35238,0.9\r\n',
+            "",
+            "1,2 rue basse,,\r\n",
+        ]
+    )
+
+    assert output_df.id.to_list() == ["0"]
+    assert output_df.code_insee.to_list() == ["35238"]
+
+
+class MissingColumnBANAdapter(FakeBANAdapter):
+    """Answer the first batch without the `result_citycode` column."""
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if len(self.batches) == 1:
+            response.raw = io.BytesIO(b"id,result_score\r\n0,0.9\r\n")
+        return response
+
+
+def test_ban_geocode_missing_column(geocoding_inputs):
+    adapter = MissingColumnBANAdapter(CITYCODE_BY_POSTCODE)
+    backend = make_ban_backend(adapter, batch_size=2, max_workers=1, max_attempts=1)
+
+    # only the first batch is lost
+    assert [o.id for o in backend.geocode_batch(geocoding_inputs)] == ["3", "4"]
+    assert backend.stats.failed_batches == 1
+
+
+def test_ban_geocode_failing_batch(geocoding_inputs):
+    adapter = FakeBANAdapter(CITYCODE_BY_POSTCODE, failing_batches=(1,))
+    backend = make_ban_backend(adapter, batch_size=2, max_workers=1)
+
+    assert [o.id for o in backend.geocode_batch(geocoding_inputs)] == ["3", "4"]
+
+
+def test_ban_geocode_retried_batch(monkeypatch, geocoding_inputs):
+    monkeypatch.setattr(geocoding.time, "sleep", lambda _: None)
+    adapter = FakeBANAdapter(
+        CITYCODE_BY_POSTCODE, failing_batches=(1,), failing_status_code=503
+    )
+    backend = make_ban_backend(adapter, batch_size=2, max_workers=1)
+
+    assert [o.id for o in backend.geocode_batch(geocoding_inputs)] == [
+        "0",
+        "1",
+        "3",
+        "4",
+    ]
+
+
+def test_adaptive_batch_size():
+    batch_size = geocoding.AdaptiveBatchSize(
+        initial_size=100, min_size=50, max_size=200, target_latency=1, increment=40
+    )
+    batch_sizes = iter(batch_size)
+
+    assert next(batch_sizes) == 100
+    batch_size.record(latency=0.5, failed=False)
+    assert next(batch_sizes) == 140
+    batch_size.record(latency=0.5, failed=False)
+    batch_size.record(latency=0.5, failed=False)
+    assert next(batch_sizes) == 200
+    batch_size.record(latency=2, failed=False)
+    assert next(batch_sizes) == 100
+    batch_size.record(latency=0.5, failed=True)
+    batch_size.record(latency=0.5, failed=True)
+    assert next(batch_sizes) == 50
+
+
+def test_adaptive_batch_size_response_bytes():
+    batch_size = geocoding.AdaptiveBatchSize(
+        initial_size=100,
+        min_size=10,
+        max_size=1000,
+        max_response_bytes=10_000,
+        increment=100,
+    )
+    batch_sizes = iter(batch_size)
+
+    # 20 bytes per row : 500 rows fit in the budget
+    batch_size.record(latency=0.5, failed=False, batch_size=100, response_bytes=2000)
+    assert next(batch_sizes) == 200
+    batch_size.record(latency=0.5, failed=False, batch_size=200, response_bytes=4000)
+    batch_size.record(latency=0.5, failed=False, batch_size=300, response_bytes=6000)
+    batch_size.record(latency=0.5, failed=False, batch_size=400, response_bytes=8000)
+    assert next(batch_sizes) == 500
+    # larger rows
+    batch_size.record(latency=0.5, failed=False, batch_size=500, response_bytes=9000)
+    assert next(batch_sizes) == 555
+    # over the budget
+    batch_size.record(latency=0.5, failed=False, batch_size=555, response_bytes=12000)
+    assert next(batch_sizes) == 277
+
+
+def test_ban_geocode_adaptive_batches(geocoding_inputs):
+    adapter = FakeBANAdapter(CITYCODE_BY_POSTCODE)
+    backend = make_ban_backend(
+        adapter, batch_size=1, min_batch_size=1, max_batch_size=4, max_workers=1
+    )
+    backend.adaptive_batch_size.increment = 1
+
+    assert len(backend.geocode_batch(geocoding_inputs)) == 4
+    assert backend.stats.batch_sizes == [1, 2, 2]
+    assert backend.stats.rows == len(geocoding_inputs)
+    assert backend.stats.failed_batches == 0
+
+
+class FakeBackend(geocoding.GeocodingBackend):
+    """Geocode from a static postcode lookup, recording the inputs."""
+
+    def __init__(self, citycode_by_postcode: dict, score: float = 0.9):
+        self.citycode_by_postcode = citycode_by_postcode
+        self.score = score
+        self.inputs = []
+
+    def geocode_batch(self, geocoding_input_list):
+        self.inputs += geocoding_input_list
+        return [
+            geocoding.GeocodingOutput(
+                id=i.id,
+                code_insee=self.citycode_by_postcode[i.code_postal],
+                score=self.score,
+                latitude=48.1,
+                longitude=-1.6,
+            )
+            for i in geocoding_input_list
+            if i.code_postal in self.citycode_by_postcode
+        ]
+
+
+def test_cached_geocode(tmp_path, geocoding_inputs):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+    cached_backend = geocoding.CachedGeocodingBackend(
+        backend=backend, path=tmp_path / "cache.sqlite"
+    )
+
+    outputs = cached_backend.geocode_batch(geocoding_inputs)
+    assert outputs == backend.geocode_batch(geocoding_inputs)
+
+    backend.inputs = []
+    assert cached_backend.geocode_batch(geocoding_inputs) == outputs
+    # inputs without result are not cached
+    assert [i.code_postal for i in backend.inputs] == ["99999"]
+
+
+def test_cached_geocode_normalized_key(tmp_path):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+    cached_backend = geocoding.CachedGeocodingBackend(
+        backend=backend, path=tmp_path / "cache.sqlite"
+    )
+
+    outputs = cached_backend.geocode_batch(
+        [
+            geocoding.GeocodingInput(
+                id=None,
+                adresse="1 Rue  de l'Église",
+                code_postal="35000",
+                commune="Rennes",
+            ),
+            geocoding.GeocodingInput(
+                id="b",
+                adresse="1 rue de l eglise",
+                code_postal="35000",
+                commune="RENNES",
+            ),
+        ]
+    )
+
+    assert [o.id for o in outputs] == [None, "b"]
+    assert len(backend.inputs) == 1
+
+
+def test_cached_geocode_eviction(tmp_path, geocoding_inputs):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+    cached_backend = geocoding.CachedGeocodingBackend(
+        backend=backend, path=tmp_path / "cache.sqlite", max_entries=2
+    )
+    cached_backend.geocode_batch(geocoding_inputs)
+    assert cached_backend.cache.connection.execute(
+        "SELECT COUNT(*) FROM geocoding_cache"
+    ).fetchone() == (2,)
+
+    cached_backend = geocoding.CachedGeocodingBackend(
+        backend=backend, path=tmp_path / "cache.sqlite", ttl=timedelta(0)
+    )
+    backend.inputs = []
+    cached_backend.geocode_batch(geocoding_inputs)
+    assert len(backend.inputs) == len(geocoding_inputs)
+
+
+def test_cached_geocode_export_import(tmp_path, geocoding_inputs):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+    cached_backend = geocoding.CachedGeocodingBackend(
+        backend=backend, path=tmp_path / "cache.sqlite"
+    )
+    cached_backend.geocode_batch(geocoding_inputs)
+    cached_backend.export(tmp_path / "export.sqlite")
+
+    other_cached_backend = geocoding.CachedGeocodingBackend(
+        backend=backend, path=tmp_path / "other.sqlite"
+    )
+    other_cached_backend.import_(tmp_path / "export.sqlite")
+
+    backend.inputs = []
+    other_cached_backend.geocode_batch(geocoding_inputs)
+    assert [i.code_postal for i in backend.inputs] == ["99999"]
+
+
+def test_async_ban_geocode(geocoding_inputs):
+    adapter = FakeBANAdapter(CITYCODE_BY_POSTCODE)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        request.read()
+        response = adapter.send(
+            requests.Request(
+                method="POST",
+                url=str(request.url),
+                headers=dict(request.headers),
+                data=request.content,
+            ).prepare()
+        )
+        return httpx.Response(response.status_code, content=response.content)
+
+    backend = geocoding.SyncGeocodingBackend(
+        backend=geocoding.AsyncBaseAdresseNationaleBackend(
+            base_url="https://api-adresse.data.gouv.fr",
+            batch_size=2,
+            max_concurrency=2,
+            transport=httpx.MockTransport(handler),
+        )
+    )
+
+    assert [o.id for o in backend.geocode_batch(geocoding_inputs)] == [
+        "0",
+        "1",
+        "3",
+        "4",
+    ]
+    assert len(adapter.batches) == 3
+
+
+def test_async_ban_geocode_malformed_response(geocoding_inputs):
+    adapter = FakeBANAdapter(CITYCODE_BY_POSTCODE)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        request.read()
+        response = adapter.send(
+            requests.Request(
+                method="POST",
+                url=str(request.url),
+                headers=dict(request.headers),
+                data=request.content,
+            ).prepare()
+        )
+        if b"0 rue de la Paix" in request.content:
+            return httpx.Response(200, content=b"id,result_citycode,result_score\n0,")
+        return httpx.Response(response.status_code, content=response.content)
+
+    backend = geocoding.SyncGeocodingBackend(
+        backend=geocoding.AsyncBaseAdresseNationaleBackend(
+            base_url="https://api-adresse.data.gouv.fr",
+            batch_size=2,
+            max_concurrency=2,
+            transport=httpx.MockTransport(handler),
+        )
+    )
+
+    # only the malformed batch is lost
+    assert [o.id for o in backend.geocode_batch(geocoding_inputs)] == ["3", "4"]
+
+
+@pytest.fixture
+def structures_df():
+    return pd.DataFrame(
+        [
+            {
+                "id": None,
+                "adresse": "27 Impasse Lefebvre",
+                "code_postal": "59260",
+                "commune": "Hellemmes",
+                "code_insee": None,
+                "latitude": None,
+                "longitude": None,
+            },
+            {
+                "id": None,
+                "adresse": "5 rue du Simplon",
+                "code_postal": "75018",
+                "commune": "Paris",
+                "code_insee": "75056",
+                "latitude": 48.89,
+                "longitude": 2.35,
+            },
+            {
+                "id": "3",
+                "adresse": "Nulle part",
+                "code_postal": "99999",
+                "commune": "Nulle Part",
+                "code_insee": None,
+                "latitude": None,
+                "longitude": None,
+            },
+        ]
+    )
+
+
+def test_geocode_normalized_dataframe(structures_df):
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df, geocoding_backend=FakeBackend(CITYCODE_BY_POSTCODE)
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", None]
+
+
+def test_geocode_normalized_dataframe_low_score(structures_df):
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df, geocoding_backend=FakeBackend(CITYCODE_BY_POSTCODE, score=0.3)
+    )
+
+    assert output_df.code_insee.to_list() == [None, "75056", None]
+
+
+def test_geocode_normalized_dataframe_deduplicated(structures_df):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+    structures_df = pd.concat(
+        [
+            structures_df,
+            pd.DataFrame(
+                [
+                    {
+                        "id": "4",
+                        "adresse": "27 imp. Lefèbvre",
+                        "code_postal": "59260",
+                        "commune": "HELLEMMES",
+                        "code_insee": None,
+                        "latitude": None,
+                        "longitude": None,
+                    }
+                ]
+            ),
+        ],
+        ignore_index=True,
+    )
+
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df, geocoding_backend=backend
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", None, "59350"]
+    assert [i.code_postal for i in backend.inputs] == ["59260", "99999"]
+
+
+def test_geocode_normalized_dataframe_fill_coordinates(structures_df):
+    structures_df.loc[1, "latitude"] = None
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df,
+        geocoding_backend=FakeBackend(CITYCODE_BY_POSTCODE),
+        fill_coordinates=True,
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", None]
+    assert output_df.latitude.to_list() == [48.1, 48.1, None]
+    assert output_df.longitude.to_list() == [-1.6, -1.6, None]
+
+
+def test_geocode_normalized_dataframe_imprecise_coordinates(structures_df):
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df,
+        geocoding_backend=FakeBackend(CITYCODE_BY_POSTCODE, score=0.5),
+        fill_coordinates=True,
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", None]
+    assert output_df.latitude.to_list() == [None, 48.89, None]
+
+
+def test_geocode_normalized_dataframe_commune_index(structures_df):
+    structures_df.loc[2, ["latitude", "longitude"]] = [48.15, -1.65]
+    commune_index = communes.CommunePolygonIndex(
+        codes=["35238"],
+        rings_list=[
+            [
+                np.array(
+                    [
+                        [-1.7, 48.1],
+                        [-1.6, 48.1],
+                        [-1.6, 48.2],
+                        [-1.7, 48.2],
+                        [-1.7, 48.1],
+                    ]
+                )
+            ]
+        ],
+    )
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df, geocoding_backend=backend, commune_index=commune_index
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", "35238"]
+    assert [i.code_postal for i in backend.inputs] == ["59260"]
+
+
+def test_geocode_normalized_dataframe_codes_postaux_table(structures_df):
+    codes_postaux_table = codes_postaux.CodesPostauxTable(
+        table_df=pd.DataFrame(
+            [
+                {"code_postal": "59260", "code_insee": "59350", "commune": "lille"},
+                {"code_postal": "99999", "code_insee": "99001", "commune": "a"},
+                {"code_postal": "99999", "code_insee": "99002", "commune": "b"},
+            ]
+        )
+    )
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df,
+        geocoding_backend=backend,
+        codes_postaux_table=codes_postaux_table,
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", None]
+    assert [i.code_postal for i in backend.inputs] == ["99999"]
+
+
+def test_geocode_normalized_dataframe_commune_level(structures_df):
+    structures_df.loc[1, "code_insee"] = None
+    structures_df.loc[3] = structures_df.loc[0].replace({"adresse": "1 rue Faidherbe"})
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df, geocoding_backend=backend, commune_level=True
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75118", None, "59350"]
+    # one request by commune, then the street level for the unresolved one
+    assert [(i.adresse, i.code_postal) for i in backend.inputs] == [
+        ("", "59260"),
+        ("", "75018"),
+        ("", "99999"),
+        ("Nulle part", "99999"),
+    ]
+
+
+def test_geocode_normalized_dataframe_commune_level_ambiguous(structures_df):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE, score=0.5)
+
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df, geocoding_backend=backend, commune_level=True
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", None]
+    assert [(i.adresse, i.code_postal) for i in backend.inputs] == [
+        ("", "59260"),
+        ("", "99999"),
+        ("27 Impasse Lefebvre", "59260"),
+        ("Nulle part", "99999"),
+    ]
+
+
+class FakeReverseBackend(FakeBackend):
+    """Also reverse geocode, from a static latitude lookup."""
+
+    def __init__(self, citycode_by_postcode: dict, citycode_by_latitude: dict):
+        super().__init__(citycode_by_postcode)
+        self.citycode_by_latitude = citycode_by_latitude
+        self.reverse_inputs = []
+
+    def reverse_geocode_dataframe(self, df):
+        self.reverse_inputs += df.to_dict(orient="records")
+        return geocoding.to_geocoding_output_dataframe(
+            [
+                geocoding.GeocodingOutput(
+                    id=row.id,
+                    code_insee=self.citycode_by_latitude[row.latitude],
+                    score=0.9,
+                )
+                for row in df.itertuples()
+                if row.latitude in self.citycode_by_latitude
+            ]
+        )
+
+
+def test_geocode_normalized_dataframe_reverse(structures_df):
+    structures_df.loc[0, ["latitude", "longitude"]] = [50.62, 3.1]
+    structures_df.loc[2, ["adresse", "latitude", "longitude"]] = [None, 48.11, -1.67]
+    backend = FakeReverseBackend(
+        CITYCODE_BY_POSTCODE, citycode_by_latitude={48.11: "35238", 50.62: "59350"}
+    )
+
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df, geocoding_backend=backend
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", "35238"]
+    # only the structure without address is reverse geocoded
+    assert [row["latitude"] for row in backend.reverse_inputs] == [48.11]
+    assert [i.code_postal for i in backend.inputs] == ["59260"]
+
+
+def test_geocode_normalized_dataframe_reverse_not_supported(structures_df):
+    structures_df.loc[2, ["adresse", "latitude", "longitude"]] = [None, 48.11, -1.67]
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+
+    output_df = geocoding.geocode_normalized_dataframe(
+        structures_df, geocoding_backend=backend
+    )
+
+    assert output_df.code_insee.to_list() == ["59350", "75056", None]
+    assert [i.code_postal for i in backend.inputs] == ["59260", "99999"]
+
+
+def test_coalescing_geocode(geocoding_inputs):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+    coalescing_backend = geocoding.CoalescingGeocodingBackend(
+        backend=backend, window=0.2
+    )
+
+    # overlapping inputs, from concurrent callers
+    inputs_list = [geocoding_inputs[:3], geocoding_inputs[1:], geocoding_inputs[:1]]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        outputs_list = list(executor.map(coalescing_backend.geocode_batch, inputs_list))
+
+    for inputs, outputs in zip(inputs_list, outputs_list):
+        assert outputs == FakeBackend(CITYCODE_BY_POSTCODE).geocode_batch(inputs)
+    # each distinct address is geocoded once
+    assert sorted(i.code_postal for i in backend.inputs) == [
+        "35000",
+        "35000",
+        "59260",
+        "75018",
+        "99999",
+    ]
+
+
+def test_coalescing_geocode_interrupted_leader(geocoding_inputs, monkeypatch):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+    coalescing_backend = geocoding.CoalescingGeocodingBackend(
+        backend=backend, window=0.2
+    )
+    follower_registered = threading.Event()
+
+    def sleep(seconds):
+        # the leader is interrupted once the follower waits for its request
+        assert follower_registered.wait(timeout=5)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(geocoding.time, "sleep", sleep)
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        leader = executor.submit(coalescing_backend.geocode_batch, geocoding_inputs[:1])
+        while coalescing_backend.pending_future is None:
+            pass
+        follower = executor.submit(
+            coalescing_backend.geocode_batch, geocoding_inputs[1:2]
+        )
+        while len(coalescing_backend.pending_inputs) < 2:
+            pass
+        follower_registered.set()
+
+        with pytest.raises(KeyboardInterrupt):
+            leader.result(timeout=5)
+        # the request was still sent for the follower
+        assert follower.result(timeout=5) == FakeBackend(
+            CITYCODE_BY_POSTCODE
+        ).geocode_batch(geocoding_inputs[1:2])
+
+    assert coalescing_backend.pending_future is None
+    assert coalescing_backend.futures_by_key == {}
+
+
+def test_cached_geocode_dataframe(tmp_path, geocoding_inputs):
+    backend = FakeBackend(CITYCODE_BY_POSTCODE)
+    cached_backend = geocoding.CachedGeocodingBackend(
+        backend=backend, path=tmp_path / "cache.sqlite"
+    )
+    # duplicated ids and addresses
+    df = geocoding.to_geocoding_input_dataframe(
+        geocoding_inputs + geocoding_inputs[:1]
+    ).assign(id="x")
+
+    output_df = cached_backend.geocode_dataframe(df)
+    expected_df = geocoding.to_geocoding_output_dataframe(
+        FakeBackend(CITYCODE_BY_POSTCODE).geocode_batch(
+            geocoding.to_geocoding_input_list(df)
+        )
+    )
+    pd.testing.assert_frame_equal(output_df, expected_df)
+    assert len(backend.inputs) == len(geocoding_inputs)
+
+    backend.inputs = []
+    pd.testing.assert_frame_equal(cached_backend.geocode_dataframe(df), expected_df)
+    assert [i.code_postal for i in backend.inputs] == ["99999"]
+
+    assert len(cached_backend.geocode_dataframe(df.iloc[:0])) == 0
@@ -0,0 +1,44 @@
+from data_inclusion.tasks import sirene
+
+
+def test_iter_index_names():
+    plan = {
+        "Node Type": "Limit",
+        "Plans": [
+            {
+                "Node Type": "Sort",
+                "Plans": [
+                    {
+                        "Node Type": "Bitmap Heap Scan",
+                        "Plans": [
+                            {
+                                "Node Type": "BitmapAnd",
+                                "Plans": [
+                                    {
+                                        "Node Type": "Bitmap Index Scan",
+                                        "Index Name": "sirene_establishment_department_idx",  # noqa: E501
+                                    },
+                                    {
+                                        "Node Type": "Bitmap Index Scan",
+                                        "Index Name": "sirene_establishment_name_trgm_idx",  # noqa: E501
+                                    },
+                                ],
+                            }
+                        ],
+                    }
+                ],
+            }
+        ],
+    }
+
+    assert set(sirene.iter_index_names(plan)) == {
+        "sirene_establishment_department_idx",
+        "sirene_establishment_name_trgm_idx",
+    }
+
+
+def test_name_key():
+    assert sirene.name_key("Mairie de Saint-Étienne (annexe)") == (
+        "mairie de saint etienne annexe"
+    )
+    assert sirene.name_key(None) == ""
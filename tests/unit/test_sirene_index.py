@@ -0,0 +1,149 @@
+import textwrap
+
+import pandas as pd
+import pytest
+import sqlalchemy as slqa
+
+from data_inclusion.tasks import sirene_index, sirene_stock
+
+
+@pytest.mark.parametrize(
+    "s,expected_trigrams",
+    [
+        ("word", ["  w", " wo", "ord", "rd ", "wor"]),
+        ("l'É-é", ["  l", " l ", "  é", " é "]),
+        (None, []),
+    ],
+)
+def test_trigrams(s, expected_trigrams):
+    assert sirene_index.trigrams(s) == sorted(expected_trigrams)
+
+
+def test_similarity():
+    # SELECT similarity('word', 'two words') -> 0.36363637
+    assert sirene_index.similarity(
+        sirene_index.trigrams("word"), sirene_index.trigrams("two words")
+    ) == pytest.approx(0.36363637)
+
+
+@pytest.fixture
+def sirene_index_dir(tmp_path):
+    (tmp_path / "sirene_establishment.csv").write_text(
+        textwrap.dedent(
+            """\
+            siret,name,address1,city_code,longitude,latitude
+            11111111100011,MAIRIE DE RENNES,PLACE DE LA MAIRIE,35238,-1.6794,48.1113
+            22222222200022,MAIRIE DE RENNES ANNEXE,RUE DE PARIS,35238,-1.6500,48.1100
+            33333333300033,CENTRE SOCIAL DU BLOSNE,BD DE YOUGOSLAVIE,35238,-1.6602,48.0855
+            44444444400044,CENTRE SOCIAL DU BLOSNE,RUE DE RENNES,35051,-1.6601,48.0856
+            55555555500055,CENTRE SOCIAL,,59350,3.0600,50.6300
+            """
+        )
+    )
+    return sirene_index.build_sirene_index(
+        src=tmp_path / "sirene_establishment.csv", output_dir=tmp_path / "index"
+    )
+
+
+def test_build_sirene_index_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+
+    pd.DataFrame(
+        {
+            "siret": ["11111111100011", "22222222200022"],
+            "name": ["MAIRIE DE RENNES", "CENTRE SOCIAL"],
+            "address1": ["PLACE DE LA MAIRIE", None],
+            "city_code": ["35238", "59350"],
+            "longitude": [-1.6794, 3.06],
+            "latitude": [48.1113, 50.63],
+        }
+    ).to_parquet(tmp_path / "sirene_establishment.parquet")
+
+    sirene_index.build_sirene_index(
+        src=tmp_path / "sirene_establishment.parquet", output_dir=tmp_path / "index"
+    )
+    backend = sirene_index.LocalSireneBackend(index_dir=tmp_path / "index")
+
+    assert backend.match("Mairie de Rennes", "35238", -1.679, 48.111) == (
+        "11111111100011"
+    )
+    assert backend.match("Centre social", "59350", 3.06, 50.63) == "22222222200022"
+
+
+def test_local_sirene_match_batch(sirene_index_dir):
+    backend = sirene_index.LocalSireneBackend(index_dir=sirene_index_dir)
+
+    structures_df = pd.DataFrame(
+        [
+            # close to the first one, the annexe being about 2km away
+            ("Mairie de Rennes", "Place de la Mairie", "35238", 48.1110, -1.6790),
+            # the establishment in another department is ignored
+            ("Centre social du Blosne", "Bd de Yougoslavie", "35238", 48.086, -1.660),
+            # not similar enough
+            ("Epicerie solidaire", "Place de la Mairie", "35238", 48.1110, -1.6790),
+            # too far
+            ("Centre social", "Rue du Moulin", "59350", 50.70, 3.06),
+            # missing data
+            ("Mairie de Rennes", None, "35238", 48.1110, -1.6790),
+            ("Centre social", "Rue de Lille", "75056", 48.85, 2.35),
+        ],
+        columns=["nom", "adresse", "code_insee", "latitude", "longitude"],
+        index=[3, 1, 4, 1, 5, 9],
+    )
+
+    output_df = backend.match_batch(structures_df)
+
+    assert output_df.index.to_list() == [3, 1, 4, 1, 5, 9]
+    assert output_df.siret.to_list() == [
+        "11111111100011",
+        "33333333300033",
+        None,
+        None,
+        None,
+        None,
+    ]
+
+
+def test_prefetched_sirene_match_batch(tmp_path):
+    engine = slqa.create_engine(f"sqlite:///{tmp_path / 'sirene.db'}")
+    with engine.begin() as connection:
+        sirene_stock.create_table(
+            connection, generated_columns=sirene_stock.SQLITE_COLUMNS
+        )
+        pd.DataFrame(
+            [
+                (
+                    "11111111100011",
+                    "MAIRIE",
+                    "PL DE LA MAIRIE",
+                    "35238",
+                    -1.679,
+                    48.111,
+                ),
+                ("22222222200022", "MAIRIE", "RUE HAUTE", "35238", -1.6791, 48.1111),
+                ("33333333300033", "CENTRE SOCIAL", None, "59350", None, None),
+            ],
+            columns=list(sirene_stock.TABLE_COLUMNS),
+        ).to_sql("sirene_establishment", connection, if_exists="append", index=False)
+        sirene_stock.create_sqlite_indexes(connection)
+
+    backend = sirene_index.PrefetchedSireneBackend(engine=engine, cache_size=1)
+    structures_df = pd.DataFrame(
+        [
+            ("Mairie", "Rue Haute", "35238", 48.111, -1.679),
+            ("Centre social", "Rue de Lille", "59350", 50.63, 3.06),
+            ("Mairie", "Pl de la Mairie", "35238", 48.111, -1.679),
+        ],
+        columns=["nom", "adresse", "code_insee", "latitude", "longitude"],
+        index=[7, 7, 8],
+    )
+
+    output_df = backend.match_batch(structures_df)
+
+    assert output_df.index.to_list() == [7, 7, 8]
+    assert output_df.siret.iloc[1] is None
+    # both establishments have the same name, the first one is kept
+    assert output_df.siret.iloc[0] == output_df.siret.iloc[2] == "11111111100011"
+    assert output_df.address_similarity.iloc[2] == 1.0
+    assert backend.stats.counts["prefetch_department"] == 2
+    assert list(backend.backends_by_department) == ["59"]
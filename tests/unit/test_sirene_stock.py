@@ -0,0 +1,163 @@
+import gzip
+import textwrap
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy as slqa
+
+from data_inclusion.tasks import sirene_index, sirene_stock
+
+
+def test_load_sirene_stock_sqlite(tmp_path):
+    with gzip.open(tmp_path / "StockEtablissement.csv.gz", "wt") as f:
+        f.write(
+            textwrap.dedent(
+                """\
+                siret,siren,etatAdministratifEtablissement,denominationUsuelleEtablissement,enseigne1Etablissement,numeroVoieEtablissement,indiceRepetitionEtablissement,typeVoieEtablissement,libelleVoieEtablissement,codeCommuneEtablissement,longitude,latitude
+                11111111100011,111111111,A,MAIRIE DE RENNES,,,,PL,DE LA MAIRIE,35238,-1.6794,48.1113
+                22222222200022,222222222,A,,CAFE DU PORT,12,B,RUE,DU PORT,35238,-1.65,48.11
+                33333333300033,333333333,F,ANCIENNE ECOLE,,1,,RUE,HAUTE,59350,3.06,50.63
+                44444444400044,444444444,A,SANS ADRESSE,,,,,,59350,,
+                """  # noqa: E501
+            )
+        )
+
+    engine = slqa.create_engine(f"sqlite:///{tmp_path / 'sirene.db'}")
+    count = sirene_stock.load_sirene_stock(
+        src=tmp_path / "StockEtablissement.csv.gz", engine=engine, batch_size=2
+    )
+
+    assert count == 3
+    establishments_df = pd.read_sql_table("sirene_establishment", engine)
+    establishments_df = establishments_df.replace(np.nan, None)
+    assert establishments_df.to_dict(orient="records") == [
+        {
+            "siret": "11111111100011",
+            "name": "MAIRIE DE RENNES",
+            "address1": "PL DE LA MAIRIE",
+            "city_code": "35238",
+            "department": "35",
+            "longitude": -1.6794,
+            "latitude": 48.1113,
+        },
+        {
+            "siret": "22222222200022",
+            "name": "CAFE DU PORT",
+            "address1": "12 B RUE DU PORT",
+            "city_code": "35238",
+            "department": "35",
+            "longitude": -1.65,
+            "latitude": 48.11,
+        },
+        {
+            "siret": "44444444400044",
+            "name": "SANS ADRESSE",
+            "address1": None,
+            "city_code": "59350",
+            "department": "59",
+            "longitude": None,
+            "latitude": None,
+        },
+    ]
+
+    # the database can be indexed for the local backend
+    sirene_index.build_sirene_index(
+        src=tmp_path / "sirene.db", output_dir=tmp_path / "index"
+    )
+    backend = sirene_index.LocalSireneBackend(index_dir=tmp_path / "index")
+    assert backend.match("Mairie de Rennes", "35238", -1.679, 48.111) == (
+        "11111111100011"
+    )
+
+
+def test_load_sirene_stock_legal_names(tmp_path):
+    (tmp_path / "StockEtablissement.csv").write_text(
+        textwrap.dedent(
+            """\
+            siret,etatAdministratifEtablissement,denominationUsuelleEtablissement,enseigne1Etablissement,numeroVoieEtablissement,indiceRepetitionEtablissement,typeVoieEtablissement,libelleVoieEtablissement,codeCommuneEtablissement,longitude,latitude
+            11111111100011,A,MAIRIE DE RENNES,,,,,,35238,,
+            22222222200022,A,,,,,,,35238,,
+            33333333300033,A,,,,,,,35238,,
+            """  # noqa: E501
+        )
+    )
+    (tmp_path / "StockUniteLegale.csv").write_text(
+        textwrap.dedent(
+            """\
+            siren,nomUniteLegale,denominationUniteLegale
+            111111111,,COMMUNE DE RENNES
+            222222222,,ASSOCIATION DU PORT
+            333333333,DUPONT,
+            """
+        )
+    )
+
+    engine = slqa.create_engine(f"sqlite:///{tmp_path / 'sirene.db'}")
+    sirene_stock.load_sirene_stock(
+        src=tmp_path / "StockEtablissement.csv",
+        engine=engine,
+        batch_size=2,
+        legal_units_src=tmp_path / "StockUniteLegale.csv",
+    )
+
+    establishments_df = pd.read_sql_table("sirene_establishment", engine)
+    establishments_df = establishments_df.replace(np.nan, None)
+    assert establishments_df[["siret", "name"]].to_dict(orient="records") == [
+        {"siret": "11111111100011", "name": "MAIRIE DE RENNES"},
+        {"siret": "22222222200022", "name": "ASSOCIATION DU PORT"},
+        {"siret": "33333333300033", "name": None},
+    ]
+
+
+def test_load_sirene_stock_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+
+    pd.DataFrame(
+        {
+            "siret": ["11111111100011", "22222222200022", "33333333300033"],
+            "siren": ["111111111", "222222222", "333333333"],
+            "etatAdministratifEtablissement": ["A", "A", "F"],
+            "denominationUsuelleEtablissement": ["MAIRIE DE RENNES", None, None],
+            "enseigne1Etablissement": [None, None, None],
+            # numeric in the parquet file
+            "numeroVoieEtablissement": [None, 12, 1],
+            "indiceRepetitionEtablissement": [None, "B", None],
+            "typeVoieEtablissement": ["PL", "RUE", "RUE"],
+            "libelleVoieEtablissement": ["DE LA MAIRIE", "DU PORT", "HAUTE"],
+            "codeCommuneEtablissement": ["35238", "35238", "59350"],
+            "longitude": [-1.6794, -1.65, 3.06],
+            "latitude": [48.1113, 48.11, 50.63],
+        }
+    ).to_parquet(tmp_path / "StockEtablissement.parquet")
+    pd.DataFrame(
+        {
+            "siren": ["222222222"],
+            "denominationUniteLegale": ["ASSOCIATION DU PORT"],
+        }
+    ).to_parquet(tmp_path / "StockUniteLegale.parquet")
+
+    engine = slqa.create_engine(f"sqlite:///{tmp_path / 'sirene.db'}")
+    count = sirene_stock.load_sirene_stock(
+        src=tmp_path / "StockEtablissement.parquet",
+        engine=engine,
+        batch_size=2,
+        legal_units_src=tmp_path / "StockUniteLegale.parquet",
+    )
+
+    assert count == 2
+    establishments_df = pd.read_sql_table("sirene_establishment", engine)
+    assert establishments_df[["siret", "name", "address1"]].to_dict(
+        orient="records"
+    ) == [
+        {
+            "siret": "11111111100011",
+            "name": "MAIRIE DE RENNES",
+            "address1": "PL DE LA MAIRIE",
+        },
+        {
+            "siret": "22222222200022",
+            "name": "ASSOCIATION DU PORT",
+            "address1": "12 B RUE DU PORT",
+        },
+    ]
@@ -0,0 +1,381 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy as slqa
+
+from data_inclusion.tasks import sirene, siretisation
+
+
+def test_statement_stats():
+    stats = siretisation.StatementStats()
+
+    for _ in range(3):
+        with stats.timed("search_establishment"):
+            pass
+    with stats.timed("prepare"):
+        pass
+
+    assert stats.counts == {"search_establishment": 3, "prepare": 1}
+    assert set(stats.elapsed_seconds) == {"search_establishment", "prepare"}
+
+
+def test_siretize_normalized_dataframe_by_department(monkeypatch):
+    partitions = []
+
+    def fake_search_establishments(structures_df, engine, stats):
+        partitions.append(sorted(structures_df.nom))
+        return pd.DataFrame.from_dict(
+            {
+                row.Index: {"siret": f"siret-{row.nom}"}
+                for row in structures_df.itertuples()
+                if row.code_insee is not None
+            },
+            orient="index",
+            columns=["siret"],
+        )
+
+    monkeypatch.setattr(siretisation, "create_engine", lambda *args, **kwargs: None)
+    monkeypatch.setattr(
+        siretisation, "search_establishments", fake_search_establishments
+    )
+
+    structures_df = pd.DataFrame(
+        {
+            "nom": ["a", "b", "c", "d"],
+            "code_insee": ["35238", "59350", None, "35051"],
+        },
+        index=[10, 11, 12, 13],
+    )
+
+    output_df = siretisation.siretize_normalized_dataframe(
+        structures_df,
+        siretisation_backend=siretisation.PostgresSiretisationBackend(
+            url="postgresql://", exact=False, pool_size=2
+        ),
+        workers=2,
+    )
+
+    assert sorted(partitions) == [["a", "d"], ["b"], ["c"]]
+    assert output_df.index.to_list() == [10, 11, 12, 13]
+    assert output_df.siret.to_list() == ["siret-a", "siret-b", None, "siret-d"]
+
+
+class FakeSiretisationBackend(siretisation.SiretisationBackend):
+    def __init__(self, fail_after: Optional[int] = None):
+        self.fail_after = fail_after
+        self.matched = []
+
+    def match_batch(self, structures_df: pd.DataFrame) -> pd.DataFrame:
+        if self.fail_after is not None and len(self.matched) >= self.fail_after:
+            raise KeyboardInterrupt
+        self.matched += structures_df.nom.to_list()
+        sirets = structures_df.nom.map(lambda nom: None if nom == "c" else f"s-{nom}")
+        return pd.DataFrame({"siret": sirets}, dtype=object)
+
+
+def test_siretize_normalized_data_resumes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "structures.json"
+    pd.DataFrame(
+        {
+            "id": ["1", "2", "3", "4", "5"],
+            "nom": ["a", "b", "c", "d", "e"],
+            "code_insee": ["35238"] * 5,
+            "structure_parente": [None] * 5,
+            "siret": [None, "known", None, None, None],
+            "rna": [None, None, None, "W123", None],
+        }
+    ).to_json(path, orient="records")
+
+    backend = FakeSiretisationBackend(fail_after=2)
+    with pytest.raises(KeyboardInterrupt):
+        siretisation.siretize_normalized_data(
+            path, siretisation_backend=backend, chunk_size=2
+        )
+    assert backend.matched == ["a", "c"]
+    assert len(list(tmp_path.glob("structures.*.siret.checkpoint.csv"))) == 1
+
+    backend = FakeSiretisationBackend()
+    output_path = siretisation.siretize_normalized_data(
+        path, siretisation_backend=backend, chunk_size=2
+    )
+
+    assert backend.matched == ["e"]
+    assert list(tmp_path.glob("*.checkpoint.csv")) == []
+    output_df = pd.read_json(output_path, dtype=False).replace(np.nan, None)
+    assert output_df.siret.to_list() == ["s-a", "known", None, None, "s-e"]
+
+
+def test_siretisation_cache(tmp_path):
+    cache = siretisation.SiretisationCache(path=tmp_path / "cache.sqlite")
+    structures_df = pd.DataFrame(
+        {
+            "nom": ["Mairie", "Café", "mairie", "Sans adresse"],
+            "adresse": [
+                "1 pl. de la mairie",
+                "2 rue haute",
+                "1 place de la Mairie",
+                "",
+            ],
+            "code_insee": ["35238"] * 4,
+            "latitude": [48.11, 48.12, 48.110001, 48.13],
+            "longitude": [-1.68, -1.69, -1.68, -1.7],
+        }
+    )
+    searched = []
+
+    def search_fn(df):
+        searched.append(df.nom.to_list())
+        return pd.DataFrame(
+            {"siret": ["123"], "name_similarity": [0.9]},
+            index=df.index[df.nom == "Mairie"],
+        )
+
+    results_df = cache.match_batch(structures_df, search_fn=search_fn)
+    assert searched == [["Mairie", "Café", "Sans adresse"]]
+    assert results_df.siret.to_dict() == {0: "123", 1: None, 2: "123", 3: None}
+
+    # the same structures, including those without match, are not searched again,
+    # except those that are not searchable
+    results_df = cache.match_batch(structures_df.iloc[::-1], search_fn=search_fn)
+    assert searched[1:] == [["Sans adresse"]]
+    assert results_df.siret.to_dict() == {0: "123", 1: None, 2: "123", 3: None}
+    assert results_df.name_similarity[0] == 0.9
+
+    # results older than the last refresh of the SIRENE data are discarded
+    cache.sirene_refreshed_at = datetime.now() + timedelta(seconds=1)
+    cache.match_batch(structures_df, search_fn=search_fn)
+    assert searched[2:] == [["Mairie", "Café", "Sans adresse"]]
+
+
+def test_recording_and_replaying_backends(tmp_path):
+    structures_df = pd.DataFrame(
+        {
+            "nom": ["a", "b", "c", "d"],
+            "adresse": ["1 rue haute", "2 rue basse", "3 rue neuve", ""],
+            "code_insee": ["35238"] * 4,
+            "latitude": [48.11, 48.12, 48.13, 48.14],
+            "longitude": [-1.68, -1.69, -1.7, -1.71],
+        }
+    )
+    recording_backend = siretisation.RecordingSiretisationBackend(
+        backend=FakeSiretisationBackend(), path=tmp_path / "recording.jsonl"
+    )
+    recording_backend.match_batch(structures_df.iloc[:2])
+    recording_backend.match_batch(structures_df.iloc[2:])
+
+    replaying_backend = siretisation.ReplayingSiretisationBackend(
+        path=tmp_path / "recording.jsonl"
+    )
+    output_df = siretisation.siretize_normalized_dataframe(
+        pd.concat([structures_df, structures_df.assign(nom="e")]),
+        siretisation_backend=replaying_backend,
+    )
+
+    assert output_df.siret.to_list() == ["s-a", "s-b", None, "s-d"] + [None] * 4
+    assert replaying_backend.misses == 4
+
+
+def test_parent_sirens():
+    structures_df = pd.DataFrame(
+        {
+            "id": ["1", "2", "3", "4"],
+            "siret": ["12345678900011", None, None, None],
+            "structure_parente": [None, "1", "2", "5"],
+        }
+    )
+
+    assert siretisation.parent_sirens(structures_df).to_list() == [
+        None,
+        "123456789",
+        None,
+        None,
+    ]
+
+
+def test_postgres_backend_searches_the_exact_match_leftovers(monkeypatch):
+    searched = []
+
+    def fake_match_exactly(structures_df, engine, stats):
+        return pd.DataFrame({"siret": ["exact"]}, index=[11])
+
+    def fake_search_establishments(structures_df, engine, stats):
+        searched.extend(structures_df.index)
+        return pd.DataFrame({"siret": ["fuzzy"]}, index=[12])
+
+    monkeypatch.setattr(siretisation, "create_engine", lambda *args, **kwargs: None)
+    monkeypatch.setattr(siretisation, "match_exactly", fake_match_exactly)
+    monkeypatch.setattr(
+        siretisation, "search_establishments", fake_search_establishments
+    )
+
+    backend = siretisation.PostgresSiretisationBackend(url="postgresql://")
+    results_df = backend.match_batch(
+        pd.DataFrame({"nom": ["a", "b", "c"]}, index=[10, 11, 12])
+    )
+
+    assert searched == [10, 12]
+    assert results_df.siret.to_list() == [None, "exact", "fuzzy"]
+
+
+def test_siretize_normalized_data_discards_stale_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "structures.json"
+
+    def write_input(noms):
+        pd.DataFrame(
+            {
+                "id": noms,
+                "nom": noms,
+                "code_insee": ["35238"] * len(noms),
+                "siret": [None] * len(noms),
+                "rna": [None] * len(noms),
+                "structure_parente": [None] * len(noms),
+            }
+        ).to_json(path, orient="records")
+
+    write_input(["a", "b", "c", "d"])
+    with pytest.raises(KeyboardInterrupt):
+        siretisation.siretize_normalized_data(
+            path,
+            siretisation_backend=FakeSiretisationBackend(fail_after=2),
+            chunk_size=2,
+        )
+
+    # a new extract, with the same name
+    write_input(["z", "y", "c", "d"])
+    backend = FakeSiretisationBackend()
+    output_path = siretisation.siretize_normalized_data(
+        path, siretisation_backend=backend, chunk_size=2
+    )
+
+    assert backend.matched == ["z", "y", "c", "d"]
+    output_df = pd.read_json(output_path, dtype=False).replace(np.nan, None)
+    assert output_df.siret.to_list() == ["s-z", "s-y", None, "s-d"]
+    assert list(tmp_path.glob("*.checkpoint.csv")) == []
+
+
+def test_siretize_normalized_data_keeps_checkpoints_of_other_inputs(
+    tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    # the stem of the first input is a prefix of the stem of the second one
+    paths = [tmp_path / "soliguide.json", tmp_path / "soliguide.geocoded.json"]
+    for path, noms in zip(paths, [["a", "b"], ["c", "d", "e"]]):
+        pd.DataFrame(
+            {
+                "id": noms,
+                "nom": noms,
+                "code_insee": ["35238"] * len(noms),
+                "siret": [None] * len(noms),
+                "rna": [None] * len(noms),
+                "structure_parente": [None] * len(noms),
+            }
+        ).to_json(path, orient="records")
+
+    with pytest.raises(KeyboardInterrupt):
+        siretisation.siretize_normalized_data(
+            paths[1],
+            siretisation_backend=FakeSiretisationBackend(fail_after=2),
+            chunk_size=2,
+        )
+    (checkpoint_path,) = tmp_path.glob("soliguide.geocoded.*.siret.checkpoint.csv")
+
+    siretisation.siretize_normalized_data(
+        paths[0], siretisation_backend=FakeSiretisationBackend(), chunk_size=2
+    )
+    assert checkpoint_path.exists()
+
+    # the interrupted run is still resumed
+    backend = FakeSiretisationBackend()
+    siretisation.siretize_normalized_data(
+        paths[1], siretisation_backend=backend, chunk_size=2
+    )
+    assert backend.matched == ["e"]
+
+
+def test_check_search_plan_explains_the_batch_query(monkeypatch):
+    explained = {}
+
+    def explain(connection, statement, params):
+        if statement == siretisation.BATCH_SEARCH_QUERY:
+            # the batch query reads the structures of the temporary table
+            explained["batch"] = connection.execute(
+                slqa.text("SELECT nom, department FROM structures_to_siretize")
+            ).all()
+            return {"sirene_establishment_name_trgm_idx"}
+        explained["prepared"] = params
+        return set()
+
+    monkeypatch.setattr(sirene, "explain", explain)
+    engine = slqa.create_engine("sqlite://")
+
+    # the prepared statement does not use any index
+    assert not siretisation.check_search_plan(engine)
+    assert explained["prepared"]["department"] == "75"
+    assert explained["batch"] == [("mairie", "75")]
+
+
+def test_search_establishments_batch(tmp_path):
+    # a new connection, and temporary table, by search
+    engine = slqa.create_engine(f"sqlite:///{tmp_path / 'sirene.db'}")
+
+    # sqlite has neither postgis nor pg_trgm : the batch query is replaced by a
+    # query of the temporary table, matching the structures named after a siret
+    @slqa.event.listens_for(engine, "before_cursor_execute", retval=True)
+    def replace_batch_query(conn, cursor, statement, parameters, context, many):
+        if "CROSS JOIN LATERAL" in statement:
+            assert set(context.compiled_parameters[0]) == {
+                "location_within_meters",
+                "name_similarity_threshold",
+            }
+            return (
+                "SELECT position, nom, 0.9, 0.5, latitude + longitude "
+                "FROM structures_to_siretize WHERE nom LIKE 's-%' "
+                "ORDER BY position",
+                (),
+            )
+        return statement, parameters
+
+    structures_df = pd.DataFrame(
+        [
+            ("s-1", "Place de la Mairie", "35238", 48.0, -1.0),
+            ("Epicerie solidaire", "Place de la Mairie", "35238", 48.0, -1.0),
+            # missing data
+            ("s-3", None, "35238", 48.0, -1.0),
+            ("s-4", "Rue du Moulin", "59350", 50.0, 3.0),
+        ],
+        columns=["nom", "adresse", "code_insee", "latitude", "longitude"],
+        index=[7, 2, 5, 0],
+    )
+    stats = siretisation.StatementStats()
+
+    output_df = siretisation.search_establishments(
+        structures_df, engine=engine, stats=stats, chunk_size=1
+    )
+
+    assert output_df.to_dict(orient="index") == {
+        0: {
+            "siret": "s-4",
+            "name_similarity": 0.9,
+            "address_similarity": 0.5,
+            "distance": 53.0,
+        },
+        7: {
+            "siret": "s-1",
+            "name_similarity": 0.9,
+            "address_similarity": 0.5,
+            "distance": 47.0,
+        },
+    }
+    assert stats.counts["search_establishments"] == 1
+
+    # without searchable structure
+    output_df = siretisation.search_establishments(
+        structures_df.iloc[[2]], engine=engine, stats=stats
+    )
+    assert len(output_df) == 0
+    assert list(output_df.columns) == ["siret", *siretisation.SCORE_COLUMNS]